@@ -6,6 +6,7 @@ import email
 import re
 import shortuuid
 import hashlib
+import hmac
 import requests
 import urllib
 from typing import Any, Dict, List, cast
@@ -22,7 +23,7 @@ from .falcon_swagger_ui import register_swaggerui_app  # type: ignore
 
 from .shared import config
 
-from .shared.db import open_db, json_obj, DB, JsonObj
+from .shared.db import open_db, json_obj, DB, JsonObj, pool_metrics
 from .shared.utils import (
     user_log,
     redis_connect,
@@ -43,6 +44,10 @@ from .shared.send import send_rate, sparkpost_domain, mg_domain
 from .shared.tasks import tasks, HIGH_PRIORITY
 from .shared.s3 import s3_write, s3_size, s3_read, s3_copy, s3_delete, s3_write_stream
 from .shared import contacts
+from .shared.geoloc import lookup_ip
+from .shared.daystats import stat_buckets
+from .shared.snapshots import snapshot_metrics
+from .shared.webhooks import invalidate_webhooks
 from .shared.log import get_logger, get_root_logger
 from .shared.version import VERSION
 
@@ -190,6 +195,7 @@ allowedpaths = [
     re.compile(r"^/api/reset/passemail$"),
     re.compile(r"^/api/doc"),
     re.compile(r"^/api/healthy$"),
+    re.compile(r"^/api/metrics/dbpool$"),
     re.compile(r"^/api/showform/"),
     re.compile(r"^/api/trackform/"),
     re.compile(r"^/api/postform/"),
@@ -317,6 +323,20 @@ class Healthy(object):
         pass
 
 
+class DBPoolMetrics(object):
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
+        token = os.environ.get("metrics_token")
+        if not token:
+            raise falcon.HTTPNotFound()
+        auth = req.get_header("Authorization") or ""
+        if not hmac.compare_digest(auth.encode(), ("Bearer %s" % token).encode()):
+            raise falcon.HTTPUnauthorized(title="Invalid token")
+
+        resp.content_type = "text/plain; version=0.0.4"
+        resp.text = pool_metrics() + snapshot_metrics()
+
+
 class Ping(object):
 
     def on_post(self, req: falcon.Request, resp: falcon.Response) -> None:
@@ -568,12 +588,9 @@ class Invite(object):
                         except Exception:
                             pass
                         if ipnum != 0:
-                            row = db.row(
-                                "select country, region from iplocations where iprange @> (%s)::bigint limit 1",
-                                ipnum,
-                            )
+                            row = lookup_ip(db, ipnum)
                             if row is not None:
-                                country, region = row
+                                _, country, region, _ = row
                 except:
                     log.exception("error")
 
@@ -1438,6 +1455,9 @@ RESTHOOK_SCHEMA = {
         "event": {
             "type": "string",
         },
+        "batch": {
+            "type": "boolean",
+        },
     },
     "required": ["target_url", "event"],
 }
@@ -1451,6 +1471,7 @@ class RestHook(object):
         db = req.context["db"]
 
         db.resthooks.remove(id)
+        invalidate_webhooks(db.get_cid())
         resp.status = falcon.HTTP_200
 
     def on_get(self, req: falcon.Request, resp: falcon.Response, id: str) -> None:
@@ -1493,6 +1514,7 @@ class RestHook(object):
         doc["updated"] = datetime.utcnow().isoformat() + "Z"
 
         db.resthooks.patch(id, doc)
+        invalidate_webhooks(db.get_cid())
 
         req.context["result"] = doc
 
@@ -1603,6 +1625,7 @@ class RestHooks(object):
         doc["updated"] = now
 
         newid = db.resthooks.add(doc)
+        invalidate_webhooks(db.get_cid())
 
         req.context["result"] = {"id": newid}
         resp.status = falcon.HTTP_201
@@ -2434,63 +2457,65 @@ class CustomerDashboard(object):
         end = req.get_param("end", required=True)
 
         try:
-            end = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            endts: datetime = (
+                dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            )
         except:
             raise falcon.HTTPBadRequest(
                 title="Invalid parameter", description="invalid date parameter"
             )
 
         now = datetime.utcnow()
-        if end > now:
-            end = now
+        if endts > now:
+            endts = now
 
         dayarray = []
         for i in range(20):
-            dayarray.append(end - (timedelta(days=1) * (19 - i)))
+            dayarray.append(endts - (timedelta(days=1) * (19 - i)))
 
         stats = {}
-        for row in db.execute(
-            """select width_bucket(ts, %s) hourbucket, sum(open),
-                                 sum(
-                                    case when substring(campid from 1 for 3) = 'tx-' then send
-                                    else 0
-                                    end
-                                 ),
-                                 sum(
-                                    case when campaigns.id is not null then send
-                                    else 0
-                                    end
-                                 ),
-                                 sum(
-                                    case when messages.id is not null then send
-                                    else 0
-                                    end
-                                 )
-                                 from hourstats
-                                 left join campaigns on campaigns.id = hourstats.campid
-                                 left join messages on messages.id = hourstats.campid
-                                 where campcid = %s and ts >= %s
-                                 group by hourbucket
-                                 order by hourbucket""",
+        for bucket, row in stat_buckets(
+            db,
+            "campdaystats",
             dayarray,
-            db.get_cid(),
             dayarray[0] - timedelta(days=1),
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
+            """sum({table}.open),
+               sum(
+                  case when substring({table}.campid from 1 for 3) = 'tx-' then {table}.send
+                  else 0
+                  end
+               ),
+               sum(
+                  case when campaigns.id is not null then {table}.send
+                  else 0
+                  end
+               ),
+               sum(
+                  case when messages.id is not null then {table}.send
+                  else 0
+                  end
+               )""",
+            """{table}
+               left join campaigns on campaigns.id = {table}.campid
+               left join messages on messages.id = {table}.campid""",
+            "{table}.campcid = %s",
+            db.get_cid(),
+            inclusive=True,
+        ).items():
+            ts = dayarray[bucket].isoformat() + "Z"
             stats[ts] = {
                 "ts": ts,
-                "open": row[1],
-                "txn": row[2],
-                "bc": row[3],
-                "funnel": row[4],
+                "open": row[0],
+                "txn": row[1],
+                "bc": row[2],
+                "funnel": row[3],
             }
-        for ts in dayarray:
-            t = ts.isoformat() + "Z"
+        for day in dayarray:
+            t = day.isoformat() + "Z"
             if t not in stats:
                 stats[t] = {
                     "ts": t,
+                    "open": 0,
                     "txn": 0,
                     "bc": 0,
                     "funnel": 0,
@@ -3635,6 +3660,7 @@ register_swaggerui_app(
 
 app.add_route("/api/stock/search", StockSearch())
 app.add_route("/api/healthy", Healthy())
+app.add_route("/api/metrics/dbpool", DBPoolMetrics())
 app.add_route("/api/invite", Invite())
 app.add_route("/api/resendcode", ResendCode())
 app.add_route("/api/login", Login())
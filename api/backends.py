@@ -3,7 +3,7 @@ import re
 import dateutil.parser
 import requests
 import shortuuid
-from typing import Dict, List
+from typing import Any, Dict, List
 from netaddr import IPAddress, IPNetwork, IPRange, IPSet
 from dateutil.tz import tzutc
 from datetime import timedelta, datetime
@@ -26,6 +26,7 @@ from .shared.send import (
     setup_sparkpost_webhooks,
     mg_domain,
 )
+from .shared.daystats import stat_buckets
 from .shared.tasks import tasks, HIGH_PRIORITY
 from .shared.log import get_logger
 
@@ -311,7 +312,9 @@ class SettingsSumStats(object):
 
         end = req.get_param("end", required=True)
         try:
-            end = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            endts: datetime = (
+                dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            )
         except:
             raise falcon.HTTPBadRequest(
                 title="Invalid parameter", description="invalid date parameter"
@@ -331,7 +334,7 @@ class SettingsSumStats(object):
 
         dayarray = []
         for i in range(20):
-            dayarray.append(end - timedelta(days=19 - i))
+            dayarray.append(endts - timedelta(days=19 - i))
 
         now = datetime.utcnow()
         hourarray = []
@@ -378,32 +381,32 @@ class SettingsSumStats(object):
                     "defercnt": 0,
                 }
 
+        daywhere = "{table}.cid = %s and {table}.settingsid = %s"
+        dayargs: List[Any] = [db.get_cid(), id]
+        if domains:
+            daywhere += " and {table}.domaingroupid = any(%s)"
+            dayargs.append(domains)
+
         days = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) daybucket,
-            sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-            from hourstats
-            where cid = %%s and settingsid = %%s and ts > %%s
-            %s
-            group by daybucket
-            order by daybucket"""
-            % (domainfilter,),
+        for bucket, row in stat_buckets(
+            db,
+            "daystats",
             dayarray,
-            db.get_cid(),
-            id,
             dayarray[0] - timedelta(days=1),
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
+            "sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)",
+            "{table}",
+            daywhere,
+            *dayargs,
+        ).items():
+            ts = dayarray[bucket].isoformat() + "Z"
             days[ts] = {
                 "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
+                "send": row[0],
+                "soft": row[1],
+                "hard": row[2],
+                "err": row[3],
+                "open": row[4],
+                "defercnt": row[5],
             }
         for ts in dayarray:
             t = ts.isoformat() + "Z"
@@ -986,7 +989,9 @@ class AllStats(object):
 
         end = req.get_param("end", required=True)
         try:
-            end = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            endts: datetime = (
+                dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            )
         except:
             raise falcon.HTTPBadRequest(
                 title="Invalid parameter", description="invalid date parameter"
@@ -1025,7 +1030,7 @@ class AllStats(object):
 
         dayarray = []
         for i in range(20):
-            dayarray.append(end - timedelta(days=19 - i))
+            dayarray.append(endts - timedelta(days=19 - i))
 
         now = datetime.utcnow()
         hourarray = []
@@ -1072,32 +1077,35 @@ class AllStats(object):
                     "defercnt": 0,
                 }
 
+        daywhere = "{table}.cid = %s"
+        dayargs: List[Any] = [db.get_cid()]
+        if domains:
+            daywhere += " and {table}.domaingroupid = any(%s)"
+            dayargs.append(domains)
+        if servers:
+            daywhere += " and {table}.sinkid = any(%s)"
+            dayargs.append(sinks)
+
         days = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) daybucket,
-            sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-            from hourstats
-            where cid = %%s and ts > %%s
-            %s
-            %s
-            group by daybucket
-            order by daybucket"""
-            % (domainfilter, serverfilter),
+        for bucket, row in stat_buckets(
+            db,
+            "daystats",
             dayarray,
-            db.get_cid(),
             dayarray[0] - timedelta(days=1),
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
+            "sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)",
+            "{table}",
+            daywhere,
+            *dayargs,
+        ).items():
+            ts = dayarray[bucket].isoformat() + "Z"
             days[ts] = {
                 "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
+                "send": row[0],
+                "soft": row[1],
+                "hard": row[2],
+                "err": row[3],
+                "open": row[4],
+                "defercnt": row[5],
             }
         for ts in dayarray:
             t = ts.isoformat() + "Z"
@@ -1128,7 +1136,9 @@ class SinkSumStats(object):
 
         end = req.get_param("end", required=True)
         try:
-            end = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            endts: datetime = (
+                dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            )
         except:
             raise falcon.HTTPBadRequest(
                 title="Invalid parameter", description="invalid date parameter"
@@ -1148,7 +1158,7 @@ class SinkSumStats(object):
 
         dayarray = []
         for i in range(20):
-            dayarray.append(end - timedelta(days=19 - i))
+            dayarray.append(endts - timedelta(days=19 - i))
 
         now = datetime.utcnow()
         hourarray = []
@@ -1195,32 +1205,32 @@ class SinkSumStats(object):
                     "defercnt": 0,
                 }
 
+        daywhere = "{table}.cid = %s and {table}.sinkid = %s"
+        dayargs: List[Any] = [db.get_cid(), id]
+        if domains:
+            daywhere += " and {table}.domaingroupid = any(%s)"
+            dayargs.append(domains)
+
         days = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) daybucket,
-            sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-            from hourstats
-            where cid = %%s and sinkid = %%s and ts > %%s
-            %s
-            group by daybucket
-            order by daybucket"""
-            % (domainfilter,),
+        for bucket, row in stat_buckets(
+            db,
+            "daystats",
             dayarray,
-            db.get_cid(),
-            id,
             dayarray[0] - timedelta(days=1),
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
+            "sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)",
+            "{table}",
+            daywhere,
+            *dayargs,
+        ).items():
+            ts = dayarray[bucket].isoformat() + "Z"
             days[ts] = {
                 "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
+                "send": row[0],
+                "soft": row[1],
+                "hard": row[2],
+                "err": row[3],
+                "open": row[4],
+                "defercnt": row[5],
             }
         for ts in dayarray:
             t = ts.isoformat() + "Z"
@@ -14,6 +14,7 @@ import shortuuid
 from abc import abstractmethod
 from typing import Any, List, Tuple, Dict, Set, cast, Iterable
 from fnmatch import fnmatch
+from itertools import groupby
 from datetime import datetime, timedelta
 from io import BytesIO
 
@@ -52,12 +53,15 @@ from .shared.utils import (
 from .shared.segments import (
     segment_get_params,
     get_segment_rows,
-    segment_eval_parts,
+    segment_compile,
+    segment_compile_many,
     segment_get_segments,
     segment_get_campaignids,
     get_segment_sentrows,
     supp_rows,
-    Cache,
+    segment_sql_filter,
+    EvalState,
+    ActivityLogs,
 )
 from .shared.tasks import tasks, HIGH_PRIORITY, LOW_PRIORITY
 from .shared.send import (
@@ -71,7 +75,7 @@ from .shared.send import (
     sink_get_ips,
     fix_headers,
     update_sink_camp,
-    check_send_limit,
+    check_send_limits,
     check_test_limit,
     client_domain,
     get_frontend_params,
@@ -85,6 +89,8 @@ from .shared.s3 import (
     s3_read,
     s3_read_stream,
 )
+from .shared.counters import merge_counters, reset_linkclicks
+from .shared.daystats import incr_daystats
 from .shared.log import get_logger
 
 log = get_logger()
@@ -134,28 +140,20 @@ def write_campaign_lists(
                 db, segment["cid"], campaignids, hashval, hashlimit
             )
 
-            rows = get_segment_rows(db, segment["cid"], hashval, listfactors, hashlimit)
-
-            cache = Cache()
+            rows = get_segment_rows(
+                db,
+                segment["cid"],
+                hashval,
+                listfactors,
+                hashlimit,
+                where=segment_sql_filter(
+                    segment["cid"], [segment], segments, listfactors
+                ),
+            )
 
-            r2 = []
-            segcounts: Dict[str, int] = {}
-            numrows = len(rows)
-            for row in rows:
-                if segment_eval_parts(
-                    segment["parts"],
-                    segment["operator"],
-                    row,
-                    segcounts,
-                    numrows,
-                    segments,
-                    sentrows,
-                    segment,
-                    hashlimit,
-                    cache,
-                ):
-                    r2.append(row)
-            rows = r2
+            pred = segment_compile(segment, segments, hashlimit)
+            state = EvalState(sentrows, len(rows), ActivityLogs(rows))
+            rows = [row for row in rows if pred(row, state)]
 
             def most_recent(row: JsonObj) -> int:
                 maxts = 0
@@ -634,6 +632,31 @@ def fake_hour_stats(
                             err,
                             defer,
                         )
+                        incr_daystats(
+                            db,
+                            [
+                                (
+                                    sink["cid"],
+                                    campcid,
+                                    ts,
+                                    sink["id"],
+                                    domain,
+                                    settingsid,
+                                    campid,
+                                    {
+                                        "complaint": complained,
+                                        "open": opened,
+                                        "click": clicked,
+                                        "unsub": unsub,
+                                        "send": send,
+                                        "soft": soft,
+                                        "hard": hard,
+                                        "err": err,
+                                        "defercnt": defer,
+                                    },
+                                )
+                            ],
+                        )
 
                         db.execute(
                             """insert into statmsgs (id, cid, ts, sinkid, domaingroupid, ip, settingsid, campid,
@@ -803,48 +826,53 @@ def campaign_calculate_segment(
                 db, segment["cid"], campaignids, hashval, hashlimit
             )
 
-            rows = get_segment_rows(db, segment["cid"], hashval, listfactors, hashlimit)
+            # the suppression segment only matters for contacts in the segment,
+            # but its subset counters need to see every row
+            where = None
+            if suppsegment is None or not any(
+                s is not None and s.get("subset")
+                for s in [suppsegment, *suppsegments.values()]
+            ):
+                where = segment_sql_filter(
+                    segment["cid"], [segment], segments, listfactors
+                )
+
+            rows = get_segment_rows(
+                db,
+                segment["cid"],
+                hashval,
+                listfactors,
+                hashlimit,
+                where=where,
+                snapshot=True,
+            )
 
             unavailable = 0
             tagsupped = 0
 
             supptags: Set[str] = set(supptagslist)
 
-            cache = Cache()
+            # the suppression segment repeats the include rules, which one
+            # plan evaluates once per row for both
+            supppred = None
+            if suppsegment is None:
+                pred = segment_compile(segment, segments, hashlimit)
+            else:
+                pred, supppred = segment_compile_many(
+                    [segment, suppsegment], {**segments, **suppsegments}, hashlimit
+                )
+            logs = ActivityLogs(rows)
+            state = EvalState(sentrows, len(rows), logs)
+            suppstate = EvalState(sentrows, len(rows), logs)
 
             segrows = set()
-            numrows = len(rows)
-            suppsegcounts: Dict[str, int] = {}
-            segcounts: Dict[str, int] = {}
             for row in rows:
                 suppsegmentpassed = True
-                if suppsegment is not None:
-                    if not segment_eval_parts(
-                        suppsegment["parts"],
-                        suppsegment["operator"],
-                        row,
-                        suppsegcounts,
-                        numrows,
-                        suppsegments,
-                        sentrows,
-                        suppsegment,
-                        hashlimit,
-                        cache,
-                    ):
+                if supppred is not None:
+                    if not supppred(row, suppstate):
                         suppsegmentpassed = False
 
-                if segment_eval_parts(
-                    segment["parts"],
-                    segment["operator"],
-                    row,
-                    segcounts,
-                    numrows,
-                    segments,
-                    sentrows,
-                    segment,
-                    hashlimit,
-                    cache,
-                ):
+                if pred(row, state):
                     if (
                         is_true(row.get("Unsubscribed", ("",))[0])
                         or is_true(row.get("Complained", ("",))[0])
@@ -1075,7 +1103,9 @@ def campaign_start(campid: str) -> None:
 
             taskparams = []
             for taskobj in taskgroups:
-                gatherid = gather_init(db, "write_campaign_lists", hashlimit)
+                gatherid = gather_init(
+                    db, "write_campaign_lists", hashlimit, camp["cid"]
+                )
                 for i in range(hashlimit):
                     taskparams.append(
                         (
@@ -1241,41 +1271,43 @@ def export_campaign(
                 "soft": "softbounced",
             }
 
-            for (contact_email,) in db.execute(
-                f"""select c.email
-                                    from contacts."contacts_{cid}" c
-                                    join contacts."contact_send_logs_{cid}" s on s.contact_id = c.contact_id
-                                    where s.campid = %s""",
-                campid,
-            ):
-                key = "delivered"
-                if key not in fps:
-                    fps[key] = open(files[key], "w")
-                    dw = csv.DictWriter(fps[key], ["Email"])
-                    writers[key] = dw
-                    dw.writeheader()
-                dw = cast("csv.DictWriter[str]", writers[key])
-                dw.writerow({"Email": contact_email})
-                cnt += 1
-
-            for contact_email, cmd, ts, code in db.execute(
-                "select email, cmd, ts, code from camplogs where campid = %s", campid
-            ):
-                key = cmdtokey[cmd]
-                if key not in fps:
-                    fps[key] = open(files[key], "w")
-                    w = cast(_CSVWriter, csv.writer(fps[key]))
-                    writers[key] = w
+            with db.transaction():
+                for (contact_email,) in db.stream(
+                    f"""select c.email
+                                        from contacts."contacts_{cid}" c
+                                        join contacts."contact_send_logs_{cid}" s on s.contact_id = c.contact_id
+                                        where s.campid = %s""",
+                    campid,
+                ):
+                    key = "delivered"
+                    if key not in fps:
+                        fps[key] = open(files[key], "w")
+                        dw = csv.DictWriter(fps[key], ["Email"])
+                        writers[key] = dw
+                        dw.writeheader()
+                    dw = cast("csv.DictWriter[str]", writers[key])
+                    dw.writerow({"Email": contact_email})
+                    cnt += 1
+
+                for contact_email, cmd, ts, code in db.stream(
+                    "select email, cmd, ts, code from camplogs where campid = %s",
+                    campid,
+                ):
+                    key = cmdtokey[cmd]
+                    if key not in fps:
+                        fps[key] = open(files[key], "w")
+                        w = cast(_CSVWriter, csv.writer(fps[key]))
+                        writers[key] = w
+                        if cmd in ("bounce", "soft"):
+                            w.writerow(("Email", "Date", "Msg"))
+                        else:
+                            w.writerow(("Email", "Date"))
                     if cmd in ("bounce", "soft"):
-                        w.writerow(("Email", "Date", "Msg"))
+                        w = cast(_CSVWriter, writers[key])
+                        w.writerow((contact_email, ts.isoformat() + "Z", code))
                     else:
-                        w.writerow(("Email", "Date"))
-                if cmd in ("bounce", "soft"):
-                    w = cast(_CSVWriter, writers[key])
-                    w.writerow((contact_email, ts.isoformat() + "Z", code))
-                else:
-                    w = cast(_CSVWriter, writers[key])
-                    w.writerow((contact_email, ts.isoformat() + "Z"))
+                        w = cast(_CSVWriter, writers[key])
+                        w.writerow((contact_email, ts.isoformat() + "Z"))
 
             zipname = "/tmp/%s.zip" % exportid
             outzip = zipfile.ZipFile(zipname, "w", zipfile.ZIP_DEFLATED)
@@ -1319,7 +1351,7 @@ class CampaignUpdate(object):
                 title="Not JSON", description="A valid JSON document is required."
             )
 
-        db = req.context["db"]
+        db: DB = req.context["db"]
 
         doc.pop("when", None)
         doc.pop("scheduled_for", None)
@@ -1440,6 +1472,7 @@ class CampaignUpdate(object):
             linkurls,
             camp["id"],
         )
+        reset_linkclicks(db, True, camp["id"])
         db.execute(
             """update campqueue set data = data || %s where cid = %s and campid = %s""",
             queueobj,
@@ -1791,7 +1824,7 @@ class CampaignCalculate(object):
                 if listfactor not in listfactors:
                     listfactors.append(listfactor)
 
-        gatherid = gather_init(db, "campaign_calculate_segment", hashlimit)
+        gatherid = gather_init(db, "campaign_calculate_segment", hashlimit, camp["cid"])
 
         suppfactors = [supplist["id"] for supplist in supplists if supplist is not None]
 
@@ -1941,7 +1974,7 @@ class RecentCampaigns(object):
     def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
         check_noadmin(req)
 
-        db = req.context["db"]
+        db: DB = req.context["db"]
 
         segid = req.get_param("segid")
 
@@ -2010,6 +2043,9 @@ class RecentCampaigns(object):
                 if camp is not None:
                     ret.append(camp)
 
+        merge_counters(db, True, [r for r in ret if r["is_bc"]])
+        merge_counters(db, False, [r for r in ret if not r["is_bc"]])
+
         ret.sort(
             key=lambda x: cast(str, x.get("sent_at")) or cast(str, x.get("modified")),
             reverse=True,
@@ -2540,6 +2576,9 @@ class Campaign(CRUDSingle):
 
         CRUDSingle.on_get(self, req, resp, id)
 
+        db: DB = req.context["db"]
+        merge_counters(db, True, [req.context["result"]])
+
         if req.context["api"]:
             req.context["result"].pop(
                 "delivered", None
@@ -2886,6 +2925,35 @@ except ValueError:
 
 
 CHECK_CAMPS_LOCK = 59479592
+CHECK_CAMPS_PAGE = 200
+
+
+def queued_camp_tasks(
+    cid: str,
+    campid: str,
+    sendid: str,
+    domain: str,
+    data: JsonObj,
+    offset: int,
+    tosend: int,
+) -> List[Tuple[Any, ...]]:
+    # pre-batch these because they can only send one email at a time
+    if data["policytype"] in ("ses", "smtprelay", "easylink"):
+        return [
+            (
+                send_queued_camp,
+                cid,
+                campid,
+                sendid,
+                domain,
+                data,
+                offset + i,
+                min(tosend - i, MAX_SEND_LIMIT),
+            )
+            for i in range(0, tosend, MAX_SEND_LIMIT)
+        ]
+    # mailgun, sparkpost, mta can all do batch sends
+    return [(send_queued_camp, cid, campid, sendid, domain, data, offset, tosend)]
 
 
 def check_camps() -> None:
@@ -2898,14 +2966,17 @@ def check_camps() -> None:
                     log.info("check_camps already running")
                     return
 
-                while True:
-                    lastcid: str | None = None
-                    lastcampid: str | None = None
-                    lastdomain: str | None = None
+                # companies and their throttles are loaded once per pass
+                companies: Dict[str, JsonObj | None] = {}
+                throttles: Dict[str, List[JsonObj]] = {}
 
+                lastcid: str | None = None
+                lastcampid: str | None = None
+                lastdomain: str | None = None
+
+                while True:
                     with open_db() as db:
                         with db.transaction():
-                            alltasks = []
                             queue_items = list(
                                 db.execute(
                                     """select q.cid, campid, c.data->>'route' r, domain, sum(remaining)
@@ -2917,160 +2988,156 @@ def check_camps() -> None:
                                        ) and remaining > 0
                                        group by q.cid, campid, r, domain
                                        order by q.cid, campid, domain
-                                       limit 200""",
+                                       limit %s""",
                                     lastcid,
                                     lastcid,
                                     lastcampid,
                                     lastdomain,
+                                    CHECK_CAMPS_PAGE,
                                 )
                             )
 
                             if len(queue_items) == 0:
                                 break
 
-                            for cid, campid, route, domain, cnt in queue_items:
-                                lastcid = cid
-                                lastcampid = campid
-                                lastdomain = domain
-
-                                company = db.companies.get(cid)
-                                if company is not None:
-                                    requesting = cnt
-
-                                    domainthrottles = load_domain_throttles(db, company)
-
-                                    cnt = check_send_limit(
-                                        company, route, domain, domainthrottles, cnt
+                            lastcid, lastcampid, _, lastdomain, _ = queue_items[-1]
+
+                            # reserve quota for each company's page of items at once
+                            grants: List[int] = []
+                            for cid, group in groupby(queue_items, lambda i: i[0]):
+                                pageitems = list(group)
+                                if cid not in companies:
+                                    company = companies[cid] = db.companies.get(cid)
+                                    if company is not None:
+                                        throttles[cid] = load_domain_throttles(
+                                            db, company
+                                        )
+                                company = companies[cid]
+                                if company is None:
+                                    grants.extend(0 for _ in pageitems)
+                                    continue
+                                grants.extend(
+                                    check_send_limits(
+                                        company,
+                                        throttles[cid],
+                                        [(r, d, c) for _, _, r, d, c in pageitems],
                                     )
-                                    if cnt > 0:
-                                        log.debug(
-                                            "%s clear to send %s for campaign %s route %s domain %s (requested %s)",
+                                )
+
+                            granted = {
+                                (item[0], item[1], item[3]): (item[2], item[4], cnt)
+                                for item, cnt in zip(queue_items, grants)
+                                if cnt > 0
+                            }
+                            if not granted:
+                                continue
+
+                            # split each grant across its queue rows, then apply
+                            # all of the decrements in one statement
+                            alltasks: List[Tuple[Any, ...]] = []
+                            sent: List[Tuple[str, str, str, str, int]] = []
+                            items = db.execute(
+                                """select q.cid, q.campid, q.domain, q.sendid, q.count, q.remaining, q.data
+                                   from campqueue q
+                                   inner join unnest(%s::text[], %s::text[], %s::text[]) g (cid, campid, domain)
+                                   on q.cid = g.cid and q.campid = g.campid and q.domain = g.domain
+                                   order by q.cid, q.campid, q.domain, q.sendid""",
+                                *(list(k) for k in zip(*granted)),
+                            )
+                            for (cid, campid, domain), group in groupby(
+                                items, lambda i: (i[0], i[1], i[2])
+                            ):
+                                route, requesting, cnt = granted[(cid, campid, domain)]
+                                log.debug(
+                                    "%s clear to send %s for campaign %s route %s domain %s (requested %s)",
+                                    cid,
+                                    cnt,
+                                    campid,
+                                    route,
+                                    domain,
+                                    requesting,
+                                )
+                                rows = list(group)
+                                cntperitem = max(1, int(math.ceil(cnt / len(rows))))
+                                for _, _, _, sendid, sendcount, remaining, data in rows:
+                                    tosend = min(cntperitem, remaining)
+                                    alltasks.extend(
+                                        queued_camp_tasks(
                                             cid,
-                                            cnt,
                                             campid,
-                                            route,
+                                            sendid,
                                             domain,
-                                            requesting,
-                                        )
-                                        items = list(
-                                            db.execute(
-                                                "select sendid, count, remaining, data from campqueue where cid = %s and campid = %s and domain = %s",
-                                                cid,
-                                                campid,
-                                                domain,
-                                            )
+                                            data,
+                                            sendcount - remaining,
+                                            tosend,
                                         )
-                                        cntperitem = 1
-                                        if len(items):
-                                            cntperitem = int(
-                                                math.ceil(cnt / len(items))
-                                            )
-                                        if cntperitem == 0:
-                                            cntperitem = 1
-                                        for sendid, sendcount, remaining, data in items:
-                                            tosend = min(cntperitem, remaining)
-
-                                            # pre-batch these because they can only send one email at a time
-                                            if data["policytype"] in (
-                                                "ses",
-                                                "smtprelay",
-                                                "easylink",
-                                            ):
-                                                taskoffset = sendcount - remaining
-                                                tasktosend = min(tosend, MAX_SEND_LIMIT)
-                                                tasksent = 0
-                                                while tasksent < tosend:
-                                                    alltasks.append(
-                                                        (
-                                                            send_queued_camp,
-                                                            cid,
-                                                            campid,
-                                                            sendid,
-                                                            domain,
-                                                            data,
-                                                            taskoffset,
-                                                            tasktosend,
-                                                        )
-                                                    )
-                                                    tasksent += tasktosend
-                                                    taskoffset += tasktosend
-                                                    tasktosend = min(
-                                                        tosend - tasksent,
-                                                        MAX_SEND_LIMIT,
-                                                    )
-                                            else:  # mailgun, sparkpost, mta can all do batch sends
-                                                alltasks.append(
-                                                    (
-                                                        send_queued_camp,
-                                                        cid,
-                                                        campid,
-                                                        sendid,
-                                                        domain,
-                                                        data,
-                                                        sendcount - remaining,
-                                                        tosend,
-                                                    )
-                                                )
-
-                                            if remaining - tosend <= 0:
-                                                db.execute(
-                                                    "delete from campqueue where cid = %s and campid = %s and sendid = %s and domain = %s",
-                                                    cid,
-                                                    campid,
-                                                    sendid,
-                                                    domain,
-                                                )
-
-                                                if (
-                                                    db.single(
-                                                        "select count(sendid) from campqueue where cid = %s and campid = %s and data->>'sinkid' = %s",
-                                                        cid,
-                                                        campid,
-                                                        data["sinkid"],
-                                                    )
-                                                    == 0
-                                                ):
-                                                    db.execute(
-                                                        "update campaigns set data = data || jsonb_build_object('sinkstatus', (data->>'sinkstatus')::jsonb || jsonb_build_object(%s, true)) where id = %s",
-                                                        data["sinkid"],
-                                                        campid,
-                                                    )
-
-                                                    camp = json_obj(
-                                                        db.row(
-                                                            "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
-                                                            campid,
-                                                        )
-                                                    )
-
-                                                    if (
-                                                        camp is not None
-                                                        and False
-                                                        not in list(
-                                                            camp["sinkstatus"].values()
-                                                        )
-                                                    ):
-                                                        db.campaigns.patch(
-                                                            campid,
-                                                            {
-                                                                "finished_at": datetime.utcnow().isoformat()
-                                                                + "Z"
-                                                            },
-                                                        )
-                                            else:
-                                                db.execute(
-                                                    "update campqueue set remaining = remaining - %s where cid = %s and campid = %s and sendid = %s and domain = %s",
-                                                    tosend,
-                                                    cid,
-                                                    campid,
-                                                    sendid,
-                                                    domain,
-                                                )
-
-                                            cnt -= tosend
-
-                                            if cnt <= 0:
-                                                break
+                                    )
+                                    sent.append((cid, campid, sendid, domain, tosend))
+
+                                    cnt -= tosend
+
+                                    if cnt <= 0:
+                                        break
+
+                            emptied = list(
+                                db.execute(
+                                    """with v as (
+                                         select * from unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::int[])
+                                           v (cid, campid, sendid, domain, tosend)
+                                       ), done as (
+                                         delete from campqueue q using v
+                                         where q.cid = v.cid and q.campid = v.campid and q.sendid = v.sendid and q.domain = v.domain
+                                         and q.remaining - v.tosend <= 0
+                                         returning q.cid, q.campid, q.data->>'sinkid' sinkid
+                                       ), decremented as (
+                                         update campqueue q set remaining = q.remaining - v.tosend from v
+                                         where q.cid = v.cid and q.campid = v.campid and q.sendid = v.sendid and q.domain = v.domain
+                                         and q.remaining - v.tosend > 0
+                                       )
+                                       select distinct cid, campid, sinkid from done""",
+                                    *(list(c) for c in zip(*sent)),
+                                )
+                            )
+
+                            # a sink is finished with a campaign once none of its
+                            # queue rows are left
+                            finished = []
+                            if emptied:
+                                finished = list(
+                                    db.execute(
+                                        """select d.campid, d.sinkid
+                                           from unnest(%s::text[], %s::text[], %s::text[]) d (cid, campid, sinkid)
+                                           where not exists (
+                                             select 1 from campqueue q
+                                             where q.cid = d.cid and q.campid = d.campid and q.data->>'sinkid' = d.sinkid
+                                           )""",
+                                        *(list(c) for c in zip(*emptied)),
+                                    )
+                                )
+                            for campid, sinkid in finished:
+                                db.execute(
+                                    "update campaigns set data = data || jsonb_build_object('sinkstatus', (data->>'sinkstatus')::jsonb || jsonb_build_object(%s, true)) where id = %s",
+                                    sinkid,
+                                    campid,
+                                )
+
+                                camp = json_obj(
+                                    db.row(
+                                        "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
+                                        campid,
+                                    )
+                                )
+
+                                if camp is not None and False not in list(
+                                    camp["sinkstatus"].values()
+                                ):
+                                    db.campaigns.patch(
+                                        campid,
+                                        {
+                                            "finished_at": datetime.utcnow().isoformat()
+                                            + "Z"
+                                        },
+                                    )
 
                             run_tasks(alltasks)
         except:
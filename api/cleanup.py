@@ -7,12 +7,17 @@ from datetime import datetime, timedelta
 from .shared import config as _  # noqa: F401
 from .campaigns import export_campaign
 from .shared.db import open_db, json_iter
-from .shared.utils import run_task
+from .shared.utils import run_task, gather_stragglers
 from .shared.s3 import s3_delete_all
+from .shared.snapshots import SNAPSHOT_TTL
+from .shared.findruns import FIND_TTL
 from .shared.log import get_logger
 
 log = get_logger()
 
+# gathers still incomplete after this long are reported as stragglers
+GATHER_STRAGGLER_AGE = 60 * 60
+
 
 def cleanup_db() -> None:
     with open_db() as db:
@@ -25,6 +30,14 @@ def cleanup_db() -> None:
                 "delete from hourstats where ts < %s",
                 (datetime.utcnow() - timedelta(days=90)),
             )
+            db.execute(
+                "delete from daystats where day < %s",
+                (datetime.utcnow() - timedelta(days=90)).date(),
+            )
+            db.execute(
+                "delete from campdaystats where day < %s",
+                (datetime.utcnow() - timedelta(days=90)).date(),
+            )
             db.execute(
                 "delete from statmsgs where ts < %s",
                 (datetime.utcnow() - timedelta(days=90)),
@@ -47,14 +60,15 @@ def cleanup_db() -> None:
                 (datetime.utcnow() - timedelta(days=1)).isoformat() + "Z",
             )
 
-            db.execute(
-                "delete from taskgather where data->>'ts' < %s",
-                (datetime.utcnow() - timedelta(days=3)).isoformat() + "Z",
-            )
-            db.execute(
-                "delete from taskgatherdata where data->>'ts' < %s",
-                (datetime.utcnow() - timedelta(days=3)).isoformat() + "Z",
-            )
+            for gather in gather_stragglers(GATHER_STRAGGLER_AGE):
+                log.warning(
+                    "gather %s (%s) started at %s has only %s of %s tasks complete",
+                    gather["id"],
+                    gather["name"],
+                    gather["ts"],
+                    gather["count"],
+                    gather["limit"],
+                )
 
             db.execute(
                 "delete from userlogs where data->>'ts' < %s",
@@ -126,6 +140,14 @@ def cleanup_db() -> None:
                 "delete from sparkpost_events where ts < %s",
                 (datetime.utcnow() - timedelta(days=2)),
             )
+            # changes of companies whose segments aren't refreshed, such as
+            # demo accounts, are never consumed
+            db.execute(
+                "delete from contact_changes where changed < now() - interval '2 days'"
+            )
+            # ids of track events are removed once the stream entries are
+            # acknowledged; these are left by workers which died in between
+            db.execute("delete from track_entries where ts < now() - interval '7 days'")
 
             file_retention_days = int(os.environ.get("file_retention_days", 90))
 
@@ -137,5 +159,13 @@ def cleanup_db() -> None:
                 os.environ["s3_databucket"],
                 time.time() - (file_retention_days * 24 * 60 * 60),
             )
+            s3_delete_all(
+                os.path.join(os.environ["s3_transferbucket"], "snapshots"),
+                time.time() - SNAPSHOT_TTL,
+            )
+            s3_delete_all(
+                os.path.join(os.environ["s3_transferbucket"], "listfind"),
+                time.time() - FIND_TTL,
+            )
         except:
             log.exception("error")
@@ -6,7 +6,9 @@ import falcon
 import shortuuid
 import dateutil.parser
 import redis
-from typing import Tuple, List, Dict, Any, Callable
+import socket
+from collections import defaultdict
+from typing import Tuple, List, Dict, Any, Callable, cast
 from netaddr import IPAddress
 from datetime import datetime, timedelta
 
@@ -17,9 +19,8 @@ from .shared.utils import (
     get_contact_id,
     redis_connect,
     get_txn,
-    get_os,
-    get_browser,
-    get_device,
+    classify_agent,
+    classify_agents,
     os_names,
     browser_names,
     device_names,
@@ -31,13 +32,18 @@ from .shared.utils import (
     clickletters,
     unsubletters,
     viewletters,
+    LRUCache,
 )
 from .shared.send import unencrypt, handle_soft_event
+from .shared.tracking import set_tracking, get_tracking, TrackingInfo
+from .shared.geoloc import lookup_ip
 from .shared.crud import check_noadmin
 from .shared.s3 import s3_read, s3_delete
 from .shared import contacts
 from .shared.log import get_logger
 from .shared.webhooks import send_webhooks
+from .shared.counters import incr_counters, incr_counter_rows, CounterRow, LINKCLICKS
+from .shared.daystats import incr_daystats
 
 log = get_logger()
 
@@ -106,6 +112,31 @@ def hourstats_insert(
         err,
         defercnt,
     )
+    incr_daystats(
+        db,
+        [
+            (
+                cid,
+                campcid,
+                ts,
+                sinkid,
+                domain,
+                settingsid,
+                campid,
+                {
+                    "complaint": complaint,
+                    "unsub": unsub,
+                    "open": open,
+                    "click": click,
+                    "send": send,
+                    "soft": soft,
+                    "hard": hard,
+                    "err": err,
+                    "defercnt": defercnt,
+                },
+            )
+        ],
+    )
 
 
 def txnstats_insert(
@@ -157,6 +188,404 @@ def txnstats_insert(
     )
 
 
+# campaigns and funnel messages keep their per-event counters in tables with
+# the same layout, prefixed "campaign" or "message"
+_counter_tables = {True: ("campaign", "campaigns"), False: ("message", "messages")}
+
+
+class EventCounters(object):
+    """Counter increments made while writing an event.  This class applies
+    each increment as soon as it is made; BatchedEventCounters collects them
+    so that a batch of events can be written with one upsert per row."""
+
+    def device(self, db: DB, is_camp: bool, c: str, device: int) -> None:
+        p = _counter_tables[is_camp][0]
+        db.execute(
+            f"""insert into {p}_devices ({p}_id, device, count) values (%s, %s, 1)
+                  on conflict ({p}_id, device) do update set
+                  count = {p}_devices.count + 1""",
+            c,
+            device,
+        )
+
+    def browser(
+        self, db: DB, is_camp: bool, c: str, os: int | None, browser: int | None
+    ) -> None:
+        p = _counter_tables[is_camp][0]
+        db.execute(
+            f"""insert into {p}_browsers ({p}_id, os, browser, count) values (%s, %s, %s, 1)
+                  on conflict ({p}_id, os, browser) do update set
+                  count = {p}_browsers.count + 1""",
+            c,
+            os,
+            browser,
+        )
+
+    def location(
+        self,
+        db: DB,
+        is_camp: bool,
+        c: str,
+        countrycode: str | None,
+        country: str,
+        region: str | None,
+    ) -> None:
+        p = _counter_tables[is_camp][0]
+        db.execute(
+            f"""insert into {p}_locations ({p}_id, country_code, country, region, count) values (%s, %s, %s, %s, 1)
+                  on conflict ({p}_id, country_code, region) do update set
+                  count = {p}_locations.count + 1""",
+            c,
+            countrycode,
+            country,
+            region,
+        )
+
+    def linkclick(self, db: DB, is_camp: bool, c: str, linkindex: int) -> None:
+        incr_counter_rows(db, is_camp, [(c, LINKCLICKS, linkindex, 1)])
+
+    def prop(self, db: DB, is_camp: bool, c: str, prop: str) -> None:
+        incr_counter_rows(db, is_camp, [(c, prop, -1, 1)])
+
+    def hourstats(
+        self,
+        db: DB,
+        cid: str,
+        campcid: str,
+        ts: datetime,
+        sinkid: str,
+        domain: str,
+        ip: str,
+        settingsid: str,
+        campid: str,
+        complaint: int,
+        unsub: int,
+        open: int,
+        click: int,
+    ) -> None:
+        hourstats_insert(
+            db,
+            cid,
+            campcid,
+            ts,
+            sinkid,
+            domain,
+            ip,
+            settingsid,
+            campid,
+            complaint,
+            unsub,
+            open,
+            click,
+        )
+
+    def txnstats(
+        self,
+        db: DB,
+        cid: str,
+        ts: datetime,
+        tag: str,
+        domain: str,
+        complaint: int,
+        unsub: int,
+        open: int,
+        click: int,
+        open_all: int,
+        click_all: int,
+    ) -> None:
+        txnstats_insert(
+            db,
+            cid,
+            ts,
+            tag,
+            domain,
+            complaint,
+            unsub,
+            open,
+            click,
+            open_all,
+            click_all,
+        )
+
+
+direct_counters = EventCounters()
+
+
+def _hour(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _add(totals: List[int], counts: Tuple[int, ...]) -> None:
+    for i, n in enumerate(counts):
+        totals[i] += n
+
+
+class BatchedEventCounters(EventCounters):
+
+    def __init__(self) -> None:
+        self.devices: Dict[Tuple[bool, str, int], int] = defaultdict(int)
+        self.browsers: Dict[Tuple[bool, str, int | None, int | None], int] = (
+            defaultdict(int)
+        )
+        self.locations: Dict[Tuple[bool, str, str | None, str | None], List[Any]] = {}
+        self.linkclicks: Dict[Tuple[bool, str, int], int] = defaultdict(int)
+        self.props: Dict[Tuple[bool, str], Dict[str, int]] = {}
+        self.hourstat: Dict[Tuple[Any, ...], List[int]] = {}
+        self.txnstat: Dict[Tuple[Any, ...], List[int]] = {}
+
+    def device(self, db: DB, is_camp: bool, c: str, device: int) -> None:
+        self.devices[is_camp, c, device] += 1
+
+    def browser(
+        self, db: DB, is_camp: bool, c: str, os: int | None, browser: int | None
+    ) -> None:
+        self.browsers[is_camp, c, os, browser] += 1
+
+    def location(
+        self,
+        db: DB,
+        is_camp: bool,
+        c: str,
+        countrycode: str | None,
+        country: str,
+        region: str | None,
+    ) -> None:
+        key = (is_camp, c, countrycode, region)
+        if key not in self.locations:
+            self.locations[key] = [country, 0]
+        self.locations[key][1] += 1
+
+    def linkclick(self, db: DB, is_camp: bool, c: str, linkindex: int) -> None:
+        self.linkclicks[is_camp, c, linkindex] += 1
+
+    def prop(self, db: DB, is_camp: bool, c: str, prop: str) -> None:
+        props = self.props.setdefault((is_camp, c), {})
+        props[prop] = props.get(prop, 0) + 1
+
+    def hourstats(
+        self,
+        db: DB,
+        cid: str,
+        campcid: str,
+        ts: datetime,
+        sinkid: str,
+        domain: str,
+        ip: str,
+        settingsid: str,
+        campid: str,
+        complaint: int,
+        unsub: int,
+        open: int,
+        click: int,
+    ) -> None:
+        # hourstats_uniq, plus the customer columns which follow from it
+        key = (_hour(ts), sinkid, domain, ip, settingsid, campid, cid, campcid)
+        if key not in self.hourstat:
+            self.hourstat[key] = [0, 0, 0, 0]
+        _add(self.hourstat[key], (complaint, unsub, open, click))
+
+    def txnstats(
+        self,
+        db: DB,
+        cid: str,
+        ts: datetime,
+        tag: str,
+        domain: str,
+        complaint: int,
+        unsub: int,
+        open: int,
+        click: int,
+        open_all: int,
+        click_all: int,
+    ) -> None:
+        key = (_hour(ts), cid, tag, domain)
+        if key not in self.txnstat:
+            self.txnstat[key] = [0, 0, 0, 0, 0, 0]
+        _add(self.txnstat[key], (complaint, unsub, open, click, open_all, click_all))
+
+    def merge(self, other: "BatchedEventCounters") -> None:
+        for key, n in other.devices.items():
+            self.devices[key] += n
+        for bkey, n in other.browsers.items():
+            self.browsers[bkey] += n
+        for lkey, (country, n) in other.locations.items():
+            if lkey not in self.locations:
+                self.locations[lkey] = [country, 0]
+            self.locations[lkey][1] += n
+        for key, n in other.linkclicks.items():
+            self.linkclicks[key] += n
+        for pkey, props in other.props.items():
+            mine = self.props.setdefault(pkey, {})
+            for prop, n in props.items():
+                mine[prop] = mine.get(prop, 0) + n
+        for hkey, counts in other.hourstat.items():
+            _add(self.hourstat.setdefault(hkey, [0, 0, 0, 0]), tuple(counts))
+        for tkey, counts in other.txnstat.items():
+            _add(self.txnstat.setdefault(tkey, [0, 0, 0, 0, 0, 0]), tuple(counts))
+
+    def flush(self, db: DB) -> None:
+        """Write the collected increments in one transaction."""
+        with db.transaction():
+            self.write(db)
+
+    def write(self, db: DB) -> None:
+        """Write the collected increments in the current transaction.  Rows
+        are written in key order so that concurrent workers lock hot counter
+        rows in the same order."""
+        for is_camp in (True, False):
+            p = _counter_tables[is_camp][0]
+
+            devices = sorted(
+                (c, device, n)
+                for (ic, c, device), n in self.devices.items()
+                if ic == is_camp
+            )
+            if devices:
+                db.execute_values(
+                    f"""insert into {p}_devices ({p}_id, device, count) values %s
+                          on conflict ({p}_id, device) do update set
+                          count = {p}_devices.count + excluded.count""",
+                    devices,
+                )
+
+            browsers = sorted(
+                (
+                    (c, os, browser, n)
+                    for (ic, c, os, browser), n in self.browsers.items()
+                    if ic == is_camp
+                ),
+                key=lambda r: (r[0], r[1] or 0, r[2] or 0),
+            )
+            if browsers:
+                db.execute_values(
+                    f"""insert into {p}_browsers ({p}_id, os, browser, count) values %s
+                          on conflict ({p}_id, os, browser) do update set
+                          count = {p}_browsers.count + excluded.count""",
+                    browsers,
+                )
+
+            locations = sorted(
+                (
+                    (c, countrycode, country, region, n)
+                    for (ic, c, countrycode, region), (
+                        country,
+                        n,
+                    ) in self.locations.items()
+                    if ic == is_camp
+                ),
+                key=lambda r: (r[0], r[1] or "", r[3] or ""),
+            )
+            if locations:
+                db.execute_values(
+                    f"""insert into {p}_locations ({p}_id, country_code, country, region, count) values %s
+                          on conflict ({p}_id, country_code, region) do update set
+                          count = {p}_locations.count + excluded.count""",
+                    locations,
+                )
+
+            rows: List[CounterRow] = [
+                (c, LINKCLICKS, linkindex, n)
+                for (ic, c, linkindex), n in self.linkclicks.items()
+                if ic == is_camp
+            ]
+            rows.extend(
+                (c, prop, -1, n)
+                for (ic, c), props in self.props.items()
+                if ic == is_camp
+                for prop, n in props.items()
+            )
+            incr_counter_rows(db, is_camp, rows)
+
+        hourstats = sorted(
+            (
+                (
+                    shortuuid.uuid(),
+                    cid,
+                    campcid,
+                    ts,
+                    sinkid,
+                    domain,
+                    ip,
+                    settingsid,
+                    campid,
+                    *counts,
+                )
+                for (
+                    ts,
+                    sinkid,
+                    domain,
+                    ip,
+                    settingsid,
+                    campid,
+                    cid,
+                    campcid,
+                ), counts in self.hourstat.items()
+            ),
+            key=lambda r: r[3:9],
+        )
+        if hourstats:
+            db.execute_values(
+                """insert into hourstats (id, cid, campcid, ts, sinkid, domaingroupid, ip, settingsid, campid,
+                      complaint, unsub, open, click, send, soft, hard, err, defercnt)
+                      values %s
+                      on conflict on constraint hourstats_uniq do update set
+                      complaint = hourstats.complaint + excluded.complaint,
+                      unsub =     hourstats.unsub     + excluded.unsub,
+                      open =      hourstats.open      + excluded.open,
+                      click =     hourstats.click     + excluded.click""",
+                hourstats,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, 0, 0, 0, 0)",
+            )
+            incr_daystats(
+                db,
+                (
+                    (
+                        cid,
+                        campcid,
+                        ts,
+                        sinkid,
+                        domain,
+                        settingsid,
+                        campid,
+                        dict(zip(("complaint", "unsub", "open", "click"), counts)),
+                    )
+                    for (
+                        ts,
+                        sinkid,
+                        domain,
+                        ip,
+                        settingsid,
+                        campid,
+                        cid,
+                        campcid,
+                    ), counts in self.hourstat.items()
+                ),
+            )
+
+        txnstats = sorted(
+            (
+                (shortuuid.uuid(), cid, ts, tag, domain, *counts)
+                for (ts, cid, tag, domain), counts in self.txnstat.items()
+            ),
+            key=lambda r: r[1:5],
+        )
+        if txnstats:
+            db.execute_values(
+                """insert into txnstats (id, cid, ts, tag, domain,
+                      complaint, unsub, open, click, open_all, click_all, send, soft, hard)
+                      values %s
+                      on conflict (ts, cid, tag, domain) do update set
+                      complaint = txnstats.complaint + excluded.complaint,
+                      unsub =     txnstats.unsub     + excluded.unsub,
+                      open =      txnstats.open      + excluded.open,
+                      click =     txnstats.click     + excluded.click,
+                      open_all =  txnstats.open_all  + excluded.open_all,
+                      click_all = txnstats.click_all + excluded.click_all""",
+                txnstats,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, 0, 0)",
+            )
+
+
 def statmsgs_insert(
     db: DB,
     cid: str,
@@ -218,7 +647,12 @@ def txnmsgs_insert(
 
 
 def get_geoloc(
-    db: DB, ct: str, email: str, clientip: str, useragent: str
+    db: DB,
+    ct: str,
+    email: str,
+    clientip: str,
+    useragent: str,
+    agent: Tuple[int, int, int] | None = None,
 ) -> Tuple[
     int | None, int | None, int | None, str | None, str | None, str | None, str | None
 ]:
@@ -242,17 +676,14 @@ def get_geoloc(
                         "can't parse client IP: %s %s error %s", email, clientip, e
                     )
             if ipnum != 0:
-                row = db.row(
-                    "select country_code, country, region, zip from iplocations where iprange @> (%s)::bigint limit 1",
-                    ipnum,
-                )
+                row = lookup_ip(db, ipnum)
                 if row is None:
                     log.info("can't find IP: %s %s", email, clientip)
                 else:
                     countrycode, country, region, zp = row
-            os = get_os(agentl)
-            browser = get_browser(agentl)
-            device = get_device(agentl)
+            if agent is None:
+                agent = classify_agent(useragent)
+            os, browser, device = agent
 
     return os, browser, device, country, countrycode, region, zp
 
@@ -275,7 +706,12 @@ def write_txn(
     linktrack: bool,
     clientip: str,
     useragent: str,
+    counters: EventCounters | None = None,
+    agent: Tuple[int, int, int] | None = None,
 ) -> None:
+    if counters is None:
+        counters = direct_counters
+
     campcid = c[3:]
 
     code: str | None = msg
@@ -343,7 +779,7 @@ def write_txn(
                 complaints += 1
 
             if settingsid and ip:
-                hourstats_insert(
+                counters.hourstats(
                     db,
                     cid,
                     campcid,
@@ -359,7 +795,7 @@ def write_txn(
                     clicks,
                 )
 
-            txnstats_insert(
+            counters.txnstats(
                 db,
                 campcid,
                 insertts,
@@ -381,7 +817,7 @@ def write_txn(
         }
         if ct in ("open", "click"):
             os, browser, device, country, countrycode, region, zp = get_geoloc(
-                db, ct, email, clientip, useragent
+                db, ct, email, clientip, useragent, agent
             )
             webhookev["agent"] = useragent
             webhookev["ip"] = clientip
@@ -407,7 +843,7 @@ def write_txn(
             opens += 1
         elif ct == "click":
             clicks += 1
-        txnstats_insert(
+        counters.txnstats(
             db, campcid, insertts, tag, domain, 0, 0, 0, 0, opens, clicks
         )  # _all only
 
@@ -429,7 +865,11 @@ def write_list(
     linktrack: bool,
     clientip: str,
     useragent: str,
+    counters: EventCounters | None = None,
+    agent: Tuple[int, int, int] | None = None,
 ) -> None:
+    if counters is None:
+        counters = direct_counters
 
     campcid = camp["cid"]
 
@@ -458,102 +898,23 @@ def write_list(
             updatedts = dateutil.parser.parse(camp["modified"], ignoretz=True)
 
     os, browser, device, country, countrycode, region, zp = get_geoloc(
-        db, ct, email, clientip, useragent
+        db, ct, email, clientip, useragent, agent
     )
     if ct in ("open", "unsub", "click") and device is not None:
-        if is_camp:
-            db.execute(
-                """insert into campaign_devices (campaign_id, device, count) values (%s, %s, 1)
-                          on conflict (campaign_id, device) do update set
-                          count = campaign_devices.count + 1""",
-                c,
-                device,
-            )
-            db.execute(
-                """insert into campaign_browsers (campaign_id, os, browser, count) values (%s, %s, %s, 1)
-                          on conflict (campaign_id, os, browser) do update set
-                          count = campaign_browsers.count + 1""",
-                c,
-                os,
-                browser,
-            )
-            if country:
-                db.execute(
-                    """insert into campaign_locations (campaign_id, country_code, country, region, count) values (%s, %s, %s, %s, 1)
-                              on conflict (campaign_id, country_code, region) do update set
-                              count = campaign_locations.count + 1""",
-                    c,
-                    countrycode,
-                    country,
-                    region,
-                )
-        else:
-            db.execute(
-                """insert into message_devices (message_id, device, count) values (%s, %s, 1)
-                          on conflict (message_id, device) do update set
-                          count = message_devices.count + 1""",
-                c,
-                device,
-            )
-            db.execute(
-                """insert into message_browsers (message_id, os, browser, count) values (%s, %s, %s, 1)
-                          on conflict (message_id, os, browser) do update set
-                          count = message_browsers.count + 1""",
-                c,
-                os,
-                browser,
-            )
-            if country:
-                db.execute(
-                    """insert into message_locations (message_id, country_code, country, region, count) values (%s, %s, %s, %s, 1)
-                              on conflict (message_id, country_code, region) do update set
-                              count = message_locations.count + 1""",
-                    c,
-                    countrycode,
-                    country,
-                    region,
-                )
+        counters.device(db, is_camp, c, device)
+        counters.browser(db, is_camp, c, os, browser)
+        if country:
+            counters.location(db, is_camp, c, countrycode, country, region)
 
     if t in ("click", "unsub"):
         if linkindex >= 0 and (updatedts is None or updatedts < insertts):
-            if is_camp:
-                db.execute(
-                    """update campaigns set data = jsonb_set(data, %s, ((data->'linkclicks'->>%s)::integer + 1)::text::jsonb)
-                              where id = %s and jsonb_array_length(data->'linkclicks') > %s""",
-                    ["linkclicks", str(linkindex)],
-                    linkindex,
-                    c,
-                    linkindex,
-                )
-            else:
-                db.execute(
-                    """update messages set data = jsonb_set(data, %s, ((data->'linkclicks'->>%s)::integer + 1)::text::jsonb)
-                              where id = %s and jsonb_array_length(data->'linkclicks') > %s""",
-                    ["linkclicks", str(linkindex)],
-                    linkindex,
-                    c,
-                    linkindex,
-                )
+            counters.linkclick(db, is_camp, c, linkindex)
 
         if not linktrack:
             return
 
     if ct in ("click", "open"):
-        prop = "%s_all" % campprops[ct]
-        if is_camp:
-            db.execute(
-                "update campaigns set data = data || jsonb_build_object(%s, coalesce((data->>%s)::int, 0) + 1) where id = %s",
-                prop,
-                prop,
-                c,
-            )
-        else:
-            db.execute(
-                "update messages set data = data || jsonb_build_object(%s, coalesce((data->>%s)::int, 0) + 1) where id = %s",
-                prop,
-                prop,
-                c,
-            )
+        counters.prop(db, is_camp, c, "%s_all" % campprops[ct])
 
     unique = False
     if (
@@ -625,21 +986,7 @@ def write_list(
             if len(taglist):
                 contacts.update_tags(db, campcid, [email], taglist, webhook_msgs)
 
-        prop = campprops[ct]
-        if is_camp:
-            db.execute(
-                "update campaigns set data = data || jsonb_build_object(%s, coalesce((data->>%s)::int, 0) + 1) where id = %s",
-                prop,
-                prop,
-                c,
-            )
-        else:
-            db.execute(
-                "update messages set data = data || jsonb_build_object(%s, coalesce((data->>%s)::int, 0) + 1) where id = %s",
-                prop,
-                prop,
-                c,
-            )
+        counters.prop(db, is_camp, c, campprops[ct])
 
         if ct in ("open", "complaint", "unsub", "click") and settingsid and ip:
             opens, clicks, complaints, unsubs = 0, 0, 0, 0
@@ -652,7 +999,7 @@ def write_list(
             else:
                 complaints += 1
 
-            hourstats_insert(
+            counters.hourstats(
                 db,
                 cid,
                 camp["cid"],
@@ -747,6 +1094,12 @@ class Events(object):
             groups = {}
             camps: Dict[str, Tuple[JsonObj | None, bool]] = {}
             links = {}
+            agents = classify_agents(
+                ev.get("a", "")
+                for evlist in (doc["events"], doc["statevents"])
+                if evlist is not None
+                for ev in evlist
+            )
 
             for evlist in (doc["events"], doc["statevents"]):
                 if evlist is None:
@@ -873,6 +1226,7 @@ class Events(object):
                                         track,
                                         clientip,
                                         useragent,
+                                        agent=agents[useragent],
                                     )
                             else:
                                 assert camp is not None
@@ -893,6 +1247,7 @@ class Events(object):
                                     track,
                                     clientip,
                                     useragent,
+                                    agent=agents[useragent],
                                 )
                         except:
                             log.exception("%s", ev)
@@ -1032,30 +1387,17 @@ class Events(object):
                                     and campid != "transactional"
                                     and camps.get(campid, None) is not None
                                 ):
-                                    if camps[campid][1]:
-                                        db.execute(
-                                            """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                                            'send', (data->>'send')::int + %s,
-                                                                                                            'hard', (data->>'hard')::int + %s,
-                                                                                                            'soft', (data->>'soft')::int + %s) where id = %s""",
-                                            send + soft + hard,
-                                            send,
-                                            hard,
-                                            soft,
-                                            campid,
-                                        )
-                                    else:
-                                        db.execute(
-                                            """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                                            'send', (data->>'send')::int + %s,
-                                                                                                            'hard', (data->>'hard')::int + %s,
-                                                                                                            'soft', (data->>'soft')::int + %s) where id = %s""",
-                                            send + soft + hard,
-                                            send,
-                                            hard,
-                                            soft,
-                                            campid,
-                                        )
+                                    incr_counters(
+                                        db,
+                                        camps[campid][1],
+                                        campid,
+                                        {
+                                            "delivered": send + soft + hard,
+                                            "send": send,
+                                            "hard": hard,
+                                            "soft": soft,
+                                        },
+                                    )
 
                                 for msgt, cnt in msgs.items():
                                     msg, msgtype = msgt
@@ -1466,6 +1808,78 @@ class SendLogs(object):
 UNSUB = """<html><head><title>Unsubscribe Successful</title><link href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" rel="stylesheet" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous"></head><body><div class="container"><div class="row" style="margin-top:25px"><div class="col-xs-4 col-xs-offset-4 text-center"><div class="panel panel-default"><div class="panel-body">You have been unsubscribed from this mailing list. Sorry to see you go!</div></div></div></div></div></body></html>"""
 
 
+# Campaign rows and sink owners looked up for every open and click.  Campaigns
+# are only kept for a minute so archiving or changing tags applies quickly.
+track_campaigns = LRUCache(4096, ttl=60)
+track_sink_cids = LRUCache(1024, ttl=60 * 60)
+
+sink_tables = {
+    "mailgun": "mailgun",
+    "ses": "ses",
+    "sparkpost": "sparkpost",
+    "easylink": "easylink",
+    "smtprelay": "smtprelays",
+}
+
+
+def get_track_campaign(db: DB, c: str) -> Tuple[JsonObj | None, bool]:
+    cached = track_campaigns.get(c)
+    if cached is not None:
+        return cast(Tuple[JsonObj | None, bool], cached)
+    is_camp = True
+    camp = json_obj(
+        db.row(
+            "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
+            c,
+        )
+    )
+    if camp is None:
+        camp = json_obj(
+            db.row(
+                "select id, cid, data - 'parts' - 'rawText' from messages where id = %s",
+                c,
+            )
+        )
+        if camp is not None:
+            is_camp = False
+    track_campaigns.put(c, (camp, is_camp))
+    return camp, is_camp
+
+
+def get_sink_cid(db: DB, sinkid: str, settingsid: str) -> str | None:
+    cid: str | None = track_sink_cids.get((sinkid, settingsid))
+    if cid is None:
+        table = sink_tables.get(sinkid)
+        if table is None:
+            return None
+        cid = db.single(f"select cid from {table} where id = %s", settingsid)
+        if cid is not None:
+            track_sink_cids.put((sinkid, settingsid), cid)
+    return cid
+
+
+def lookup_tracking(db: DB, tr: str) -> TrackingInfo | None:
+    info = get_tracking(tr)
+    if info is not None:
+        return info
+    row = db.row("select settingsid, ip, ts from mgtracking where id = %s", tr)
+    if row is not None:
+        return "mailgun", row[0], row[1], row[2], None
+    row = db.row("select settingsid, ts from sesmessages where trackingid = %s", tr)
+    if row is not None:
+        return "ses", row[0], "pool", row[1], None
+    row = db.row("select settingsid, ip, ts from sptracking where id = %s", tr)
+    if row is not None:
+        return "sparkpost", row[0], row[1], row[2], None
+    row = db.row("select settingsid, ts from eltracking where id = %s", tr)
+    if row is not None:
+        return "easylink", row[0], "pool", row[1], None
+    row = db.row("select settingsid, ts from smtptracking where id = %s", tr)
+    if row is not None:
+        return "smtprelay", row[0], "pool", row[1], None
+    return None
+
+
 def process_track_event(
     db: DB,
     t: str,
@@ -1481,28 +1895,17 @@ def process_track_event(
     track: bool,
     clientip: str,
     useragent: str,
+    sinkcid: str | None = None,
+    counters: EventCounters | None = None,
+    agent: Tuple[int, int, int] | None = None,
 ) -> None:
     camp = None
     is_camp = True
     if c != "test" and not c.startswith("tx-"):
-        camp = json_obj(
-            db.row(
-                "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
-                c,
-            )
-        )
+        camp, is_camp = get_track_campaign(db, c)
         if camp is None:
-            camp = json_obj(
-                db.row(
-                    "select id, cid, data - 'parts' - 'rawText' from messages where id = %s",
-                    c,
-                )
-            )
-            if camp is None:
-                log.info("event error: %s (no campaign)", c)
-            else:
-                is_camp = False
-        if camp is not None and camp.get("archived", False):
+            log.info("event error: %s (no campaign)", c)
+        elif camp.get("archived", False):
             camp = None
 
     if camp is not None or c.startswith("tx-"):
@@ -1511,16 +1914,7 @@ def process_track_event(
             log.info("event error: %s (invalid email)", u)
         else:
             domain = email.split("@")[1]
-            if sinkid == "mailgun":
-                cid = db.single("select cid from mailgun where id = %s", settingsid)
-            elif sinkid == "ses":
-                cid = db.single("select cid from ses where id = %s", settingsid)
-            elif sinkid == "sparkpost":
-                cid = db.single("select cid from sparkpost where id = %s", settingsid)
-            elif sinkid == "easylink":
-                cid = db.single("select cid from easylink where id = %s", settingsid)
-            elif sinkid == "smtprelay":
-                cid = db.single("select cid from smtprelays where id = %s", settingsid)
+            cid = sinkcid or get_sink_cid(db, sinkid, settingsid)
             if cid is None:
                 log.info("event error: %s (api account not found)", settingsid)
             else:
@@ -1544,6 +1938,8 @@ def process_track_event(
                             track,
                             clientip,
                             useragent,
+                            counters,
+                            agent,
                         )
                 else:
                     assert camp is not None
@@ -1564,17 +1960,226 @@ def process_track_event(
                         track,
                         clientip,
                         useragent,
+                        counters,
+                        agent,
                     )
 
 
+# Track hands resolved events to the process_track_events worker through a
+# redis stream so that the pixel or redirect is returned without waiting on
+# the database.  The stream is capped as a backstop in case the worker is
+# down for a long time.
+TRACK_STREAM = "track-events"
+TRACK_GROUP = "track-events"
+TRACK_STREAM_MAXLEN = 1000000
+TRACK_BATCH_SIZE = int(os.environ.get("track_batch_size", "500"))
+# entries left pending by a worker that died are reclaimed after this long
+TRACK_CLAIM_IDLE = 5 * 60 * 1000
+# events which fail are moved here, with their original entry id, to be
+# inspected and replayed by hand
+TRACK_DEAD_STREAM = "track-events-dead"
+
+
+def queue_track_event(
+    t: str,
+    c: str,
+    u: str,
+    sinkid: str,
+    settingsid: str,
+    txntag: str | None,
+    txnmsgid: str | None,
+    ip: str,
+    ts: datetime | None,
+    index: int,
+    track: bool,
+    clientip: str,
+    useragent: str,
+    sinkcid: str | None,
+) -> None:
+    redis_connect().xadd(
+        TRACK_STREAM,
+        {
+            "e": json.dumps(
+                [
+                    t,
+                    c,
+                    u,
+                    sinkid,
+                    settingsid,
+                    txntag,
+                    txnmsgid,
+                    ip,
+                    ts.isoformat() if ts is not None else None,
+                    index,
+                    track,
+                    clientip,
+                    useragent,
+                    sinkcid,
+                ]
+            )
+        },
+        maxlen=TRACK_STREAM_MAXLEN,
+        approximate=True,
+    )
+
+
+def process_track_batch(
+    db: DB, entries: List[Tuple[bytes, Dict[bytes, bytes]]]
+) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+    """Applies a batch of stream entries, and their counters, in one
+    transaction and returns the entries which failed.  The entry ids are
+    recorded in the same transaction, so entries redelivered after the batch
+    committed, because the worker died before acknowledging them, are
+    skipped rather than applied twice."""
+    counters = BatchedEventCounters()
+    failed = []
+    ids = [entry[0].decode("utf-8") for entry in entries]
+    # entries are decoded up front so that each distinct agent in the batch is
+    # classified once; an entry which can't be decoded fails below
+    events: Dict[bytes, List[Any]] = {}
+    for entryid, fields in entries:
+        try:
+            events[entryid] = json.loads(fields[b"e"])
+        except ValueError:
+            pass
+    agents = classify_agents(ev[12] for ev in events.values() if len(ev) > 12)
+    with db.transaction():
+        done = set(
+            r
+            for r, in db.execute("select id from track_entries where id = any(%s)", ids)
+        )
+        for entryid, fields in entries:
+            if entryid.decode("utf-8") in done:
+                continue
+            # an event which fails is rolled back on its own, and its counters
+            # are only added to the batch once it has succeeded
+            eventcounters = BatchedEventCounters()
+            db.execute("savepoint track_event")
+            try:
+                (
+                    t,
+                    c,
+                    u,
+                    sinkid,
+                    settingsid,
+                    txntag,
+                    txnmsgid,
+                    ip,
+                    ts,
+                    index,
+                    track,
+                    clientip,
+                    useragent,
+                    sinkcid,
+                ) = events[entryid]
+                process_track_event(
+                    db,
+                    t,
+                    c,
+                    u,
+                    sinkid,
+                    settingsid,
+                    txntag,
+                    txnmsgid,
+                    ip,
+                    datetime.fromisoformat(ts) if ts is not None else None,
+                    index,
+                    track,
+                    clientip,
+                    useragent,
+                    sinkcid,
+                    eventcounters,
+                    agents[useragent],
+                )
+            except Exception:
+                log.exception("error processing track event %s", entryid)
+                db.execute("rollback to savepoint track_event")
+                failed.append((entryid, fields))
+            else:
+                db.execute("release savepoint track_event")
+                counters.merge(eventcounters)
+        db.execute_values(
+            "insert into track_entries (id) values %s on conflict (id) do nothing",
+            [(i,) for i in ids],
+        )
+        counters.write(db)
+    return failed
+
+
+def process_track_events(checkcancel: Callable[[], bool]) -> None:
+    try:
+        with open_db() as db:
+            rdb = redis_connect()
+
+            try:
+                rdb.xgroup_create(TRACK_STREAM, TRACK_GROUP, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+            consumer = "%s-%s" % (socket.gethostname(), os.getpid())
+
+            cnt = 0
+
+            # pick up entries a previous worker read but never acknowledged
+            entries = rdb.xautoclaim(
+                TRACK_STREAM,
+                TRACK_GROUP,
+                consumer,
+                TRACK_CLAIM_IDLE,
+                count=TRACK_BATCH_SIZE,
+            )[1]
+
+            while True:
+                if not entries:
+                    r = rdb.xreadgroup(
+                        TRACK_GROUP,
+                        consumer,
+                        {TRACK_STREAM: ">"},
+                        count=TRACK_BATCH_SIZE,
+                    )
+                    if not r:
+                        break
+                    entries = r[0][1]
+
+                failed = process_track_batch(db, entries)
+
+                ids = [entry[0] for entry in entries]
+                pipe = rdb.pipeline()
+                for entryid, fields in failed:
+                    pipe.xadd(
+                        TRACK_DEAD_STREAM,
+                        {**fields, b"id": entryid},
+                        maxlen=TRACK_STREAM_MAXLEN,
+                        approximate=True,
+                    )
+                pipe.xack(TRACK_STREAM, TRACK_GROUP, *ids).xdel(TRACK_STREAM, *ids)
+                pipe.execute()
+
+                db.execute(
+                    "delete from track_entries where id = any(%s)",
+                    [entryid.decode("utf-8") for entryid in ids],
+                )
+
+                cnt += len(entries)
+                entries = []
+
+                if checkcancel():
+                    log.info("Process terminated")
+                    return
+
+            if cnt > 0:
+                log.info("Processed %s track events", cnt)
+    except:
+        log.exception("error")
+
+
 class Track(object):
 
     def on_post(self, req: falcon.Request, resp: falcon.Response) -> None:
         return self.on_get(req, resp)
 
     def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
-        sinkid = "mailgun"
-
         t = req.get_param("t")
         c = req.get_param("c")
         u = req.get_param("u")
@@ -1634,95 +2239,74 @@ class Track(object):
                 else:
                     c = "tx-%s" % campcid
 
-            settingsid, ip, ts = None, None, None
+            tracking = None
             if c != "test":
                 if not tr:
                     log.info("event error: no tracking id")
                 else:
-                    row = db.row(
-                        "select settingsid, ip, ts from mgtracking where id = %s", tr
-                    )
-                    if row is None:
-                        row = db.row(
-                            "select settingsid, ts from sesmessages where trackingid = %s",
+                    tracking = lookup_tracking(db, tr)
+                    if tracking is None:
+                        log.info(
+                            "event pending: %s (no values for tracking id, saving to redis)",
                             tr,
                         )
-                        if row is None:
-                            row = db.row(
-                                "select settingsid, ip, ts from sptracking where id = %s",
-                                tr,
-                            )
-                            if row is None:
-                                row = db.row(
-                                    "select settingsid, ts from eltracking where id = %s",
-                                    tr,
-                                )
-                                if row is None:
-                                    row = db.row(
-                                        "select settingsid, ts from smtptracking where id = %s",
-                                        tr,
-                                    )
-                                    if row is None:
-                                        log.info(
-                                            "event pending: %s (no values for tracking id, saving to redis)",
-                                            tr,
-                                        )
-                                        trackingkey = "tracking-%s" % (tr,)
-                                        rdb = redis_connect()
-                                        rdb.pipeline().lpush(
-                                            trackingkey,
-                                            json.dumps(
-                                                {
-                                                    "t": t,
-                                                    "c": c,
-                                                    "u": u,
-                                                    "index": index,
-                                                    "track": track,
-                                                    "txntag": txntag,
-                                                    "txnmsgid": txnmsgid,
-                                                    "useragent": useragent,
-                                                    "clientip": clientip,
-                                                    "added": datetime.utcnow().isoformat()
-                                                    + "Z",
-                                                }
-                                            ),
-                                        ).expire(trackingkey, 60 * 60 * 72).execute()
-                                    else:
-                                        settingsid, ts = row
-                                        ip = "pool"
-                                        sinkid = "smtprelay"
-                                else:
-                                    settingsid, ts = row
-                                    ip = "pool"
-                                    sinkid = "easylink"
-                            else:
-                                settingsid, ip, ts = row
-                                sinkid = "sparkpost"
-                        else:
-                            settingsid, ts = row
-                            ip = "pool"
-                            sinkid = "ses"
-                    else:
-                        settingsid, ip, ts = row
-
-            if settingsid is not None:
-                assert ip is not None
-                process_track_event(
-                    db,
-                    t,
-                    c,
-                    u,
-                    sinkid,
-                    settingsid,
-                    txntag,
-                    txnmsgid,
-                    ip,
-                    ts,
-                    index,
-                    track,
-                    clientip,
-                    useragent,
-                )
+                        trackingkey = "tracking-%s" % (tr,)
+                        rdb = redis_connect()
+                        rdb.pipeline().lpush(
+                            trackingkey,
+                            json.dumps(
+                                {
+                                    "t": t,
+                                    "c": c,
+                                    "u": u,
+                                    "index": index,
+                                    "track": track,
+                                    "txntag": txntag,
+                                    "txnmsgid": txnmsgid,
+                                    "useragent": useragent,
+                                    "clientip": clientip,
+                                    "added": datetime.utcnow().isoformat() + "Z",
+                                }
+                            ),
+                        ).expire(trackingkey, 60 * 60 * 72).execute()
+
+            if tracking is not None:
+                sinkid, settingsid, ip, ts, sinkcid = tracking
+                if os.environ.get("SYNC_TASKS"):
+                    process_track_event(
+                        db,
+                        t,
+                        c,
+                        u,
+                        sinkid,
+                        settingsid,
+                        txntag,
+                        txnmsgid,
+                        ip,
+                        ts,
+                        index,
+                        track,
+                        clientip,
+                        useragent,
+                        sinkcid,
+                    )
+                else:
+                    queue_track_event(
+                        t,
+                        c,
+                        u,
+                        sinkid,
+                        settingsid,
+                        txntag,
+                        txnmsgid,
+                        ip,
+                        ts,
+                        index,
+                        track,
+                        clientip,
+                        useragent,
+                        sinkcid,
+                    )
 
             if t == "open":
                 resp.content_type = falcon.MEDIA_GIF
@@ -2039,30 +2623,17 @@ def process_ses_webhook(db: DB, jsonobj: JsonObj) -> None:
             )
 
         if (send > 0 or soft > 0 or hard > 0) and not campid.startswith("tx-"):
-            if is_camp:
-                db.execute(
-                    """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                     'send', (data->>'send')::int + %s,
-                                                                                     'hard', (data->>'hard')::int + %s,
-                                                                                     'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-            else:
-                db.execute(
-                    """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                    'send', (data->>'send')::int + %s,
-                                                                                    'hard', (data->>'hard')::int + %s,
-                                                                                    'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
+            incr_counters(
+                db,
+                is_camp,
+                campid,
+                {
+                    "delivered": send + soft + hard,
+                    "send": send,
+                    "hard": hard,
+                    "soft": soft,
+                },
+            )
 
         if msgtype != "send" and msg:
             statmsgs_insert(
@@ -2180,6 +2751,7 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
             settingsid,
             ts,
         )
+        set_tracking(trackingid, "sparkpost", settingsid, ip, ts)
         contacts.add_send(db, campid, [email], txntag=txntag)
 
         trackingkey = "tracking-%s" % trackingid
@@ -2293,30 +2865,17 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
             )
 
         if (send > 0 or soft > 0 or hard > 0) and not campid.startswith("tx-"):
-            if is_camp:
-                db.execute(
-                    """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                     'send', (data->>'send')::int + %s,
-                                                                                     'hard', (data->>'hard')::int + %s,
-                                                                                     'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-            else:
-                db.execute(
-                    """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                    'send', (data->>'send')::int + %s,
-                                                                                    'hard', (data->>'hard')::int + %s,
-                                                                                    'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
+            incr_counters(
+                db,
+                is_camp,
+                campid,
+                {
+                    "delivered": send + soft + hard,
+                    "send": send,
+                    "hard": hard,
+                    "soft": soft,
+                },
+            )
 
         if msgtype != "send":
             statmsgs_insert(
@@ -2427,6 +2986,7 @@ def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
             settingsid,
             ts,
         )
+        set_tracking(trackingid, "mailgun", settingsid, ip, ts)
         contacts.add_send(db, campid, [email], txntag=txntag)
 
         trackingkey = "tracking-%s" % trackingid
@@ -2539,30 +3099,17 @@ def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
             )
 
         if (send > 0 or soft > 0 or hard > 0) and not campid.startswith("tx-"):
-            if is_camp:
-                db.execute(
-                    """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                     'send', (data->>'send')::int + %s,
-                                                                                     'hard', (data->>'hard')::int + %s,
-                                                                                     'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-            else:
-                db.execute(
-                    """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                    'send', (data->>'send')::int + %s,
-                                                                                    'hard', (data->>'hard')::int + %s,
-                                                                                    'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
+            incr_counters(
+                db,
+                is_camp,
+                campid,
+                {
+                    "delivered": send + soft + hard,
+                    "send": send,
+                    "hard": hard,
+                    "soft": soft,
+                },
+            )
 
         if msgtype != "send":
             statmsgs_insert(
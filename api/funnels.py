@@ -43,12 +43,13 @@ from .shared.utils import (
 )
 from .shared.segments import (
     get_segment_rows,
-    segment_eval_parts,
+    segment_compile,
     segment_get_segments,
     segment_get_campaignids,
     get_segment_sentrows,
     supp_rows,
-    Cache,
+    EvalState,
+    ActivityLogs,
 )
 from .shared.send import (
     ses_send,
@@ -61,7 +62,7 @@ from .shared.send import (
     sink_get_settings,
     sink_get_ips,
     fix_headers,
-    check_send_limit,
+    check_send_limits,
     check_test_limit,
     client_domain,
     load_domain_throttles,
@@ -71,6 +72,7 @@ from .shared import contacts
 from .shared import segments
 from .shared.log import get_logger
 from .shared.webhooks import send_webhooks
+from .shared.counters import reset_linkclicks
 
 log = get_logger()
 
@@ -394,7 +396,7 @@ class Message(CRUDSingle):
 
         CRUDSingle.on_patch(self, req, resp, id)
 
-        db = req.context["db"]
+        db: DB = req.context["db"]
 
         msg = db.messages.get(id)
         if msg is None:
@@ -422,6 +424,7 @@ class Message(CRUDSingle):
                     "modified": datetime.utcnow().isoformat() + "Z",
                 },
             )
+            reset_linkclicks(db, False, id)
 
         if (
             not msg.get("example")
@@ -639,8 +642,9 @@ def check_funnels() -> None:
 
                         hashlimit = segments.get_hashlimit(db, cid)
 
-                        for hashval, messageid, route, domain, cnt in list(
-                            db.execute(
+                        groups = [
+                            row
+                            for row in db.execute(
                                 """select mod(rawhash, %s) h, messageid,
                                 case coalesce(a->>'msgroute', '')
                                 when '' then f.data->>'route'
@@ -656,33 +660,40 @@ def check_funnels() -> None:
                                 ts,
                                 cid,
                             )
+                            if row[4] > 0
+                        ]
+                        grants = check_send_limits(
+                            company,
+                            domainthrottles,
+                            [
+                                (route, domain, cnt)
+                                for _, _, route, domain, cnt in groups
+                            ],
+                        )
+                        for (hashval, messageid, route, domain, requesting), cnt in zip(
+                            groups, grants
                         ):
                             if cnt > 0:
-                                requesting = cnt
-                                cnt = check_send_limit(
-                                    company, route, domain, domainthrottles, cnt
+                                log.debug(
+                                    "%s clear to send %s for message %s, route %s, domain %s, (requested %s)",
+                                    cid,
+                                    cnt,
+                                    messageid,
+                                    route,
+                                    domain,
+                                    requesting,
+                                )
+                                run_task(
+                                    send_message,
+                                    cid,
+                                    hashval,
+                                    messageid,
+                                    domain,
+                                    hashlimit,
+                                    alllists,
+                                    ts.isoformat() + "Z",
+                                    cnt,
                                 )
-                                if cnt > 0:
-                                    log.debug(
-                                        "%s clear to send %s for message %s, route %s, domain %s, (requested %s)",
-                                        cid,
-                                        cnt,
-                                        messageid,
-                                        route,
-                                        domain,
-                                        requesting,
-                                    )
-                                    run_task(
-                                        send_message,
-                                        cid,
-                                        hashval,
-                                        messageid,
-                                        domain,
-                                        hashlimit,
-                                        alllists,
-                                        ts.isoformat() + "Z",
-                                        cnt,
-                                    )
                     except:
                         log.exception("error")
         except:
@@ -865,27 +876,16 @@ def send_message(
                                 fixedrow[prop] = r.get(prop, ("",))[0]
                         return fixedrow
 
-                    cache = Cache()
+                    if len(msg["suppsegs"]):
+                        supppred = segment_compile(fakesegment, segments, hashlimit)
+                        state = EvalState(sentrows, len(rows), ActivityLogs(rows))
 
-                    segcounts: Dict[str, int] = {}
-                    numrows = len(rows)
                     for vals in rows:
                         email = vals["Email"][0]
 
                         # remove suppressed segments
                         if len(msg["suppsegs"]):
-                            if not segment_eval_parts(
-                                fakesegment["parts"],
-                                fakesegment["operator"],
-                                vals,
-                                segcounts,
-                                numrows,
-                                segments,
-                                sentrows,
-                                fakesegment,
-                                hashlimit,
-                                cache,
-                            ):
+                            if not supppred(vals, state):
                                 continue
 
                         # remove any suppressed users
@@ -7,7 +7,7 @@ import json
 import zipfile
 import requests
 from io import BytesIO, StringIO
-from datetime import datetime
+from datetime import datetime, timedelta
 from jsonschema import validate
 from typing import List, Set, Dict, Tuple
 from .shared import config as config_module_side_effects  # noqa: F401
@@ -39,13 +39,16 @@ from .shared.segments import (
     segment_lists,
     segment_get_params,
     get_segment_rows,
-    segment_eval_parts,
+    segment_compile,
+    segment_compile_many,
     segment_get_segments,
     segment_get_campaignids,
     get_segment_sentrows,
     segment_get_segmentids,
     get_hashlimit,
-    Cache,
+    segment_sql_filter,
+    EvalState,
+    ActivityLogs,
 )
 from .shared.crud import (
     CRUDCollection,
@@ -56,6 +59,8 @@ from .shared.crud import (
 )
 from .shared.tasks import tasks, HIGH_PRIORITY, LOW_PRIORITY
 from .shared.s3 import s3_write_stream, s3_list, s3_write, s3_read
+from .shared.snapshots import bump_contacts_version
+from .shared.findruns import FindRun, find_page, load_find, save_find, write_find_run
 from .shared import contacts
 from .shared.log import get_logger
 from .shared.webhooks import send_webhooks
@@ -431,36 +436,37 @@ def export_list(
             writers = {}
             cnt = 0
 
-            for email, props in db.execute(
-                f"""
-                select c.email, c.props
-                from contacts."contacts_{cid}" c
-                join contacts."contact_lists_{cid}" l on l.contact_id = c.contact_id
-                where l.list_id = %s
-                                """,
-                listid,
-            ):
+            with db.transaction():
+                for email, props in db.stream(
+                    f"""
+                    select c.email, c.props
+                    from contacts."contacts_{cid}" c
+                    join contacts."contact_lists_{cid}" l on l.contact_id = c.contact_id
+                    where l.list_id = %s
+                                    """,
+                    listid,
+                ):
 
-                row = {"Email": email}
-                for k, v in props.items():
-                    row[k] = v[0]
-
-                key = "active"
-                if is_true(row.get("Bounced", "")):
-                    key = "bounced"
-                elif is_true(row.get("Unsubscribed", "")):
-                    key = "unsubscribed"
-                elif is_true(row.get("Complained", "")):
-                    key = "complained"
-
-                if key not in fps:
-                    fps[key] = open(files[key], "w", encoding="utf-8")
-                    writers[key] = csv.DictWriter(
-                        fps[key], allprops, extrasaction="ignore"
-                    )
-                    writers[key].writeheader()
-                writers[key].writerow(row)
-                cnt += 1
+                    row = {"Email": email}
+                    for k, v in props.items():
+                        row[k] = v[0]
+
+                    key = "active"
+                    if is_true(row.get("Bounced", "")):
+                        key = "bounced"
+                    elif is_true(row.get("Unsubscribed", "")):
+                        key = "unsubscribed"
+                    elif is_true(row.get("Complained", "")):
+                        key = "complained"
+
+                    if key not in fps:
+                        fps[key] = open(files[key], "w", encoding="utf-8")
+                        writers[key] = csv.DictWriter(
+                            fps[key], allprops, extrasaction="ignore"
+                        )
+                        writers[key].writeheader()
+                    writers[key].writerow(row)
+                    cnt += 1
 
             zipname = "/tmp/%s.zip" % exportid
             outzip = zipfile.ZipFile(zipname, "w", zipfile.ZIP_DEFLATED)
@@ -1337,7 +1343,7 @@ class ListFind(object):
     def on_post(self, req: falcon.Request, resp: falcon.Response, id: str) -> None:
         check_noadmin(req)
 
-        db = req.context["db"]
+        db: DB = req.context["db"]
 
         doc = req.context.get("doc")
         if not doc:
@@ -1352,6 +1358,25 @@ class ListFind(object):
 
         db.set_cid(None)
 
+        # pages of a search that was already run are served from its runs
+        cursor = doc.get("cursor")
+        if cursor:
+            find = load_find(cursor)
+            if (
+                find is not None
+                and find.get("complete")
+                and find["cid"] == lst["cid"]
+                and find["listid"] == id
+                and find["sort"] == doc["sort"]
+            ):
+                try:
+                    req.context["result"] = list_find_page(
+                        db, cursor, find, doc.get("before"), doc.get("after")
+                    )
+                    return
+                except FileNotFoundError:
+                    pass
+
         fakesegment = find_segment(id, doc)
 
         campaignids = segment_get_campaignids(fakesegment, [])
@@ -1360,7 +1385,19 @@ class ListFind(object):
             db, lst["cid"], fakesegment, lists=[lst]
         )
 
+        find = {
+            "cid": lst["cid"],
+            "listid": id,
+            "sort": doc["sort"],
+            "before": doc.get("before"),
+            "after": doc.get("after"),
+            "listfactors": listfactors,
+            "hashlimit": hashlimit,
+        }
+
         if hashlimit == 1:
+            findid = shortuuid.uuid()
+
             found = do_list_find(
                 db,
                 lst["cid"],
@@ -1372,11 +1409,15 @@ class ListFind(object):
                 listfactors,
                 hashlimit,
                 campaignids,
+                findid,
             )
 
-            req.context["result"] = list_find_finish([found])
+            save_find(findid, find)
+            req.context["result"] = list_find_finish(db, findid, [found])
         else:
-            gatherid = gather_init(db, "list_find", hashlimit)
+            gatherid = gather_init(db, "list_find", hashlimit, lst["cid"])
+
+            save_find(gatherid, find)
 
             run_task(
                 list_find_start,
@@ -1434,6 +1475,28 @@ def list_find_start(
 PAGE_SIZE = 50
 
 
+def fix_find_row(r: JsonObj) -> JsonObj:
+    fixedrow = {}
+    for prop in r.keys():
+        if not prop.startswith("!"):
+            fixedrow[prop] = r.get(prop, ("",))[0]
+        elif prop == "!!tags":
+            tagval = ",".join(sorted(r.get("!!tags", ())))
+            if tagval:
+                fixedrow[prop] = tagval
+        elif prop == "!!lastactivity":
+            # Include last activity timestamp
+            val = r.get(prop, (0,))
+            if val and val[0]:
+                fixedrow[prop] = val[0]
+        elif prop == "!!added":
+            # Include added timestamp
+            val = r.get(prop, (0,))
+            if val and val[0]:
+                fixedrow[prop] = val[0]
+    return fixedrow
+
+
 def do_list_find(
     db: DB,
     cid: str,
@@ -1445,93 +1508,36 @@ def do_list_find(
     listfactors: List[str],
     hashlimit: int,
     campaignids: List[str],
+    findid: str,
 ) -> JsonObj:
+    """Evaluates the search over one bucket and writes its matches as a
+    sorted run; the page itself is cut from the runs by list_find_page."""
     segments: Dict[str, JsonObj | None] = {}
 
     sentrows = get_segment_sentrows(db, cid, campaignids, hashval, hashlimit)
 
-    rows = get_segment_rows(db, cid, hashval, listfactors, hashlimit)
-
-    def fix_row(r: JsonObj) -> JsonObj:
-        fixedrow = {}
-        for prop in r.keys():
-            if not prop.startswith("!"):
-                fixedrow[prop] = r.get(prop, ("",))[0]
-            elif prop == "!!tags":
-                tagval = ",".join(sorted(r.get("!!tags", ())))
-                if tagval:
-                    fixedrow[prop] = tagval
-            elif prop == "!!lastactivity":
-                # Include last activity timestamp
-                val = r.get(prop, (0,))
-                if val and val[0]:
-                    fixedrow[prop] = val[0]
-            elif prop == "!!added":
-                # Include added timestamp
-                val = r.get(prop, (0,))
-                if val and val[0]:
-                    fixedrow[prop] = val[0]
-        return fixedrow
-
-    cache = Cache()
-    tmp = []
-    segcounts: Dict[str, int] = {}
-    numrows = len(rows)
-    for row in rows:
-        if segment_eval_parts(
-            segment["parts"],
-            segment["operator"],
-            row,
-            segcounts,
-            numrows,
-            segments,
-            sentrows,
-            segment,
-            hashlimit,
-            cache,
-        ):
-            tmp.append(fix_row(row))
-
-    tmp.sort(key=lambda r: r.get(sort["id"], ""))
-    if sort.get("desc", False):
-        tmp.reverse()
-
-    count = len(tmp)
+    rows = get_segment_rows(
+        db,
+        cid,
+        hashval,
+        listfactors,
+        hashlimit,
+        where=segment_sql_filter(cid, [segment], segments, listfactors),
+        snapshot=True,
+    )
 
-    found = []
-    if before is not None:
-        for f in tmp:
-            if f.get(sort["id"], "") < before:
-                found.append(f)
-            else:
-                break
-        has_previous = len(found) > PAGE_SIZE
-        has_next = len(tmp) > len(found)
-    elif after is not None:
-        for f in tmp:
-            if f.get(sort["id"], "") > after:
-                found.append(f)
-        has_previous = len(tmp) > len(found)
-        has_next = len(found) > PAGE_SIZE
-    else:
-        found = tmp
-        has_previous = False
-        has_next = len(found) > PAGE_SIZE
+    pred = segment_compile(segment, segments, hashlimit)
+    state = EvalState(sentrows, len(rows), ActivityLogs(rows))
+    entries = []
+    for row in rows:
+        if pred(row, state):
+            fixedrow = fix_find_row(row)
+            entries.append((fixedrow.get(sort["id"], ""), fixedrow["Email"]))
+    entries.sort()
 
-    if before is not None:
-        rows = found[-PAGE_SIZE:]
-    else:
-        rows = found[:PAGE_SIZE]
+    write_find_run(findid, hashval, entries)
 
-    return {
-        "rows": rows,
-        "count": count,
-        "sort": sort,
-        "before": before,
-        "after": after,
-        "has_previous": has_previous,
-        "has_next": has_next,
-    }
+    return {"count": len(entries)}
 
 
 @tasks.task(priority=HIGH_PRIORITY)
@@ -1560,6 +1566,7 @@ def list_find(
                 listfactors,
                 hashlimit,
                 campaignids,
+                gatherid,
             )
 
             gather_complete(db, gatherid, ret, False)
@@ -1568,42 +1575,67 @@ def list_find(
             gather_complete(db, gatherid, {"error": str(e)}, False)
 
 
-def list_find_finish(data: List[JsonObj]) -> JsonObj:
-    allprops = set()
-    rows = []
-    count = 0
-    sort = None
-    has_previous = False
-    has_next = False
-    before = None
+def list_find_finish(db: DB, findid: str, data: List[JsonObj]) -> JsonObj:
     for d in data:
         if d.get("error", None):
             return {"error": d["error"]}
-        for row in d["rows"]:
-            rows.append(row)
-        count += d["count"]
-        sort = d["sort"]
-        if d.get("before"):
-            before = d["before"]
-        if d.get("has_previous", False):
-            has_previous = True
-        if d.get("has_next", False):
-            has_next = True
-
-    if sort is not None:
-        rows.sort(key=lambda r: r.get(sort["id"], ""))
-        if sort.get("desc", False):
-            rows.reverse()
-
-    if before is not None and not has_previous:
-        has_previous = len(rows) > PAGE_SIZE
-    elif not has_next:
-        has_next = len(rows) > PAGE_SIZE
+
+    find = load_find(findid)
+    if find is None:
+        return {"error": "Search expired, please try again"}
+
+    find["complete"] = True
+    save_find(findid, find)
+
+    return list_find_page(db, findid, find, find["before"], find["after"])
+
+
+def list_find_page(
+    db: DB, findid: str, find: JsonObj, before: str | None, after: str | None
+) -> JsonObj:
+    runs = []
+    try:
+        for i in range(find["hashlimit"]):
+            runs.append(FindRun(findid, i))
+        total = sum(len(run) for run in runs)
+        page, matched = find_page(
+            runs, before, after, find["sort"].get("desc", False), PAGE_SIZE
+        )
+    finally:
+        for run in runs:
+            run.close()
 
     if before is not None:
-        rows = rows[-PAGE_SIZE:]
+        has_previous = matched > PAGE_SIZE
+        has_next = total > matched
+    elif after is not None:
+        has_previous = total > matched
+        has_next = matched > PAGE_SIZE
     else:
-        rows = rows[:PAGE_SIZE]
+        has_previous = False
+        has_next = matched > PAGE_SIZE
+
+    emails: Dict[int, Set[str]] = {}
+    for _, email, hashval in page:
+        emails.setdefault(hashval, set()).add(email)
+
+    found = {}
+    for hashval, rowset in emails.items():
+        for row in get_segment_rows(
+            db,
+            find["cid"],
+            hashval,
+            find["listfactors"],
+            find["hashlimit"],
+            rowset=rowset,
+        ):
+            fixedrow = fix_find_row(row)
+            found[fixedrow["Email"]] = fixedrow
+
+    # contacts removed since the search ran drop out of the page
+    rows = [found[email] for _, email, _ in page if email in found]
+
+    allprops = set()
     for row in rows:
         for p in row.keys():
             if p != "Email":
@@ -1614,9 +1646,10 @@ def list_find_finish(data: List[JsonObj]) -> JsonObj:
         "result": {
             "allprops": sort_props(allprops),
             "rows": rows,
-            "count": count,
+            "count": total,
             "has_previous": has_previous,
             "has_next": has_next,
+            "cursor": findid,
         },
     }
 
@@ -1642,7 +1675,7 @@ class ListFindStatus(object):
     def on_get(self, req: falcon.Request, resp: falcon.Response, id: str) -> None:
         check_noadmin(req)
 
-        db = req.context["db"]
+        db: DB = req.context["db"]
 
         db.set_cid(None)
 
@@ -1650,7 +1683,7 @@ class ListFindStatus(object):
         if data is None:
             req.context["result"] = {}
         else:
-            req.context["result"] = list_find_finish(data)
+            req.context["result"] = list_find_finish(db, id, data)
 
 
 SUPPLIST_SCHEMA = {
@@ -1754,17 +1787,21 @@ def delete_list_bucket(cid: str, hashval: int, hashlimit: int, listid: str) -> N
     with open_db() as db:
         try:
             db.execute(
-                f"""
+                contacts.log_changes_sql(
+                    f"""
                     delete from contacts."contact_lists_{cid}" l
                     using contacts."contacts_{cid}" c
                     where ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
                     and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)
                     and c.contact_id = l.contact_id
                     and l.list_id = %s
-                        """,
+                    returning l.contact_id
+                        """
+                ),
                 hashval,
                 hashval,
                 listid,
+                cid,
             )
 
             tc = {
@@ -1824,6 +1861,7 @@ def delete_list_bucket(cid: str, hashval: int, hashlimit: int, listid: str) -> N
                 hashval,
                 hashval,
             )
+            bump_contacts_version(db, cid)
         except:
             log.exception("error")
 
@@ -2453,28 +2491,20 @@ def export_segment_block(
                 db, segment["cid"], campaignids, hashval, hashlimit
             )
 
-            rows = get_segment_rows(db, segment["cid"], hashval, listfactors, hashlimit)
-
-            cache = Cache()
+            rows = get_segment_rows(
+                db,
+                segment["cid"],
+                hashval,
+                listfactors,
+                hashlimit,
+                where=segment_sql_filter(
+                    segment["cid"], [segment], segments, listfactors
+                ),
+            )
 
-            r2 = []
-            segcounts: Dict[str, int] = {}
-            numrows = len(rows)
-            for row in rows:
-                if segment_eval_parts(
-                    segment["parts"],
-                    segment["operator"],
-                    row,
-                    segcounts,
-                    numrows,
-                    segments,
-                    sentrows,
-                    segment,
-                    hashlimit,
-                    cache,
-                ):
-                    r2.append(row)
-            rows = r2
+            pred = segment_compile(segment, segments, hashlimit)
+            state = EvalState(sentrows, len(rows), ActivityLogs(rows))
+            rows = [row for row in rows if pred(row, state)]
 
             allprops = set()
             for row in rows:
@@ -2542,35 +2572,39 @@ def refresh_segment_block(
 
             segments: Dict[str, JsonObj | None] = {}
             counts: Dict[str, int] = {}
-            segcounts: Dict[str, Dict[str, int]] = {}
             for segment in segmentobjs:
                 counts[segment["id"]] = 0
-                segcounts[segment["id"]] = {}
                 segment_get_segments(db, segment["parts"], segments)
 
             sentrows = get_segment_sentrows(db, cid, campaignids, hashval, hashlimit)
 
-            rows = get_segment_rows(db, cid, hashval, listfactors, hashlimit)
+            rows = get_segment_rows(
+                db,
+                cid,
+                hashval,
+                listfactors,
+                hashlimit,
+                where=segment_sql_filter(cid, segmentobjs, segments, listfactors),
+                snapshot=True,
+            )
 
-            cache = Cache()
+            logs = ActivityLogs(rows)
+            evals = [
+                (segment["id"], pred, EvalState(sentrows, len(rows), logs))
+                for segment, pred in zip(
+                    segmentobjs,
+                    segment_compile_many(segmentobjs, segments, hashlimit),
+                )
+            ]
 
-            numrows = len(rows)
+            members: Dict[str, Set[str]] = {segid: set() for segid, _, _ in evals}
             for row in rows:
-                for segment in segmentobjs:
-                    segid = segment["id"]
-                    if segment_eval_parts(
-                        segment["parts"],
-                        segment["operator"],
-                        row,
-                        segcounts[segid],
-                        numrows,
-                        segments,
-                        sentrows,
-                        segment,
-                        hashlimit,
-                        cache,
-                    ):
+                for segid, pred, state in evals:
+                    if pred(row, state):
                         counts[segid] = counts[segid] + 1
+                        members[segid].add(row["Email"][0])
+
+            sync_segment_members(db, cid, hashval, hashlimit, members)
 
             data = gather_complete(db, gatherid, {"counts": counts})
             if data is not None:
@@ -2593,8 +2627,16 @@ def refresh_segment_block(
                             {
                                 "count": counts[segid],
                                 "last_update": datetime.utcnow().isoformat() + "Z",
+                                "members_modified": checkts,
                             },
                         )
+                    # a later rescan of the segment may have started since
+                    db.execute(
+                        """update segments set data = data - 'refresh_id' - 'refresh_started'
+                           where id = %s and data->>'refresh_id' = %s""",
+                        segid,
+                        gatherid,
+                    )
         except Exception as e:
             log.exception("error")
             db.segments.patch(values[0][0], {"count": "Error: %s" % e})
@@ -2615,7 +2657,9 @@ def export_segment(segid: str, exportid: str, path: str) -> None:
 
             hashlimit, listfactors = segment_get_params(db, segment["cid"], segment)
 
-            gatherid = gather_init(db, "export_segment_block", hashlimit)
+            gatherid = gather_init(
+                db, "export_segment_block", hashlimit, segment["cid"]
+            )
 
             taskparams = []
             for i in range(hashlimit):
@@ -2665,7 +2709,15 @@ def refresh_segment_count(cid: str, values: List[Tuple[str, int]]) -> None:
                 hashlimit = max(hashlimit, hl)
                 listfactors.update(lf)
 
-            gatherid = gather_init(db, "refresh_segment_block", hashlimit)
+            gatherid = gather_init(db, "refresh_segment_block", hashlimit, cid)
+
+            # incremental passes leave the segments alone until the rescan
+            # has written their members
+            started = datetime.utcnow().isoformat() + "Z"
+            for segid, _ in values:
+                db.segments.patch(
+                    segid, {"refresh_id": gatherid, "refresh_started": started}
+                )
 
             taskparams = []
             for i in range(hashlimit):
@@ -2695,7 +2747,7 @@ def refresh_company_active(cid: str) -> None:
 
             hashlimit = get_hashlimit(db, cid)
 
-            gatherid = gather_init(db, "refresh_company_active", hashlimit)
+            gatherid = gather_init(db, "refresh_company_active", hashlimit, cid)
 
             n = unix_time_secs(datetime.now())
 
@@ -2705,6 +2757,213 @@ def refresh_company_active(cid: str) -> None:
             log.exception("error")
 
 
+# Segment counts are kept current by re-evaluating only the contacts logged in
+# contact_changes against the members stored for each segment.  A segment is
+# rescanned in full instead when it has just been edited, when its rules can't
+# be evaluated one contact at a time (subsets depend on the whole bucket and
+# sent-campaign rules on sends, which aren't logged), when too many contacts
+# changed at once, and every SEGMENT_RECONCILE_SECS so that rules relative to
+# the current time catch up.
+#
+# While a rescan is in flight its blocks replace the members of their bucket
+# with what they read, which may be older than a change an incremental pass
+# has applied.  Segments with a rescan started in the last
+# SEGMENT_REFRESH_TIMEOUT are skipped, and the changes are kept for the pass
+# after the rescan has finished; re-applying a change is harmless.
+SEGMENT_RECONCILE_SECS = int(os.environ.get("segment_reconcile_secs", "21600"))
+SEGMENT_REFRESH_TIMEOUT = int(os.environ.get("segment_refresh_timeout", "3600"))
+SEGMENT_INCREMENTAL_LIMIT = int(os.environ.get("segment_incremental_limit", "100000"))
+SEGMENT_INCREMENTAL_CHUNK = 5000
+
+
+def update_segment_members(db: DB, segid: str, add: Set[int], remove: Set[int]) -> None:
+    if len(add):
+        db.execute_values(
+            """insert into segment_members (segment_id, contact_id) values %s
+               on conflict (segment_id, contact_id) do nothing""",
+            [(segid, contact_id) for contact_id in sorted(add)],
+        )
+    if len(remove):
+        db.execute(
+            "delete from segment_members where segment_id = %s and contact_id = any(%s)",
+            segid,
+            sorted(remove),
+        )
+
+
+def sync_segment_members(
+    db: DB, cid: str, hashval: int, hashlimit: int, members: Dict[str, Set[str]]
+) -> None:
+    emails = set()
+    for segemails in members.values():
+        emails.update(segemails)
+
+    ids = {}
+    if len(emails):
+        ids = {
+            email: contact_id
+            for email, contact_id in db.execute(
+                f"""select email, contact_id from contacts."contacts_{cid}" where email = any(%s)""",
+                list(emails),
+            )
+        }
+
+    for segid, segemails in members.items():
+        new = set(ids[email] for email in segemails if email in ids)
+        old = set(
+            contact_id
+            for contact_id, in db.execute(
+                f"""select contact_id from segment_members
+                    where segment_id = %s and ({hashlimit} = 1 or mod(contact_id, {hashlimit}) = %s)""",
+                segid,
+                hashval,
+            )
+        )
+        update_segment_members(db, segid, new - old, old - new)
+
+
+def segment_incremental(
+    db: DB, segment: JsonObj, segments: Dict[str, JsonObj | None]
+) -> bool:
+    count = segment.get("count")
+    if not isinstance(count, int) or isinstance(count, bool):
+        return False
+    if segment.get("members_modified") != segment["modified"]:
+        return False
+    if len(segment["parts"]) == 0:
+        return False
+
+    segsegments: Dict[str, JsonObj | None] = {}
+    segment_get_segments(db, segment["parts"], segsegments)
+    segments.update(segsegments)
+
+    for seg in [segment, *segsegments.values()]:
+        if seg is not None and seg.get("subset"):
+            return False
+    return not segment_get_campaignids(segment, list(segsegments.values()))
+
+
+def segment_refreshing(segment: JsonObj) -> bool:
+    started: str | None = segment.get("refresh_started")
+    if not started:
+        return False
+    since = datetime.utcnow() - timedelta(seconds=SEGMENT_REFRESH_TIMEOUT)
+    return started > since.isoformat() + "Z"
+
+
+def refresh_segments_incremental(
+    db: DB,
+    cid: str,
+    segmentobjs: List[JsonObj],
+    segments: Dict[str, JsonObj | None],
+    listfactors: List[str],
+    refreshing: bool,
+) -> bool:
+    """Applies the contact changes logged for cid to the members and counts of
+    segmentobjs, or returns False when there are too many of them and the
+    segments should be rescanned instead.  The changes are kept for a later
+    pass when any of the company's segments is being rescanned."""
+    with db.transaction():
+        # a rescan which starts now waits for this transaction before it
+        # marks its segments, so its blocks read every change applied here
+        locked = {
+            segid: data
+            for segid, data in db.execute(
+                "select id, data from segments where id = any(%s) order by id for update",
+                sorted(segment["id"] for segment in segmentobjs),
+            )
+        }
+        segmentobjs = [
+            segment
+            for segment in segmentobjs
+            if segment["id"] in locked and not segment_refreshing(locked[segment["id"]])
+        ]
+        if len(segmentobjs) < len(locked):
+            refreshing = True
+
+        if refreshing:
+            changed = [
+                contact_id
+                for contact_id, in db.execute(
+                    "select contact_id from contact_changes where cid = %s", cid
+                )
+            ]
+        else:
+            changed = [
+                contact_id
+                for contact_id, in db.execute(
+                    "delete from contact_changes where cid = %s returning contact_id",
+                    cid,
+                )
+            ]
+        if not len(changed) or not len(segmentobjs):
+            return True
+        if len(changed) > SEGMENT_INCREMENTAL_LIMIT:
+            return False
+
+        evals = list(
+            zip(
+                [segment["id"] for segment in segmentobjs],
+                segment_compile_many(segmentobjs, segments, 1),
+            )
+        )
+        deltas = {segid: 0 for segid, _ in evals}
+
+        for i in range(0, len(changed), SEGMENT_INCREMENTAL_CHUNK):
+            chunk = changed[i : i + SEGMENT_INCREMENTAL_CHUNK]
+
+            # erased contacts are gone and simply drop out of every segment
+            ids = {
+                email: contact_id
+                for contact_id, email in db.execute(
+                    f"""select contact_id, email from contacts."contacts_{cid}" where contact_id = any(%s)""",
+                    chunk,
+                )
+            }
+            rows = []
+            if len(ids):
+                rows = get_segment_rows(
+                    db, cid, 0, listfactors, 1, contact_ids=list(ids.values())
+                )
+
+            logs = ActivityLogs(rows)
+            states = {segid: EvalState({}, len(rows), logs) for segid, _ in evals}
+            news: Dict[str, Set[int]] = {segid: set() for segid, _ in evals}
+            for row in rows:
+                for segid, pred in evals:
+                    if pred(row, states[segid]):
+                        news[segid].add(ids[row["Email"][0]])
+
+            for segid, _ in evals:
+                new = news[segid]
+                old = set(
+                    contact_id
+                    for contact_id, in db.execute(
+                        "select contact_id from segment_members where segment_id = %s and contact_id = any(%s)",
+                        segid,
+                        chunk,
+                    )
+                )
+                update_segment_members(db, segid, new - old, old - new)
+                deltas[segid] += len(new - old) - len(old - new)
+
+        for segment in segmentobjs:
+            delta = deltas[segment["id"]]
+            if delta:
+                log.debug(
+                    "%s: adjusting count for %s by %s"
+                    % (datetime.utcnow().isoformat(), segment["id"], delta)
+                )
+                db.execute(
+                    """update segments set data = data || jsonb_build_object('count', (data->>'count')::bigint + %s)
+                       where id = %s and data->>'modified' = %s and jsonb_typeof(data->'count') = 'number'""",
+                    delta,
+                    segment["id"],
+                    segment["modified"],
+                )
+    return True
+
+
 @tasks.task(priority=LOW_PRIORITY)
 def refresh_company_segments(cid: str, force: bool) -> None:
     with open_db() as db:
@@ -2713,20 +2972,46 @@ def refresh_company_segments(cid: str, force: bool) -> None:
 
             alllists = db.lists.get_all()
 
+            lists = segment_lists(alllists)
+
+            reconcile = (
+                datetime.utcnow() - timedelta(seconds=SEGMENT_RECONCILE_SECS)
+            ).isoformat() + "Z"
+
             updatelist = []
+            incremental = []
+            refreshing = False
+            segments: Dict[str, JsonObj | None] = {}
 
             for segment in db.segments.get_all():
                 if "last_update" not in segment:
                     continue
 
-                lists = segment_lists(alllists)
+                if segment_refreshing(segment):
+                    refreshing = True
+                    continue
 
-                needsupdate = False
-                for l in lists:
-                    if "last_update" in l and l["last_update"] > segment["last_update"]:
-                        needsupdate = True
-                        break
-                if needsupdate or force:
+                if force or segment["last_update"] < reconcile:
+                    needsupdate = True
+                elif segment_incremental(db, segment, segments):
+                    incremental.append(segment)
+                    continue
+                else:
+                    needsupdate = False
+                    for l in lists:
+                        if (
+                            "last_update" in l
+                            and l["last_update"] > segment["last_update"]
+                        ):
+                            needsupdate = True
+                            break
+                if needsupdate:
+                    updatelist.append([segment["id"], segment["modified"]])
+
+            if not refresh_segments_incremental(
+                db, cid, incremental, segments, [l["id"] for l in lists], refreshing
+            ):
+                for segment in incremental:
                     updatelist.append([segment["id"], segment["modified"]])
 
             if len(updatelist):
@@ -0,0 +1,21 @@
+def run(db):
+    db.execute(
+        """
+        create table campaign_counters (
+            campaign_id text not null references campaigns (id) on delete cascade,
+            counter text not null,
+            linkindex integer not null,
+            slot smallint not null,
+            count bigint not null,
+            primary key (campaign_id, counter, linkindex, slot)
+        );
+        create table message_counters (
+            message_id text not null references messages (id) on delete cascade,
+            counter text not null,
+            linkindex integer not null,
+            slot smallint not null,
+            count bigint not null,
+            primary key (message_id, counter, linkindex, slot)
+        );
+    """
+    )
@@ -0,0 +1,41 @@
+def run(db):
+    db.execute(
+        """
+        create table daystats (
+            cid text not null,
+            day date not null,
+            sinkid text not null,
+            domaingroupid text not null,
+            settingsid text not null,
+            complaint bigint not null,
+            unsub bigint not null,
+            open bigint not null,
+            click bigint not null,
+            send bigint not null,
+            soft bigint not null,
+            hard bigint not null,
+            err bigint not null,
+            defercnt bigint not null,
+            primary key (cid, day, sinkid, domaingroupid, settingsid)
+        );
+        create table campdaystats (
+            campcid text not null,
+            day date not null,
+            campid text not null,
+            open bigint not null,
+            send bigint not null,
+            primary key (campcid, day, campid)
+        );
+        insert into daystats (cid, day, sinkid, domaingroupid, settingsid,
+                              complaint, unsub, open, click, send, soft, hard, err, defercnt)
+        select cid, ts::date, sinkid, domaingroupid, settingsid,
+               sum(complaint), sum(unsub), sum(open), sum(click), sum(send), sum(soft), sum(hard), sum(err), sum(defercnt)
+        from hourstats
+        group by 1, 2, 3, 4, 5;
+        insert into campdaystats (campcid, day, campid, open, send)
+        select campcid, ts::date, campid, sum(open), sum(send)
+        from hourstats
+        group by 1, 2, 3
+        having sum(open) <> 0 or sum(send) <> 0;
+    """
+    )
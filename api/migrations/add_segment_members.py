@@ -0,0 +1,16 @@
+def run(db):
+    db.execute(
+        """
+        create table contact_changes (
+            cid text not null,
+            contact_id bigint not null,
+            changed timestamptz not null default now(),
+            primary key (cid, contact_id)
+        );
+        create table segment_members (
+            segment_id text not null references segments (id) on delete cascade,
+            contact_id bigint not null,
+            primary key (segment_id, contact_id)
+        );
+    """
+    )
@@ -0,0 +1,9 @@
+def run(db):
+    db.execute(
+        """
+        create table track_entries (
+            id text primary key,
+            ts timestamptz not null default now()
+        );
+    """
+    )
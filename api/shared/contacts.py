@@ -1,13 +1,17 @@
 import os
 import re
 import csv
+import json
+import zlib
+import codecs
 import shortuuid
 import requests
 import msgpack
 import time
 import random
-from typing import Dict, Tuple, List, Any, Callable
-from io import BytesIO, TextIOWrapper, IOBase
+from redis.exceptions import LockError
+from typing import Dict, Tuple, List, Any, Callable, Iterator, Set
+from io import BytesIO, StringIO, IOBase
 from datetime import datetime
 from .block import read_block, list_blocks
 from .utils import (
@@ -18,8 +22,11 @@ from .utils import (
     insert_funnel_tag,
     incr_funnel_counts,
     run_task,
+    run_task_delay,
     gather_init,
     gather_complete,
+    gathers_running,
+    redis_connect,
     emailre,
     md5re,
     open_ticket,
@@ -28,27 +35,59 @@ from .utils import (
     SECS_IN_DAY,
     get_txn,
 )
-from .s3 import s3_delete, s3_read_stream, s3_open_write
-from .db import open_db, json_obj, JsonObj, DB
+from .s3 import (
+    s3_delete,
+    s3_read_stream,
+    s3_open_write,
+    s3_read_range,
+)
+from .db import open_db, direct_cursor, json_obj, JsonObj, DB
 from .tasks import tasks, HIGH_PRIORITY, LOW_PRIORITY
 from .segments import (
     get_hashlimit,
+    plan_hashlimit,
     segment_get_campaignids,
     segment_get_params,
     get_segment_sentrows,
     get_segment_rows,
-    segment_eval_parts,
-    Cache,
+    segment_compile,
+    segment_sql_filter,
+    EvalState,
+    ActivityLogs,
 )
 from .log import get_logger
 from .webhooks import send_webhooks
+from .snapshots import bump_contacts_version
 
 log = get_logger()
 
 WRITE_BLOCK_SIZE = 32 * 1024
 HASH_BLOCK_SIZE = 1024 * 1024
-# Max hash buckets to prevent runaway rehashing/task fan-out. Can be overridden via env.
-HASHLIMIT_CAP = int(os.environ.get("hashlimit_max", "128"))
+
+
+# Contacts whose segment membership may have changed are logged in
+# contact_changes along with the change, so refresh_company_segments can
+# re-evaluate just those contacts instead of rescanning every bucket.
+def log_changes(db: DB, cid: str, contact_ids: List[int]) -> None:
+    if len(contact_ids):
+        db.execute(
+            """insert into contact_changes (cid, contact_id)
+               select %s, unnest(%s::bigint[])
+               on conflict (cid, contact_id) do nothing""",
+            cid,
+            contact_ids,
+        )
+
+
+def log_changes_sql(sql: str) -> str:
+    """Wraps a statement returning contact_id so the contacts it touches are
+    logged as changed; the cid goes after the statement's own parameters."""
+    return f"""
+        with changed as ({sql})
+        insert into contact_changes (cid, contact_id)
+        select distinct %s, contact_id from changed
+        on conflict (cid, contact_id) do nothing
+    """
 
 
 def load_campaign_or_message(db: DB, campid: str) -> Tuple[JsonObj | None, bool]:
@@ -266,6 +305,10 @@ def update_tags(
             tagname,
         )
 
+    if len(add_tags) or len(remove_tags):
+        log_changes(db, cid, [contact_id for _, contact_id in email_contact_ids])
+        bump_contacts_version(db, cid)
+
 
 def add_tag(
     db: DB,
@@ -428,7 +471,11 @@ def erase(db: DB, cid: str, emails: List[str], unsublog: bool = False) -> None:
             )
 
         db.execute(
-            f"""delete from contacts."contacts_{cid}" where email = any(%s)""", emails
+            log_changes_sql(
+                f"""delete from contacts."contacts_{cid}" where email = any(%s) returning contact_id"""
+            ),
+            emails,
+            cid,
         )
 
         if unsublog:
@@ -438,6 +485,8 @@ def erase(db: DB, cid: str, emails: List[str], unsublog: bool = False) -> None:
                 emails,
             )
 
+    bump_contacts_version(db, cid)
+
 
 def overwrite_props(db: DB, cid: str, email: str, props: JsonObj) -> None:
     fixedprops = {}
@@ -446,10 +495,14 @@ def overwrite_props(db: DB, cid: str, email: str, props: JsonObj) -> None:
             fixedprops[k] = [v]
 
     db.execute(
-        f"""update contacts."contacts_{cid}" set props = %s where email = %s""",
+        log_changes_sql(
+            f"""update contacts."contacts_{cid}" set props = %s where email = %s returning contact_id"""
+        ),
         fixedprops,
         email,
+        cid,
     )
+    bump_contacts_version(db, cid)
 
     listids = [
         listid
@@ -567,6 +620,8 @@ def feed(
         contact_id,
         listid,
     )
+    log_changes(db, cid, [contact_id])
+    bump_contacts_version(db, cid)
 
     update_tags(db, cid, [email], tags, webhook_msgs, [(email, contact_id)], funnel)
 
@@ -732,18 +787,23 @@ def update(db: DB, cid: str, upd: JsonObj) -> None:
     if written and count_prop in counts:
         counts[count_prop] = 1
 
+    # only writes which change the contact can change its segment rows or
+    # membership; a repeat open or click of the same link changes nothing
+    modified = bool(written)
+
     # add browser, device etc
     for clientname in clientprops:
         nc = getattr(fn, clientname)
         if nc:
-            db.execute(
+            if db.execute(
                 f"""insert into contacts."contact_values_{cid}" (contact_id, type, value) values (%s, %s, %s)
                            on conflict (contact_id, type, value) do nothing
                        """,
                 contact_id,
                 clientname,
                 nc,
-            )
+            ).rowcount:
+                modified = True
 
     # add open or click log
     changed = False
@@ -806,6 +866,10 @@ def update(db: DB, cid: str, upd: JsonObj) -> None:
                 ).rowcount
             )
 
+    if modified or changed:
+        log_changes(db, cid, [contact_id])
+        bump_contacts_version(db, cid)
+
     if changed and fn.prop in ("Opened", "Clicked"):
         funnelcounts: Dict[str, int] = {}
         _, respfunnels = get_funnels(db, cid)
@@ -961,16 +1025,21 @@ def erase_domains_bucket(
             db.execute("delete from alltags where count <= 0 and cid = %s", cid)
 
             db.execute(
-                f"""
+                log_changes_sql(
+                    f"""
                 delete from contacts."contacts_{cid}" c
                 where ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
                 and (
                     {domain_or_expr}
                 )
-            """,
+                returning c.contact_id
+            """
+                ),
                 hashval,
                 *domain_params,
+                cid,
             )
+            bump_contacts_version(db, cid)
 
             bucketinfo = gather_complete(
                 db, tmpid, {"listids": listids, "liststats": liststats}
@@ -1065,7 +1134,7 @@ def patch_list(
 def erase_domains(db: DB, cid: str, domains: List[str]) -> None:
     hashlimit = get_hashlimit(db, cid)
 
-    tmpid = gather_init(db, "erase_domains", hashlimit)
+    tmpid = gather_init(db, "erase_domains", hashlimit, cid)
 
     for hashval in range(hashlimit):
         run_task(erase_domains_bucket, cid, hashval, hashlimit, domains, tmpid)
@@ -1105,17 +1174,23 @@ def remove_list_contacts(db: DB, cid: str, listid: str, emails: List[str]) -> in
             emails,
         )
 
-        ret = db.execute(
-            f"""
+        removed = [
+            contact_id
+            for contact_id, in db.execute(
+                f"""
             delete from contacts."contact_lists_{cid}" l
             using contacts."contacts_{cid}" c
             where l.contact_id = c.contact_id
             and l.list_id = %s
             and c.email = any(%s)
+            returning l.contact_id
         """,
-            listid,
-            emails,
-        ).rowcount
+                listid,
+                emails,
+            )
+        ]
+        ret = len(removed)
+        log_changes(db, cid, removed)
 
         tc = {
             tag: cnt
@@ -1188,7 +1263,9 @@ def remove_list_contacts(db: DB, cid: str, listid: str, emails: List[str]) -> in
             db, listid, -ret, -bounced, -unsubscribed, -complained, -soft_bounced
         )
 
-        return ret
+    bump_contacts_version(db, cid)
+
+    return ret
 
 
 @tasks.task(priority=HIGH_PRIORITY)
@@ -1225,7 +1302,8 @@ def remove_list_domains_bucket(
             )
 
             db.execute(
-                f"""
+                log_changes_sql(
+                    f"""
                 delete from contacts."contact_lists_{cid}" l
                 using contacts."contacts_{cid}" c
                 where ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
@@ -1235,11 +1313,14 @@ def remove_list_domains_bucket(
                 and (
                     {domain_or_expr}
                 )
-                    """,
+                returning l.contact_id
+                    """
+                ),
                 hashval,
                 hashval,
                 listid,
                 *domain_params,
+                cid,
             )
 
             tc = {
@@ -1299,6 +1380,7 @@ def remove_list_domains_bucket(
                 hashval,
                 hashval,
             )
+            bump_contacts_version(db, cid)
 
             bucketinfo = gather_complete(
                 db, tmpid, {"stats": [bounced, unsubscribed, complained, soft_bounced]}
@@ -1327,7 +1409,7 @@ def remove_list_domains_bucket(
 def remove_list_domains(db: DB, cid: str, lst: JsonObj, domains: List[str]) -> None:
     hashlimit = get_hashlimit(db, cid, [lst])
 
-    tmpid = gather_init(db, "remove_list_domains", hashlimit)
+    tmpid = gather_init(db, "remove_list_domains", hashlimit, cid)
 
     for hashval in range(hashlimit):
         run_task(
@@ -1458,12 +1540,7 @@ def write_rows(
 ) -> Tuple[int, Dict[str, int], Tuple[int, int, int, int]]:
     count = 0
     domaincounts: Dict[str, int] = {}
-    values_query = []
-    values = []
     webhook_msgs = []
-    emails = []
-    override_emails = []
-    unsublogs = {}
     if keytype == "list":
         list_table = f'contacts."contact_lists_{cid}"'
         list_column = "list_id"
@@ -1476,189 +1553,197 @@ def write_rows(
         list_column = "supplist_id"
         webhook_count = 0
     with db.transaction():
+        # the block is copied into a staging table so the merges, stats and
+        # upserts below are set-based statements instead of huge parameter lists
+        db.execute(
+            """
+            create temp table write_rows_stage (
+                email text not null,
+                added bigint not null,
+                props jsonb not null
+            ) on commit drop
+        """
+        )
         with s3_read_stream(os.environ["s3_transferbucket"], key) as fp:
-            lines = [
-                (email, props)
-                for email, props in msgpack.Unpacker(fp, strict_map_key=False)
-            ]
-            if keytype == "list":
-                for email, bounced, unsubscribed, complained in db.execute(
-                    """
-                    select email, bounced, unsubscribed, complained
-                    from unsublogs
-                    where cid = %s and email = any(%s)
-                """,
-                    cid,
-                    [email for email, _ in lines],
-                ):
-                    unsublogs[email] = (bounced, unsubscribed, complained)
-            for email, props in lines:
+            added = unix_time_secs(datetime.now())
+            buf = StringIO()
+            writer = csv.writer(buf)
+            seen = set()
+            for email, props in msgpack.Unpacker(fp, strict_map_key=False):
+                # blocks are deduped before they are written, but an email in
+                # a block twice would fail the upsert, so the first one wins
+                if email in seen:
+                    continue
+                seen.add(email)
                 if override:
-                    override_emails.append(email)
                     props["Bounced"] = [""]
                     props["Unsubscribed"] = [""]
                     props["Complained"] = [""]
-                elif email in unsublogs:
-                    bounced, unsubscribed, complained = unsublogs[email]
-                    if bounced:
-                        props["Bounced"] = ["true"]
-                    if unsubscribed:
-                        props["Unsubscribed"] = ["true"]
-                    if complained:
-                        props["Complained"] = ["true"]
-                if keytype == "list":
-                    emails.append(email)
-                values_query.append("(%s, %s, %s)")
-                values.append(email)
-                values.append(unix_time_secs(datetime.now()))
-                values.append(props)
-            values.append(listid)
-
-            if override:
-                stats: Tuple[int, int, int, int] = db.row_or_error(
-                    f"""
-                    select -count(distinct c.contact_id) filter (where coalesce((nullif(props->'Bounced'->>0, ''))::bool, false)),
-                           -count(distinct c.contact_id) filter (where coalesce((nullif(props->'Unsubscribed'->>0, ''))::bool, false)),
-                           -count(distinct c.contact_id) filter (where coalesce((nullif(props->'Complained'->>0, ''))::bool, false)),
-                           0
+                writer.writerow((email, added, json.dumps(props)))
+        buf.seek(0)
+        db.copy_expert(
+            "copy write_rows_stage (email, added, props) from stdin with (format csv)",
+            buf,
+        )
+        db.execute("analyze write_rows_stage")
+
+        if keytype == "list" and not override:
+            db.execute(
+                """
+                update write_rows_stage s
+                set props = s.props || jsonb_strip_nulls(jsonb_build_object(
+                    'Bounced', case when u.bounced then '["true"]'::jsonb end,
+                    'Unsubscribed', case when u.unsubscribed then '["true"]'::jsonb end,
+                    'Complained', case when u.complained then '["true"]'::jsonb end
+                ))
+                from unsublogs u
+                where u.cid = %s and u.email = s.email
+                and (u.bounced or u.unsubscribed or u.complained)
+            """,
+                cid,
+            )
+
+        if keytype != "list":
+            stats: Tuple[int, int, int, int] = (0, 0, 0, 0)
+        elif override:
+            stats = db.row_or_error(
+                f"""
+                select -count(distinct c.contact_id) filter (where coalesce((nullif(props->'Bounced'->>0, ''))::bool, false)),
+                       -count(distinct c.contact_id) filter (where coalesce((nullif(props->'Unsubscribed'->>0, ''))::bool, false)),
+                       -count(distinct c.contact_id) filter (where coalesce((nullif(props->'Complained'->>0, ''))::bool, false)),
+                       0
+                from contacts."contacts_{cid}" c
+                join {list_table} l on l.contact_id = c.contact_id and l.{list_column} = %s
+                where c.email in (select email from write_rows_stage)
+            """,
+                listid,
+            )
+        elif unsub:
+            stats = db.row_or_error(
+                f"""
+                select sum(bounced), sum(unsubscribed), sum(complained), sum(soft_bounced)
+                from (
+                    select count(distinct c.contact_id) filter (where coalesce((nullif(props->'Bounced'->>0, ''))::bool, false)) as bounced,
+                           count(distinct c.contact_id) as unsubscribed,
+                           count(distinct c.contact_id) filter (where coalesce((nullif(props->'Complained'->>0, ''))::bool, false)) as complained,
+                           count(distinct c.contact_id) filter (where coalesce((nullif(props->'Soft Bounced'->>0, ''))::bool, false)) as soft_bounced
                     from contacts."contacts_{cid}" c
-                    join {list_table} l on l.contact_id = c.contact_id and l.{list_column} = %s
-                    where c.email = any(%s)
-                """,
-                    listid,
-                    emails,
-                )
-            elif unsub:
-                stats = db.row_or_error(
-                    f"""
-                    select sum(bounced), sum(unsubscribed), sum(complained), sum(soft_bounced)
-                    from (
-                        select count(distinct c.contact_id) filter (where coalesce((nullif(props->'Bounced'->>0, ''))::bool, false)) as bounced,
-                               count(distinct c.contact_id) as unsubscribed,
-                               count(distinct c.contact_id) filter (where coalesce((nullif(props->'Complained'->>0, ''))::bool, false)) as complained,
-                               count(distinct c.contact_id) filter (where coalesce((nullif(props->'Soft Bounced'->>0, ''))::bool, false)) as soft_bounced
-                        from contacts."contacts_{cid}" c
-                        left join {list_table} l on l.contact_id = c.contact_id
-                        where email = any(%s)
-                        and (l.contact_id is null or l.{list_column} != %s)
-                        union all
-                        select count(email) filter (where bounced) as bounced,
-                               0 as unsubscribed,
-                               count(email) filter (where complained) as complained,
-                               0 as soft_bounced
-                        from unsublogs
-                        where cid = %s and email = any(%s)
-                    ) s
-                """,
-                    emails,
-                    listid,
-                    cid,
-                    emails,
-                )
+                    left join {list_table} l on l.contact_id = c.contact_id
+                    where email in (select email from write_rows_stage)
+                    and (l.contact_id is null or l.{list_column} != %s)
+                    union all
+                    select count(email) filter (where bounced) as bounced,
+                           0 as unsubscribed,
+                           count(email) filter (where complained) as complained,
+                           0 as soft_bounced
+                    from unsublogs
+                    where cid = %s and email in (select email from write_rows_stage)
+                ) s
+            """,
+                listid,
+                cid,
+            )
 
-                existunsubs = db.single(
-                    f"""
-                    select count(c.contact_id)
+            existunsubs = db.single(
+                f"""
+                select count(c.contact_id)
+                from contacts."contacts_{cid}" c
+                join {list_table} l on l.contact_id = c.contact_id and l.{list_column} = %s
+                where email in (select email from write_rows_stage)
+            """,
+                listid,
+            )
+            stats = (stats[0], stats[1] + existunsubs, stats[2], stats[3])
+        else:
+            stats = db.row_or_error(
+                f"""
+                select sum(bounced), sum(unsubscribed), sum(complained), sum(soft_bounced)
+                from (
+                    select count(distinct c.contact_id) filter (where coalesce((nullif(props->'Bounced'->>0, ''))::bool, false)) as bounced,
+                           count(distinct c.contact_id) filter (where coalesce((nullif(props->'Unsubscribed'->>0, ''))::bool, false)) as unsubscribed,
+                           count(distinct c.contact_id) filter (where coalesce((nullif(props->'Complained'->>0, ''))::bool, false)) as complained,
+                           count(distinct c.contact_id) filter (where coalesce((nullif(props->'Soft Bounced'->>0, ''))::bool, false)) as soft_bounced
                     from contacts."contacts_{cid}" c
-                    join {list_table} l on l.contact_id = c.contact_id and l.{list_column} = %s
-                    where email = any(%s)
-                """,
-                    listid,
-                    emails,
-                )
-                stats = (stats[0], stats[1] + existunsubs, stats[2], stats[3])
-            else:
-                stats = db.row_or_error(
-                    f"""
-                    select sum(bounced), sum(unsubscribed), sum(complained), sum(soft_bounced)
-                    from (
-                        select count(distinct c.contact_id) filter (where coalesce((nullif(props->'Bounced'->>0, ''))::bool, false)) as bounced,
-                               count(distinct c.contact_id) filter (where coalesce((nullif(props->'Unsubscribed'->>0, ''))::bool, false)) as unsubscribed,
-                               count(distinct c.contact_id) filter (where coalesce((nullif(props->'Complained'->>0, ''))::bool, false)) as complained,
-                               count(distinct c.contact_id) filter (where coalesce((nullif(props->'Soft Bounced'->>0, ''))::bool, false)) as soft_bounced
-                        from contacts."contacts_{cid}" c
-                        left join {list_table} l on l.contact_id = c.contact_id
-                        where email = any(%s)
-                        and (l.{list_column} is null or l.{list_column} != %s)
-                        union all
-                        select count(email) filter (where bounced) as bounced,
-                               count(email) filter (where unsubscribed) as unsubscribed,
-                               count(email) filter (where complained) as complained,
-                               0 as soft_bounced
-                        from unsublogs
-                        where cid = %s and email = any(%s)
-                    ) s
-                """,
-                    emails,
-                    listid,
-                    cid,
-                    emails,
-                )
+                    left join {list_table} l on l.contact_id = c.contact_id
+                    where email in (select email from write_rows_stage)
+                    and (l.{list_column} is null or l.{list_column} != %s)
+                    union all
+                    select count(email) filter (where bounced) as bounced,
+                           count(email) filter (where unsubscribed) as unsubscribed,
+                           count(email) filter (where complained) as complained,
+                           0 as soft_bounced
+                    from unsublogs
+                    where cid = %s and email in (select email from write_rows_stage)
+                ) s
+            """,
+                listid,
+                cid,
+            )
 
-            if webhook_count > 0:
-                for (email,) in db.execute(
-                    f"""
-                    with c as (
-                        insert into contacts."contacts_{cid}" (email, added, props) values
-                        {", ".join(values_query)}
-                        on conflict (email) do update set props = contacts."contacts_{cid}".props || excluded.props
-                        returning contact_id, email
-                    ), l as (
-                        insert into {list_table} (contact_id, {list_column})
-                        select c.contact_id, %s
-                        from c
-                        on conflict (contact_id, {list_column}) do nothing
-                        returning contact_id
-                    )
-                    select c.email
-                    from c
-                    join l on c.contact_id = l.contact_id
-                """,
-                    *values,
-                ):
-                    count += 1
-                    domain = email.split("@")[1]
-                    domaincounts[domain] = domaincounts.get(domain, 0) + 1
+        upsert = f"""
+            with c as (
+                insert into contacts."contacts_{cid}" (email, added, props)
+                select email, added, props from write_rows_stage
+                on conflict (email) do update set props = contacts."contacts_{cid}".props || excluded.props
+                returning contact_id, email
+            ), l as (
+                insert into {list_table} (contact_id, {list_column})
+                select c.contact_id, %s
+                from c
+                on conflict (contact_id, {list_column}) do nothing
+                returning contact_id
+            ), changed as (
+                insert into contact_changes (cid, contact_id)
+                select %s, contact_id from c
+                on conflict (cid, contact_id) do nothing
+            )
+        """
 
-                    webhook_msgs.append(
-                        {
-                            "type": "list_add",
-                            "list": listid,
-                            "email": email,
-                            "timestamp": datetime.utcnow().isoformat() + "Z",
-                        }
-                    )
-            else:
-                for domain, domaincount in db.execute(
-                    f"""
-                    with c as (
-                        insert into contacts."contacts_{cid}" (email, added, props) values
-                        {", ".join(values_query)}
-                        on conflict (email) do update set props = contacts."contacts_{cid}".props || excluded.props
-                        returning contact_id, email
-                    ), l as (
-                        insert into {list_table} (contact_id, {list_column})
-                        select c.contact_id, %s
-                        from c
-                        on conflict (contact_id, {list_column}) do nothing
-                        returning contact_id
-                    )
-                    select split_part(c.email, '@', 2) as domain, count(c.contact_id) as count
-                    from c
-                    join l on c.contact_id = l.contact_id
-                    group by split_part(c.email, '@', 2)
-                """,
-                    *values,
-                ):
-                    count += domaincount
-                    domaincounts[domain] = domaincount
+        if webhook_count > 0:
+            for (email,) in db.execute(
+                f"""
+                {upsert}
+                select c.email
+                from c
+                join l on c.contact_id = l.contact_id
+            """,
+                listid,
+                cid,
+            ):
+                count += 1
+                domain = email.split("@")[1]
+                domaincounts[domain] = domaincounts.get(domain, 0) + 1
 
-            if len(override_emails):
-                db.execute(
-                    "delete from unsublogs where cid = %s and email = any(%s)",
-                    cid,
-                    override_emails,
+                webhook_msgs.append(
+                    {
+                        "type": "list_add",
+                        "list": listid,
+                        "email": email,
+                        "timestamp": datetime.utcnow().isoformat() + "Z",
+                    }
                 )
+        else:
+            for domain, domaincount in db.execute(
+                f"""
+                {upsert}
+                select split_part(c.email, '@', 2) as domain, count(c.contact_id) as count
+                from c
+                join l on c.contact_id = l.contact_id
+                group by split_part(c.email, '@', 2)
+            """,
+                listid,
+                cid,
+            ):
+                count += domaincount
+                domaincounts[domain] = domaincount
+
+        if override:
+            db.execute(
+                "delete from unsublogs where cid = %s and email in (select email from write_rows_stage)",
+                cid,
+            )
+
+    bump_contacts_version(db, cid)
 
     if len(webhook_msgs):
         send_webhooks(db, cid, webhook_msgs)
@@ -1804,6 +1889,133 @@ def write_block(
 
 CONTACTS_PER_BLOCK = 500
 
+# Uploads are split into newline aligned byte ranges which are parsed in
+# parallel; each range hashes its contacts into partitions by email so that
+# every partition can be deduped on its own before the write_block fan-out.
+INGEST_RANGE_SIZE = 16 * 1024 * 1024
+INGEST_SAMPLE_SIZE = 64 * 1024
+INGEST_MAX_PARTITIONS = 64
+
+
+def import_failed(db: DB, keytype: str, listid: str, e: Exception) -> None:
+    if keytype == "supp":
+        db.supplists.patch(
+            listid,
+            {
+                "processing": "",
+                "processing_error": "Importing data failed: %s" % str(e),
+            },
+        )
+    elif keytype == "list":
+        db.lists.patch(
+            listid,
+            {
+                "processing": "",
+                "processing_error": "Importing data failed: %s" % str(e),
+            },
+        )
+
+
+def import_finished(db: DB, keytype: str, listid: str) -> None:
+    if keytype == "supp":
+        db.supplists.patch(listid, {"processing": "", "processing_error": ""})
+    elif keytype == "list":
+        db.lists.patch(listid, {"processing": "", "processing_error": ""})
+
+
+def detect_encoding(sample: bytes) -> str:
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "iso-8859-1"
+
+
+def line_ranges(key: str, rangesize: int) -> List[Tuple[int, int]]:
+    """Splits the file into ranges of about rangesize bytes, each ending at a
+    line end.  Quotes inside a field are doubled, so a line end is inside a
+    field exactly when an odd number of quotes come before it; ranges only end
+    at the others, so a quoted field which spans lines is never split."""
+    ranges = []
+    start = 0
+    pos = 0
+    inquote = False
+    with s3_read_stream(os.environ["s3_transferbucket"], key) as fp:
+        while True:
+            chunk = fp.read(INGEST_SAMPLE_SIZE)
+            if not chunk:
+                break
+            for i, part in enumerate(chunk.split(b'"')):
+                if i:
+                    inquote = not inquote
+                    pos += 1
+                if not inquote:
+                    # the first line end at least rangesize bytes into the range
+                    nl = part.find(b"\n", max(0, start + rangesize - 1 - pos))
+                    while nl >= 0:
+                        ranges.append((start, pos + nl + 1))
+                        start = pos + nl + 1
+                        nl = part.find(b"\n", max(nl + 1, start + rangesize - 1 - pos))
+                pos += len(part)
+    if start < pos:
+        ranges.append((start, pos))
+    return ranges
+
+
+def delete_range_files(key: str, rangeinfo: List[JsonObj]) -> None:
+    s3_delete(os.environ["s3_transferbucket"], key)
+    for info in rangeinfo:
+        for partition in info["partitions"]:
+            s3_delete(
+                os.environ["s3_transferbucket"],
+                f"{key}.range.{partition:03d}.{info['index']:05d}",
+            )
+
+
+def parse_import_rows(
+    text: str, colmap: List[str], keytype: str, unsub: bool, used: Set[str]
+) -> Iterator[Tuple[str, JsonObj]]:
+    l = len(colmap)
+    strippedcols = [c for c in colmap if valid_prop(c)]
+    s = len(strippedcols)
+    emailindex = strippedcols.index("Email")
+
+    for row in csv.reader(StringIO(text, newline="")):
+        r = [row[i].strip() for i in range(min(len(row), l)) if valid_prop(colmap[i])]
+
+        if len(r) <= emailindex:
+            continue
+
+        emailmatch = emailre.search(r[emailindex])
+        if not emailmatch and not (keytype == "supp" and md5re.search(r[emailindex])):
+            continue
+
+        if emailmatch:
+            email = emailmatch.group(0).lower()
+            if len(email) > 254:
+                continue
+        else:
+            email = r[emailindex].lower()
+
+        while len(r) < s:
+            r.append("")
+
+        props = {}
+        for i in range(len(r)):
+            if i != emailindex:
+                colname = strippedcols[i]
+                if not unsub and colname in (
+                    "Bounced",
+                    "Unsubscribed",
+                    "Complained",
+                    "Soft Bounced",
+                ):
+                    continue
+                props[colname] = [r[i]]
+                used.add(colname)
+
+        yield email, props
+
 
 @tasks.task(priority=LOW_PRIORITY)
 def dedupe_blocks(
@@ -1817,118 +2029,219 @@ def dedupe_blocks(
 ) -> None:
     with open_db() as db:
         try:
-            l = len(colmap)
-            strippedcols = [c for c in colmap if valid_prop(c)]
-            s = len(strippedcols)
-            emailindex = strippedcols.index("Email")
-
-            used = set()
             skipvalidation = False
-            excludemails = None
-            excludedomains = None
             if keytype == "list":
-                excludemails = set()
-                excludedomains = set()
-                for item, rh in db.execute(
-                    "select item, rawhash from exclusions where cid = %s", cid
-                ):
-                    if rh is None:
-                        excludedomains.add(item)
-                    else:
-                        excludemails.add(item)
                 skipvalidation = db.single(
                     "select (data->>'skip_list_validation')::boolean from companies where id = %s",
                     cid,
                 )
 
-            for encoding in ["utf-8", "iso-8859-1", "ascii"]:
-                try:
-                    files: List[str] = []
-                    writefp: IOBase | None = None
-                    writecount = 0
-                    emails = set()
-
-                    with s3_read_stream(os.environ["s3_transferbucket"], key) as fp:
-                        with TextIOWrapper(
-                            fp,
-                            encoding,
-                            newline="",
-                            errors="ignore" if encoding == "ascii" else None,
-                        ) as text:
-                            for row in csv.reader(text):
-                                r = [
-                                    row[i].strip()
-                                    for i in range(min(len(row), l))
-                                    if valid_prop(colmap[i])
-                                ]
-
-                                if len(r) <= emailindex:
-                                    continue
-
-                                emailmatch = emailre.search(r[emailindex])
-                                if not emailmatch and not (
-                                    keytype == "supp" and md5re.search(r[emailindex])
-                                ):
-                                    continue
-
-                                if emailmatch:
-                                    email = emailmatch.group(0).lower()
-                                    if len(email) > 254:
-                                        continue
-                                else:
-                                    email = r[emailindex].lower()
-
-                                if email in emails:
-                                    continue
-                                emails.add(email)
-
-                                while len(r) < s:
-                                    r.append("")
-
-                                props = {}
-                                for i in range(len(r)):
-                                    if i != emailindex:
-                                        colname = strippedcols[i]
-                                        if not unsub and colname in (
-                                            "Bounced",
-                                            "Unsubscribed",
-                                            "Complained",
-                                            "Soft Bounced",
-                                        ):
-                                            continue
-                                        props[colname] = [r[i]]
-                                        used.add(colname)
-
-                                if keytype == "list":
-                                    domain = email.split("@")[1]
-
-                                    if (email in excludemails) or (
-                                        domain in excludedomains
-                                    ):
-                                        continue
-
-                                if writefp is None or writecount >= CONTACTS_PER_BLOCK:
-                                    if writefp is not None:
-                                        writefp.close()
-                                    filename = f"{key}.dedupe.{len(files):05d}"
-                                    writefp = s3_open_write(
-                                        os.environ["s3_transferbucket"], filename
-                                    )
-                                    files.append(filename)
-                                    writecount = 0
-                                msgpack.pack([email, props], writefp)
-                                writecount += 1
-                    if writefp is not None:
-                        writefp.close()
-                    break
-                except UnicodeDecodeError:
-                    if encoding == "ascii":
-                        raise
+            encoding = detect_encoding(
+                s3_read_range(
+                    os.environ["s3_transferbucket"], key, 0, INGEST_SAMPLE_SIZE
+                )
+            )
+            ranges = line_ranges(key, INGEST_RANGE_SIZE)
+            if not len(ranges):
+                ranges = [(0, 0)]
+            partitions = min(len(ranges), INGEST_MAX_PARTITIONS)
+
+            gatherid = gather_init(db, "ingest_range", len(ranges))
+            for index, (start, end) in enumerate(ranges):
+                run_task(
+                    ingest_range,
+                    cid,
+                    listid,
+                    keytype,
+                    key,
+                    colmap,
+                    override,
+                    unsub,
+                    skipvalidation,
+                    encoding,
+                    index,
+                    start,
+                    end,
+                    partitions,
+                    gatherid,
+                )
+        except Exception as e:
+            log.exception("error")
+            import_failed(db, keytype, listid, e)
+
+
+@tasks.task(priority=LOW_PRIORITY)
+def ingest_range(
+    cid: str,
+    listid: str,
+    keytype: str,
+    key: str,
+    colmap: List[str],
+    override: bool,
+    unsub: bool,
+    skipvalidation: bool,
+    encoding: str,
+    index: int,
+    start: int,
+    end: int,
+    partitions: int,
+    gatherid: str,
+) -> None:
+    with open_db() as db:
+        completed = False
+        writefps: Dict[int, IOBase] = {}
+        try:
+            data = s3_read_range(
+                os.environ["s3_transferbucket"], key, start, end - start
+            )
+            try:
+                text = data.decode(encoding)
+            except UnicodeDecodeError:
+                text = data.decode("iso-8859-1")
+            del data
+
+            used: Set[str] = set()
+            emails = set()
+            for email, props in parse_import_rows(text, colmap, keytype, unsub, used):
+                if email in emails:
+                    continue
+                emails.add(email)
+
+                partition = zlib.crc32(email.encode("utf-8")) % partitions
+                writefp = writefps.get(partition)
+                if writefp is None:
+                    writefp = writefps[partition] = s3_open_write(
+                        os.environ["s3_transferbucket"],
+                        f"{key}.range.{partition:03d}.{index:05d}",
+                    )
+                msgpack.pack([email, props], writefp)
+            for writefp in writefps.values():
+                writefp.close()
+
+            rangeinfo = gather_complete(
+                db,
+                gatherid,
+                {"index": index, "partitions": list(writefps), "used": list(used)},
+            )
+            completed = True
+            if rangeinfo is not None:
+                # the range which failed has already failed the import
+                if any("error" in info for info in rangeinfo):
+                    delete_range_files(key, rangeinfo)
+                    return
+
+                s3_delete(os.environ["s3_transferbucket"], key)
+
+                allused = set()
+                files: Dict[int, List[str]] = {}
+                for info in sorted(rangeinfo, key=lambda i: i["index"]):
+                    allused.update(info["used"])
+                    for partition in info["partitions"]:
+                        files.setdefault(partition, []).append(
+                            f"{key}.range.{partition:03d}.{info['index']:05d}"
+                        )
+
+                if not len(files):
+                    import_finished(db, keytype, listid)
+                    return
+
+                partgatherid = gather_init(db, "dedupe_partition", len(files))
+                for partition, partfiles in files.items():
+                    run_task(
+                        dedupe_partition,
+                        cid,
+                        listid,
+                        keytype,
+                        key,
+                        partition,
+                        partfiles,
+                        list(allused),
+                        override,
+                        unsub,
+                        skipvalidation,
+                        partgatherid,
+                    )
+        except Exception as e:
+            log.exception("error")
+            import_failed(db, keytype, listid, e)
+            if not completed:
+                for writefp in writefps.values():
+                    writefp.close()
+                rangeinfo = gather_complete(
+                    db,
+                    gatherid,
+                    {"index": index, "partitions": list(writefps), "error": str(e)},
+                )
+                if rangeinfo is not None:
+                    delete_range_files(key, rangeinfo)
+
+
+@tasks.task(priority=LOW_PRIORITY)
+def dedupe_partition(
+    cid: str,
+    listid: str,
+    keytype: str,
+    key: str,
+    partition: int,
+    partfiles: List[str],
+    used: List[str],
+    override: bool,
+    unsub: bool,
+    skipvalidation: bool,
+    gatherid: str,
+) -> None:
+    with open_db() as db:
+        try:
+            # ranges are read in file order so the first occurrence of an email wins
+            rows = []
+            emails = set()
+            for filename in partfiles:
+                with s3_read_stream(os.environ["s3_transferbucket"], filename) as fp:
+                    for email, props in msgpack.Unpacker(fp, strict_map_key=False):
+                        if email not in emails:
+                            emails.add(email)
+                            rows.append((email, props))
+
+            if keytype == "list" and len(rows):
+                domains = set(email.split("@")[1] for email, _ in rows)
+                excluded = set(
+                    item
+                    for (item,) in db.execute(
+                        "select item from exclusions where cid = %s and item = any(%s)",
+                        cid,
+                        list(emails | domains),
+                    )
+                )
+                if len(excluded):
+                    rows = [
+                        (email, props)
+                        for email, props in rows
+                        if email not in excluded and email.split("@")[1] not in excluded
+                    ]
+
+            files: List[str] = []
+            for i in range(0, len(rows), CONTACTS_PER_BLOCK):
+                filename = f"{key}.dedupe.{partition:03d}.{len(files):05d}"
+                with s3_open_write(
+                    os.environ["s3_transferbucket"], filename
+                ) as writefp:
+                    for row in rows[i : i + CONTACTS_PER_BLOCK]:
+                        msgpack.pack(row, writefp)
+                files.append(filename)
+
+            for filename in partfiles:
+                s3_delete(os.environ["s3_transferbucket"], filename)
+
+            partinfo = gather_complete(db, gatherid, {"files": files})
+            if partinfo is not None:
+                allfiles = sorted(f for info in partinfo for f in info["files"])
+                if not len(allfiles):
+                    import_finished(db, keytype, listid)
+                    return
 
-            if len(files):
-                tmpid = gather_init(db, "write_block", len(files))
+                tmpid = gather_init(db, "write_block", len(allfiles))
 
-                for filename in files:
+                for filename in allfiles:
                     run_task(
                         write_block,
                         cid,
@@ -1936,37 +2249,14 @@ def dedupe_blocks(
                         tmpid,
                         listid,
                         keytype,
-                        list(used),
+                        used,
                         skipvalidation,
                         override,
                         unsub,
                     )
-            else:
-                if keytype == "supp":
-                    db.supplists.patch(
-                        listid, {"processing": "", "processing_error": ""}
-                    )
-                elif keytype == "list":
-                    db.lists.patch(listid, {"processing": "", "processing_error": ""})
-            s3_delete(os.environ["s3_transferbucket"], key)
         except Exception as e:
             log.exception("error")
-            if keytype == "supp":
-                db.supplists.patch(
-                    listid,
-                    {
-                        "processing": "",
-                        "processing_error": "Importing data failed: %s" % str(e),
-                    },
-                )
-            elif keytype == "list":
-                db.lists.patch(
-                    listid,
-                    {
-                        "processing": "",
-                        "processing_error": "Importing data failed: %s" % str(e),
-                    },
-                )
+            import_failed(db, keytype, listid, e)
 
 
 def add_blocks(
@@ -1997,27 +2287,18 @@ def list_remove_bucket(
 
             sentrows = get_segment_sentrows(db, cid, campaignids, hashval, hashlimit)
 
-            rows = get_segment_rows(db, cid, hashval, listfactors, hashlimit)
-
-            cache = Cache()
-
-            found = set()
-            segcounts: Dict[str, int] = {}
-            numrows = len(rows)
-            for row in rows:
-                if segment_eval_parts(
-                    segment["parts"],
-                    segment["operator"],
-                    row,
-                    segcounts,
-                    numrows,
-                    segments,
-                    sentrows,
-                    segment,
-                    hashlimit,
-                    cache,
-                ):
-                    found.add(row["Email"][0])
+            rows = get_segment_rows(
+                db,
+                cid,
+                hashval,
+                listfactors,
+                hashlimit,
+                where=segment_sql_filter(cid, [segment], segments, listfactors),
+            )
+
+            pred = segment_compile(segment, segments, hashlimit)
+            state = EvalState(sentrows, len(rows), ActivityLogs(rows))
+            found = set(row["Email"][0] for row in rows if pred(row, state))
 
             remove_list_contacts(db, cid, listid, list(found))
         except:
@@ -2041,27 +2322,18 @@ def tag_bucket(
 
             sentrows = get_segment_sentrows(db, cid, campaignids, hashval, hashlimit)
 
-            rows = get_segment_rows(db, cid, hashval, listfactors, hashlimit)
-
-            cache = Cache()
-
-            found = set()
-            segcounts: Dict[str, int] = {}
-            numrows = len(rows)
-            for row in rows:
-                if segment_eval_parts(
-                    segment["parts"],
-                    segment["operator"],
-                    row,
-                    segcounts,
-                    numrows,
-                    segments,
-                    sentrows,
-                    segment,
-                    hashlimit,
-                    cache,
-                ):
-                    found.add(row["Email"][0])
+            rows = get_segment_rows(
+                db,
+                cid,
+                hashval,
+                listfactors,
+                hashlimit,
+                where=segment_sql_filter(cid, [segment], segments, listfactors),
+            )
+
+            pred = segment_compile(segment, segments, hashlimit)
+            state = EvalState(sentrows, len(rows), ActivityLogs(rows))
+            found = set(row["Email"][0] for row in rows if pred(row, state))
 
             update_tags(db, cid, list(found), tags, webhook_msgs)
 
@@ -2112,13 +2384,17 @@ def remove_tag_all_bucket(cid: str, hashval: int, hashlimit: int, tag: str) -> N
 
             if not webhook_count:
                 db.execute(
-                    f"""
+                    log_changes_sql(
+                        f"""
                     delete from contacts."contact_values_{cid}"
                     where type = 'tag' and value = %s
                     and ({hashlimit} = 1 or mod(contact_id, {hashlimit}) = %s)
-                """,
+                    returning contact_id
+                """
+                    ),
                     tag,
                     hashval,
+                    cid,
                 )
             else:
                 for (email,) in db.execute(
@@ -2128,6 +2404,10 @@ def remove_tag_all_bucket(cid: str, hashval: int, hashlimit: int, tag: str) -> N
                         where type = 'tag' and value = %s
                         and ({hashlimit} = 1 or mod(contact_id, {hashlimit}) = %s)
                         returning contact_id
+                    ), changed as (
+                        insert into contact_changes (cid, contact_id)
+                        select distinct %s, contact_id from d
+                        on conflict (cid, contact_id) do nothing
                     )
                     select c.email from contacts."contacts_{cid}" c
                     join d on d.contact_id = c.contact_id
@@ -2135,6 +2415,8 @@ def remove_tag_all_bucket(cid: str, hashval: int, hashlimit: int, tag: str) -> N
                 """,
                     tag,
                     hashval,
+                    cid,
+                    hashval,
                 ):
                     webhook_msgs.append(
                         {
@@ -2145,6 +2427,8 @@ def remove_tag_all_bucket(cid: str, hashval: int, hashlimit: int, tag: str) -> N
                         }
                     )
 
+            bump_contacts_version(db, cid)
+
             if len(webhook_msgs):
                 send_webhooks(db, cid, webhook_msgs)
         except:
@@ -2157,108 +2441,182 @@ def remove_tag_all(db: DB, cid: str, tag: str) -> None:
         run_task(remove_tag_all_bucket, cid, hashval, hashlimit, tag)
 
 
-REHASH_LOCK = 164287603
+# Rebucketing a company is serialized with a redis lock rather than an
+# advisory lock: the indexes are built concurrently outside of a transaction,
+# so that the tables stay writable meanwhile, and a session lock can't be held
+# across statements through pgbouncer.  The builds and drops themselves run on
+# a direct connection, where the statement timeout can be lifted safely.
+REHASH_LOCK_EXPIRE = 6 * 60 * 60
+
+CONTACT_TABLES = (
+    "contacts",
+    "contact_lists",
+    "contact_supplists",
+    "contact_values",
+    "contact_open_logs",
+    "contact_click_logs",
+    "contact_send_logs",
+)
 
 
-def recalculate_hashlimit(db: DB, cid: str) -> None:
-    db.execute(f"select pg_advisory_xact_lock({REHASH_LOCK})")
+def rehash_lock(cid: str) -> Any:
+    return redis_connect().lock("rehash-%s" % cid, timeout=REHASH_LOCK_EXPIRE)
+
 
+def release_rehash_lock(lock: Any) -> None:
     try:
-        # For stability, keep hashlimit fixed at the capped value.
-        desired_hashlimit = HASHLIMIT_CAP
+        lock.release()
+    except LockError:
+        log.warning("rehash lock %s expired before release", lock.name)
 
-        sz = db.single(
-            f"""
-            select pg_relation_size('contacts.' || quote_ident('contacts_{cid}')) +
-                    pg_relation_size('contacts.' || quote_ident('contact_lists_{cid}')) +
-                    pg_relation_size('contacts.' || quote_ident('contact_supplists_{cid}')) +
-                    pg_relation_size('contacts.' || quote_ident('contact_values_{cid}')) +
-                    pg_relation_size('contacts.' || quote_ident('contact_open_logs_{cid}')) +
-                    pg_relation_size('contacts.' || quote_ident('contact_click_logs_{cid}')) +
-                    pg_relation_size('contacts.' || quote_ident('contact_send_logs_{cid}'))
-        """
-        )
 
-        db_hashlimit = db.single(
-            "select hashlimit from contacts.contacts_hashlimit where cid = %s", cid
-        )
-        if db_hashlimit is not None and db_hashlimit >= desired_hashlimit:
-            return
+def recalculate_hashlimit(db: DB, cid: str) -> None:
+    run_task(rebucket_contacts, cid)
 
-        log.info(
-            "Contact storage size for %s is %s bytes, hashlimit has changed from %s to %s, reindexing...",
-            cid,
-            sz,
-            db_hashlimit,
-            desired_hashlimit,
-        )
 
-        if db_hashlimit is None:
-            db.execute(
-                "insert into contacts.contacts_hashlimit (cid, hashlimit) values (%s, %s)",
+@tasks.task(priority=LOW_PRIORITY)
+def rebucket_contacts(cid: str) -> None:
+    lock = rehash_lock(cid)
+    if not lock.acquire(blocking=False):
+        log.info("rebucket of %s already running", cid)
+        return
+
+    switched = None
+    try:
+        with open_db() as db:
+            sz = db.single(
+                "select "
+                + " + ".join(
+                    f"pg_relation_size('contacts.' || quote_ident('{table}_{cid}'))"
+                    for table in CONTACT_TABLES
+                )
+            )
+
+            db_hashlimit = db.single(
+                "select hashlimit from contacts.contacts_hashlimit where cid = %s", cid
+            )
+
+            desired_hashlimit = plan_hashlimit(sz)
+            # only shrink once the tenant is well under the current bucket
+            # count, so a tenant near a boundary doesn't flip back and forth
+            if (
+                db_hashlimit is not None
+                and desired_hashlimit < db_hashlimit < desired_hashlimit * 4
+            ):
+                desired_hashlimit = db_hashlimit
+            if desired_hashlimit == db_hashlimit:
+                return
+
+            log.info(
+                "Contact storage size for %s is %s bytes, hashlimit has changed from %s to %s, reindexing...",
                 cid,
+                sz,
+                db_hashlimit,
                 desired_hashlimit,
             )
-        else:
+
+            if desired_hashlimit > 1:
+                with direct_cursor() as cur:
+                    cur.execute("set statement_timeout = 0")
+                    for table in CONTACT_TABLES:
+                        index = f"{table}_{cid}_hash{desired_hashlimit}_idx"
+                        cur.execute(
+                            """select i.indisvalid from pg_index i
+                               join pg_class c on c.oid = i.indexrelid
+                               join pg_namespace n on n.oid = c.relnamespace
+                               where n.nspname = 'contacts' and c.relname = %s""",
+                            (index,),
+                        )
+                        row = cur.fetchone()
+                        if row is not None and row[0]:
+                            continue
+                        if row is not None:
+                            # left behind by an interrupted concurrent build
+                            cur.execute(f'drop index concurrently contacts."{index}"')
+                        cur.execute(
+                            f"""create index concurrently "{index}" on contacts."{table}_{cid}" ((mod(contact_id, {desired_hashlimit})))"""
+                        )
+
             db.execute(
-                "update contacts.contacts_hashlimit set hashlimit = %s where cid = %s",
-                desired_hashlimit,
+                """insert into contacts.contacts_hashlimit (cid, hashlimit) values (%s, %s)
+                   on conflict (cid) do update set hashlimit = excluded.hashlimit""",
                 cid,
+                desired_hashlimit,
             )
+            switched = time.time()
 
-        db.execute(
-            f"""
-            set lock_timeout = '1000000s';
-            set statement_timeout = '1000000s';
-
-            drop index if exists contacts."contacts_{cid}_hash_idx_old";
-            drop index if exists contacts."contact_lists_{cid}_hash_idx_old";
-            drop index if exists contacts."contact_supplists_{cid}_hash_idx_old";
-            drop index if exists contacts."contact_values_{cid}_hash_idx_old";
-            drop index if exists contacts."contact_open_logs_{cid}_hash_idx_old";
-            drop index if exists contacts."contact_click_logs_{cid}_hash_idx_old";
-            drop index if exists contacts."contact_send_logs_{cid}_hash_idx_old";
-
-            alter index if exists contacts."contacts_{cid}_hash_idx" rename to "contacts_{cid}_hash_idx_old";
-            alter index if exists contacts."contact_lists_{cid}_hash_idx" rename to "contact_lists_{cid}_hash_idx_old";
-            alter index if exists contacts."contact_supplists_{cid}_hash_idx" rename to "contact_supplists_{cid}_hash_idx_old";
-            alter index if exists contacts."contact_values_{cid}_hash_idx" rename to "contact_values_{cid}_hash_idx_old";
-            alter index if exists contacts."contact_open_logs_{cid}_hash_idx" rename to "contact_open_logs_{cid}_hash_idx_old";
-            alter index if exists contacts."contact_click_logs_{cid}_hash_idx" rename to "contact_click_logs_{cid}_hash_idx_old";
-            alter index if exists contacts."contact_send_logs_{cid}_hash_idx" rename to "contact_send_logs_{cid}_hash_idx_old";
-        """
+            log.info("..complete")
+    except:
+        log.exception("error")
+    finally:
+        release_rehash_lock(lock)
+
+    if switched is not None:
+        run_task(drop_hash_indexes, cid, desired_hashlimit, switched, 0)
+
+
+# Gathers fanned out over the old bucket count when rebucket_contacts switches
+# to a new one still need its indexes, so they are dropped in a later pass
+# once none of the company's gathers started before the switch is running.
+# After REBUCKET_DROP_ATTEMPTS checks the indexes are dropped regardless; any
+# task still using them then scans its bucket without an index.
+REBUCKET_DROP_DELAY = 10 * 60
+REBUCKET_DROP_ATTEMPTS = 36
+
+
+@tasks.task(priority=LOW_PRIORITY)
+def drop_hash_indexes(cid: str, hashlimit: int, switched: float, attempt: int) -> None:
+    if attempt < REBUCKET_DROP_ATTEMPTS and gathers_running(cid, switched):
+        run_task_delay(
+            drop_hash_indexes,
+            REBUCKET_DROP_DELAY,
+            cid,
+            hashlimit,
+            switched,
+            attempt + 1,
         )
-        if hashlimit > 1:
-            log.info("Creating indexes")
-            db.execute(
-                f"""
-                create index "contacts_{cid}_hash_idx" on contacts."contacts_{cid}" ((mod(contact_id, {hashlimit})));
-                create index "contact_lists_{cid}_hash_idx" on contacts."contact_lists_{cid}" ((mod(contact_id, {hashlimit})));
-                create index "contact_supplists_{cid}_hash_idx" on contacts."contact_supplists_{cid}" ((mod(contact_id, {hashlimit})));
-                create index "contact_values_{cid}_hash_idx" on contacts."contact_values_{cid}" ((mod(contact_id, {hashlimit})));
-                create index "contact_open_logs_{cid}_hash_idx" on contacts."contact_open_logs_{cid}" ((mod(contact_id, {hashlimit})));
-                create index "contact_click_logs_{cid}_hash_idx" on contacts."contact_click_logs_{cid}" ((mod(contact_id, {hashlimit})));
-                create index "contact_send_logs_{cid}_hash_idx" on contacts."contact_send_logs_{cid}" ((mod(contact_id, {hashlimit})));
-            """
-            )
-            log.info("Clustering tables")
-            db.execute(
-                f"""
-                cluster contacts."contacts_{cid}" using "contacts_{cid}_hash_idx";
-                cluster contacts."contact_lists_{cid}" using "contact_lists_{cid}_hash_idx";
-                cluster contacts."contact_supplists_{cid}" using "contact_supplists_{cid}_hash_idx";
-                cluster contacts."contact_values_{cid}" using "contact_values_{cid}_hash_idx";
-                cluster contacts."contact_open_logs_{cid}" using "contact_open_logs_{cid}_hash_idx";
-                cluster contacts."contact_click_logs_{cid}" using "contact_click_logs_{cid}_hash_idx";
-                cluster contacts."contact_send_logs_{cid}" using "contact_send_logs_{cid}_hash_idx";
-            """
-            )
+        return
 
-        log.info("..complete")
-    except Exception as e:
+    lock = rehash_lock(cid)
+    if not lock.acquire(blocking=False):
+        # a rebucket is running; it schedules its own drop when done
+        run_task_delay(
+            drop_hash_indexes,
+            REBUCKET_DROP_DELAY,
+            cid,
+            hashlimit,
+            switched,
+            attempt,
+        )
+        return
+
+    try:
+        with open_db() as db:
+            # a later switch drops these along with its own predecessor's
+            if hashlimit != db.single(
+                "select hashlimit from contacts.contacts_hashlimit where cid = %s", cid
+            ):
+                return
+
+            indexes = [
+                index
+                for index, in db.execute(
+                    """select indexname from pg_indexes
+                       where schemaname = 'contacts' and tablename = any(%s)
+                       and indexdef like '%%(mod(contact_id,%%'""",
+                    [f"{table}_{cid}" for table in CONTACT_TABLES],
+                )
+                if not index.endswith(f"_{cid}_hash{hashlimit}_idx")
+            ]
+        if indexes:
+            with direct_cursor() as cur:
+                cur.execute("set statement_timeout = 0")
+                for index in indexes:
+                    cur.execute(f'drop index concurrently contacts."{index}"')
+    except:
         log.exception("error")
-        if "deadlock detected" not in str(e):
-            raise
+    finally:
+        release_rehash_lock(lock)
 
 
 def initialize_cid(db: DB, cid: str) -> None:
@@ -2315,19 +2673,10 @@ def initialize_cid(db: DB, cid: str) -> None:
             unique (contact_id, campid)
         ) inherits (contacts.contact_send_logs);
         create index "contact_send_logs_{cid}_campid_idx" on contacts."contact_send_logs_{cid}" (campid);
-        -- Create hash indexes at the capped hashlimit for new tenants.
-        create index "contacts_{cid}_hash_idx" on contacts."contacts_{cid}" ((mod(contact_id, {HASHLIMIT_CAP})));
-        create index "contact_lists_{cid}_hash_idx" on contacts."contact_lists_{cid}" ((mod(contact_id, {HASHLIMIT_CAP})));
-        create index "contact_supplists_{cid}_hash_idx" on contacts."contact_supplists_{cid}" ((mod(contact_id, {HASHLIMIT_CAP})));
-        create index "contact_values_{cid}_hash_idx" on contacts."contact_values_{cid}" ((mod(contact_id, {HASHLIMIT_CAP})));
-        create index "contact_open_logs_{cid}_hash_idx" on contacts."contact_open_logs_{cid}" ((mod(contact_id, {HASHLIMIT_CAP})));
-        create index "contact_click_logs_{cid}_hash_idx" on contacts."contact_click_logs_{cid}" ((mod(contact_id, {HASHLIMIT_CAP})));
-        create index "contact_send_logs_{cid}_hash_idx" on contacts."contact_send_logs_{cid}" ((mod(contact_id, {HASHLIMIT_CAP})));
-        insert into contacts.contacts_hashlimit (cid, hashlimit) values (%s, %s) on conflict (cid) do nothing;
-    """
-        ,
+        -- new tenants start in a single bucket, see rebucket_contacts
+        insert into contacts.contacts_hashlimit (cid, hashlimit) values (%s, 1) on conflict (cid) do nothing;
+    """,
         cid,
-        HASHLIMIT_CAP,
     )
 
 
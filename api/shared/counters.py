@@ -0,0 +1,143 @@
+import os
+import random
+from typing import Dict, Iterable, List, Tuple
+from .db import DB, JsonObj, open_db
+from .log import get_logger
+
+log = get_logger()
+
+# Send and event counters of campaigns and funnel messages (delivered, opened,
+# clicks per link, ...) are incremented in narrow counter tables instead of in
+# the campaign document, which every event would otherwise rewrite under the
+# same row lock.  Each write lands in one of COUNTER_SLOTS rows per counter,
+# picked at random, so concurrent writers rarely wait on each other.
+# fold_counters moves the totals into the documents every minute, and the
+# campaign endpoints add what hasn't been folded yet.
+COUNTER_SLOTS = int(os.environ.get("counter_slots", "8"))
+
+LINKCLICKS = "linkclicks"
+
+# campaigns and funnel messages keep counters in tables with the same layout,
+# prefixed "campaign" or "message"
+_counter_tables = {True: ("campaign", "campaigns"), False: ("message", "messages")}
+
+# (campaign or message id, counter, link index or -1, count)
+CounterRow = Tuple[str, str, int, int]
+
+
+def incr_counter_rows(db: DB, is_camp: bool, rows: Iterable[CounterRow]) -> None:
+    totals: Dict[Tuple[str, str, int], int] = {}
+    for id, counter, linkindex, n in rows:
+        if n:
+            key = (id, counter, linkindex)
+            totals[key] = totals.get(key, 0) + n
+    if not totals:
+        return
+
+    p = _counter_tables[is_camp][0]
+    slot = random.randrange(COUNTER_SLOTS)
+    db.execute_values(
+        f"""insert into {p}_counters ({p}_id, counter, linkindex, slot, count) values %s
+              on conflict ({p}_id, counter, linkindex, slot) do update set
+              count = {p}_counters.count + excluded.count""",
+        [(*key, slot, n) for key, n in sorted(totals.items())],
+    )
+
+
+def incr_counters(db: DB, is_camp: bool, id: str, counts: Dict[str, int]) -> None:
+    incr_counter_rows(db, is_camp, ((id, c, -1, n) for c, n in counts.items()))
+
+
+def reset_linkclicks(db: DB, is_camp: bool, id: str) -> None:
+    """Drops unfolded link clicks of a campaign or message whose links were
+    just replaced, along with its linkclicks array."""
+    p = _counter_tables[is_camp][0]
+    db.execute(
+        f"delete from {p}_counters where {p}_id = %s and linkindex >= 0",
+        id,
+    )
+
+
+def pending_counters(db: DB, is_camp: bool, ids: List[str]) -> Dict[str, JsonObj]:
+    pending: Dict[str, JsonObj] = {}
+    if not ids:
+        return pending
+
+    p = _counter_tables[is_camp][0]
+    for id, counter, linkindex, n in db.execute(
+        f"""select {p}_id, counter, linkindex, sum(count)::bigint from {p}_counters
+              where {p}_id = any(%s) group by 1, 2, 3""",
+        ids,
+    ):
+        counts = pending.setdefault(id, {})
+        if linkindex >= 0:
+            counts.setdefault(LINKCLICKS, {})[linkindex] = n
+        else:
+            counts[counter] = n
+    return pending
+
+
+def merge_counters(db: DB, is_camp: bool, docs: List[JsonObj]) -> None:
+    """Adds counts that haven't been folded yet to campaign or message
+    documents read from the database."""
+    pending = pending_counters(db, is_camp, [doc["id"] for doc in docs])
+    for doc in docs:
+        counts = pending.get(doc["id"])
+        if counts is None:
+            continue
+        for counter, n in counts.items():
+            if counter == LINKCLICKS:
+                linkclicks = doc.get(LINKCLICKS)
+                if isinstance(linkclicks, list):
+                    for linkindex, clicks in n.items():
+                        if linkindex < len(linkclicks):
+                            linkclicks[linkindex] = (
+                                linkclicks[linkindex] or 0
+                            ) + clicks
+            else:
+                doc[counter] = (doc.get(counter) or 0) + n
+
+
+def fold_counters() -> None:
+    with open_db() as db:
+        for is_camp in (True, False):
+            p, table = _counter_tables[is_camp]
+            with db.transaction():
+                props: Dict[str, Dict[str, int]] = {}
+                links: Dict[str, Dict[str, int]] = {}
+                for id, counter, linkindex, n in db.execute(
+                    f"""delete from {p}_counters
+                          returning {p}_id, counter, linkindex, count"""
+                ):
+                    if linkindex >= 0:
+                        d = links.setdefault(id, {})
+                        key = str(linkindex)
+                    else:
+                        d = props.setdefault(id, {})
+                        key = counter
+                    d[key] = d.get(key, 0) + n
+
+                if props:
+                    db.execute_values(
+                        f"""update {table} set data = {table}.data || (
+                                select jsonb_object_agg(d.key, coalesce(({table}.data->>d.key)::bigint, 0) + d.value::bigint)
+                                from jsonb_each_text(v.delta) d)
+                              from (values %s) as v (id, delta) where {table}.id = v.id""",
+                        sorted(props.items()),
+                        template="(%s, %s::jsonb)",
+                    )
+                if links:
+                    db.execute_values(
+                        f"""update {table} set data = jsonb_set({table}.data, '{{linkclicks}}', (
+                                select jsonb_agg(coalesce(e.value::bigint, 0) + coalesce((v.delta->>(e.i - 1)::text)::bigint, 0) order by e.i)
+                                from jsonb_array_elements_text({table}.data->'linkclicks') with ordinality e (value, i)))
+                              from (values %s) as v (id, delta)
+                              where {table}.id = v.id and jsonb_typeof({table}.data->'linkclicks') = 'array'
+                              and jsonb_array_length({table}.data->'linkclicks') > 0""",
+                        sorted(links.items()),
+                        template="(%s, %s::jsonb)",
+                    )
+                if props or links:
+                    log.info(
+                        "folded counters of %s %s", len(set(props) | set(links)), table
+                    )
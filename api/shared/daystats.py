@@ -0,0 +1,170 @@
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Tuple
+from .db import DB
+
+# hourstats rows are also summed per day into daystats, without the ip and
+# campaign, and per campaign into campdaystats, by the same writers that
+# update hourstats.  Dashboards read whole days from these and only go to
+# hourstats for the hours of a day that fall in a different bucket than the
+# rest of it, which they subtract from the day's total (see stat_buckets).
+DAYSTATS_COLUMNS = (
+    "complaint",
+    "unsub",
+    "open",
+    "click",
+    "send",
+    "soft",
+    "hard",
+    "err",
+    "defercnt",
+)
+CAMPDAYSTATS_COLUMNS = ("open", "send")
+
+HOUR = timedelta(hours=1)
+
+# (cid, campcid, hour, sinkid, domaingroupid, settingsid, campid, counts)
+HourStatRow = Tuple[str, str, datetime, str, str, str, str, Dict[str, int]]
+
+
+def _upsert(
+    db: DB,
+    table: str,
+    keycols: Tuple[str, ...],
+    cols: Tuple[str, ...],
+    totals: Dict[Tuple[Any, ...], List[int]],
+) -> None:
+    if not totals:
+        return
+    db.execute_values(
+        f"""insert into {table} ({", ".join(keycols + cols)}) values %s
+              on conflict ({", ".join(keycols)}) do update set
+              {", ".join(f"{c} = {table}.{c} + excluded.{c}" for c in cols)}""",
+        [(*key, *counts) for key, counts in sorted(totals.items())],
+    )
+
+
+def incr_daystats(db: DB, rows: Iterable[HourStatRow]) -> None:
+    """Adds the increments just written to hourstats to the daily rollups."""
+    days: Dict[Tuple[Any, ...], List[int]] = {}
+    camps: Dict[Tuple[Any, ...], List[int]] = {}
+    for cid, campcid, ts, sinkid, domain, settingsid, campid, counts in rows:
+        day = ts.date()
+
+        key: Tuple[Any, ...] = (cid, day, sinkid, domain, settingsid)
+        totals = days.setdefault(key, [0] * len(DAYSTATS_COLUMNS))
+        for i, c in enumerate(DAYSTATS_COLUMNS):
+            totals[i] += counts.get(c, 0)
+
+        if any(counts.get(c, 0) for c in CAMPDAYSTATS_COLUMNS):
+            totals = camps.setdefault(
+                (campcid, day, campid), [0] * len(CAMPDAYSTATS_COLUMNS)
+            )
+            for i, c in enumerate(CAMPDAYSTATS_COLUMNS):
+                totals[i] += counts.get(c, 0)
+
+    _upsert(
+        db,
+        "daystats",
+        ("cid", "day", "sinkid", "domaingroupid", "settingsid"),
+        DAYSTATS_COLUMNS,
+        days,
+    )
+    _upsert(
+        db, "campdaystats", ("campcid", "day", "campid"), CAMPDAYSTATS_COLUMNS, camps
+    )
+
+
+def stat_buckets(
+    db: DB,
+    rollup: str,
+    boundaries: List[datetime],
+    start: datetime,
+    sums: str,
+    source: str,
+    where: str,
+    *args: Any,
+    inclusive: bool = False,
+) -> Dict[int, List[int]]:
+    """Returns the same sums as grouping hourstats by width_bucket(ts,
+    boundaries) after start (or from it, if inclusive), dropping the bucket
+    past the last boundary, but reads whole days from the rollup table.
+
+    sums, source and where are SQL with {table} standing for hourstats or
+    the rollup, which must have the columns they use, and args are the
+    parameters of where."""
+
+    now = datetime.utcnow()
+
+    first = start.replace(minute=0, second=0, microsecond=0)
+    if first < start or not inclusive:
+        first += HOUR
+    hours: Dict[date, Dict[datetime, int]] = {}
+    ts = first
+    while ts < boundaries[-1] and ts <= now:
+        hours.setdefault(ts.date(), {})[ts] = bisect_right(boundaries, ts)
+        ts += HOUR
+    if not hours:
+        return {}
+
+    # A day is read from the rollup when that takes fewer hourstats lookups:
+    # the rollup total goes to the bucket most of its hours are in, less the
+    # hours of the day which aren't, and those are added to their own buckets.
+    rollupdays: Dict[date, int] = {}
+    rawhours: List[datetime] = []
+    for day, dayhours in hours.items():
+        counts: Dict[int, int] = {}
+        for bucket in dayhours.values():
+            counts[bucket] = counts.get(bucket, 0) + 1
+        bucket = max(counts, key=lambda b: counts[b])
+
+        midnight = datetime(day.year, day.month, day.day)
+        others = [
+            ts
+            for ts in (midnight + HOUR * h for h in range(24))
+            if ts <= now and dayhours.get(ts) != bucket
+        ]
+        if len(others) < len(dayhours):
+            rollupdays[day] = bucket
+            rawhours.extend(others)
+        else:
+            rawhours.extend(dayhours)
+
+    rsums, rsource, rwhere = (
+        q.replace("{table}", rollup) for q in (sums, source, where)
+    )
+    hsums, hsource, hwhere = (
+        q.replace("{table}", "hourstats") for q in (sums, source, where)
+    )
+    results: Dict[int, List[int]] = {}
+
+    def add(bucket: int, vals: Tuple[Any, ...], sign: int) -> None:
+        totals = results.setdefault(bucket, [0] * len(vals))
+        for i, v in enumerate(vals):
+            totals[i] += sign * int(v or 0)
+
+    for israw, ts, *vals in db.execute(
+        f"""select false, {rollup}.day::timestamp, {rsums}
+              from {rsource}
+              where {rwhere} and {rollup}.day = any(%s::date[])
+              group by {rollup}.day
+            union all
+            select true, hourstats.ts, {hsums}
+              from {hsource}
+              where {hwhere} and hourstats.ts = any(%s::timestamp[])
+              group by hourstats.ts""",
+        *args,
+        list(rollupdays),
+        *args,
+        rawhours,
+    ):
+        day = ts.date()
+        if not israw:
+            add(rollupdays[day], tuple(vals), 1)
+            continue
+        if day in rollupdays:
+            add(rollupdays[day], tuple(vals), -1)
+        if ts in hours[day]:
+            add(hours[day][ts], tuple(vals), 1)
+
+    return results
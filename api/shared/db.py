@@ -1,10 +1,16 @@
 import psycopg2
-import psycopg2.pool
 import psycopg2.extras
 import psycopg2.extensions
 import shortuuid
 import os
+import json
+import time
+import bisect
+import socket
+import threading
 from typing import (
+    IO,
+    Callable,
     Dict,
     Iterator,
     Generator,
@@ -363,7 +369,280 @@ class JSONWrapper(object):
             return self.conn.execute(q, id).rowcount
 
 
-_pools = {}
+# Connections are pooled per process.  The pool is bounded so that a burst of
+# tasks can't open more connections than postgres allows; callers wait up to
+# DB_POOL_TIMEOUT seconds for one to be returned.
+DB_POOL_SIZE = int(os.environ.get("db_pool_size", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("db_pool_timeout", "30"))
+# connections are closed after this many checkouts
+DB_POOL_RECYCLE = int(os.environ.get("db_pool_recycle", "1000"))
+# connections idle longer than this are checked before they are handed out
+DB_POOL_IDLE_CHECK = float(os.environ.get("db_pool_idle_check", "30"))
+# how often each process writes its pool counters to redis
+DB_POOL_PUBLISH_INTERVAL = 15
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+
+    def __init__(
+        self,
+        dsn: str,
+        maxsize: int = DB_POOL_SIZE,
+        timeout: float = DB_POOL_TIMEOUT,
+        recycle: int = DB_POOL_RECYCLE,
+        idle_check: float = DB_POOL_IDLE_CHECK,
+    ) -> None:
+        self.dsn = dsn
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.recycle = recycle
+        self.idle_check = idle_check
+        self.cond = threading.Condition()
+        # idle connections with their use count and when they were returned
+        self.idle: List[Tuple[psycopg2.extensions.connection, int, float]] = []
+        self.inuse: Dict[psycopg2.extensions.connection, int] = {}
+        self.size = 0
+        self.waiting = 0
+        self.created = 0
+        self.closed = 0
+        self.timeouts = 0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_sum = 0.0
+        self.wait_count = 0
+        self.published = 0.0
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def _close(self, conn: psycopg2.extensions.connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _valid(self, conn: psycopg2.extensions.connection, since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - since < self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1")
+            return True
+        except Exception:
+            return False
+
+    def _record_wait(self, waited: float) -> None:
+        self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS, waited)] += 1
+        self.wait_sum += waited
+        self.wait_count += 1
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            conn = None
+            with self.cond:
+                while not self.idle and self.size >= self.maxsize:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(
+                            "Timed out waiting for a database connection (%s in use)"
+                            % self.size
+                        )
+                    self.waiting += 1
+                    try:
+                        self.cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+                if self.idle:
+                    conn, uses, since = self.idle.pop()
+                else:
+                    self.size += 1
+                    uses, since = 0, time.monotonic()
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except:
+                    with self.cond:
+                        self.size -= 1
+                        self.cond.notify()
+                    raise
+                with self.cond:
+                    self.created += 1
+            elif not self._valid(conn, since):
+                self._close(conn)
+                with self.cond:
+                    self.size -= 1
+                    self.closed += 1
+                    self.cond.notify()
+                continue
+
+            with self.cond:
+                self.inuse[conn] = uses + 1
+                self._record_wait(time.monotonic() - start)
+            return conn
+
+    def putconn(self, conn: psycopg2.extensions.connection) -> None:
+        with self.cond:
+            uses = self.inuse.pop(conn, None)
+        if uses is None:
+            return
+
+        keep = not conn.closed and uses < self.recycle
+        if keep:
+            try:
+                if (
+                    conn.get_transaction_status()
+                    != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                ):
+                    conn.rollback()
+                if not conn.autocommit:
+                    conn.autocommit = True
+            except Exception:
+                keep = False
+        if not keep:
+            self._close(conn)
+
+        with self.cond:
+            if keep:
+                self.idle.append((conn, uses, time.monotonic()))
+            else:
+                self.size -= 1
+                self.closed += 1
+            self.cond.notify()
+
+        if time.monotonic() - self.published >= DB_POOL_PUBLISH_INTERVAL:
+            self.publish()
+
+    def closeall(self) -> None:
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.closed += len(idle)
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> JsonObj:
+        with self.cond:
+            return {
+                "size": self.size,
+                "maxsize": self.maxsize,
+                "idle": len(self.idle),
+                "checked_out": len(self.inuse),
+                "waiting": self.waiting,
+                "created": self.created,
+                "closed": self.closed,
+                "timeouts": self.timeouts,
+                "wait_buckets": list(self.wait_buckets),
+                "wait_sum": self.wait_sum,
+                "wait_count": self.wait_count,
+            }
+
+    def publish(self) -> None:
+        from .utils import redis_connect
+
+        self.published = time.monotonic()
+        try:
+            redis_connect().set(
+                "dbpoolstats-%s-%s" % (socket.gethostname(), os.getpid()),
+                json.dumps(self.stats()),
+                ex=DB_POOL_PUBLISH_INTERVAL * 4,
+            )
+        except Exception:
+            log.exception("error publishing pool stats")
+
+
+_pools: Dict[int, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    pid = os.getpid()
+    pool = _pools.get(pid)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(pid)
+            if pool is None:
+                pool = _pools[pid] = ConnectionPool(os.environ["postgres_conn"])
+    return pool
+
+
+@contextmanager
+def direct_cursor() -> Generator[psycopg2.extensions.cursor, None, None]:
+    """An autocommit cursor on a connection of its own, bypassing the pool and
+    pgbouncer, which runs in transaction mode and so can't be trusted with
+    session settings or statements that can't run in a transaction."""
+    conn = psycopg2.connect(
+        os.environ.get("postgres_direct_conn") or os.environ["postgres_conn"]
+    )
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            yield cur
+    finally:
+        conn.close()
+
+
+def pool_metrics() -> str:
+    """All processes' pool counters, as published to redis, in the prometheus
+    text format."""
+    from .utils import redis_connect
+
+    rdb = redis_connect()
+    procs = []
+    for key in rdb.scan_iter("dbpoolstats-*"):
+        data = rdb.get(key)
+        if data is not None:
+            procs.append((key.decode("utf-8")[len("dbpoolstats-") :], json.loads(data)))
+    procs.sort(key=lambda p: p[0])
+
+    lines = []
+    for name, field, kind in (
+        ("edcom_db_pool_connections", "size", "gauge"),
+        ("edcom_db_pool_max_connections", "maxsize", "gauge"),
+        ("edcom_db_pool_idle", "idle", "gauge"),
+        ("edcom_db_pool_checked_out", "checked_out", "gauge"),
+        ("edcom_db_pool_waiting", "waiting", "gauge"),
+        ("edcom_db_pool_created_total", "created", "counter"),
+        ("edcom_db_pool_closed_total", "closed", "counter"),
+        ("edcom_db_pool_timeouts_total", "timeouts", "counter"),
+    ):
+        lines.append("# TYPE %s %s" % (name, kind))
+        for proc, stats in procs:
+            lines.append('%s{process="%s"} %s' % (name, proc, stats[field]))
+
+    lines.append("# TYPE edcom_db_pool_wait_seconds histogram")
+    for proc, stats in procs:
+        total = 0
+        for le, cnt in zip(
+            [str(b) for b in WAIT_BUCKETS] + ["+Inf"], stats["wait_buckets"]
+        ):
+            total += cnt
+            lines.append(
+                'edcom_db_pool_wait_seconds_bucket{process="%s",le="%s"} %s'
+                % (proc, le, total)
+            )
+        lines.append(
+            'edcom_db_pool_wait_seconds_sum{process="%s"} %s'
+            % (proc, stats["wait_sum"])
+        )
+        lines.append(
+            'edcom_db_pool_wait_seconds_count{process="%s"} %s'
+            % (proc, stats["wait_count"])
+        )
+
+    return "\n".join(lines) + "\n"
 
 
 class DB(object):
@@ -373,22 +652,20 @@ class DB(object):
         self.cur: psycopg2.extensions.cursor | None = None
         self.conn = None
         self._trace = bool(os.environ.get("sql_trace", False))
-        pid = os.getpid()
-        if pid not in _pools:
-            _pools[pid] = psycopg2.pool.SimpleConnectionPool(
-                1, 50000, os.environ["postgres_conn"]
-            )
-        self.conn = _pools[pid].getconn()
-        self.conn.autocommit = True
+        self.pool = get_pool()
+        self.pid = os.getpid()
+        self.conn = self.pool.getconn()
         self.cur = self.conn.cursor()
+        self.oncommit: List[Callable[[], Any]] = []
 
     def close(self) -> None:
         if self.cur is not None:
             self.cur.close()
             self.cur = None
         if self.conn is not None:
-            pid = os.getpid()
-            _pools[pid].putconn(self.conn)
+            # a connection inherited across a fork is still the parent's
+            if os.getpid() == self.pid:
+                self.pool.putconn(self.conn)
             self.conn = None
 
     def __del__(self) -> None:
@@ -409,6 +686,14 @@ class DB(object):
         finally:
             self._trace = oldvalue
 
+    def on_commit(self, fn: Callable[[], Any]) -> None:
+        """Calls fn once the current transaction commits, or right away
+        outside of one.  It's dropped if the transaction rolls back."""
+        if self.conn is not None and not self.conn.autocommit:
+            self.oncommit.append(fn)
+        else:
+            fn()
+
     @contextmanager
     def transaction(self) -> Generator[None, None, None]:
         if self.cur is not None:
@@ -417,6 +702,7 @@ class DB(object):
         if self.conn is not None:
             self.conn.rollback()
             self.conn.autocommit = False
+        self.oncommit = []
         self.cur = self.conn.cursor()
         try:
             yield
@@ -432,6 +718,9 @@ class DB(object):
                 self.cur = None
             self.conn.autocommit = True
             self.cur = self.conn.cursor()
+            oncommit, self.oncommit = self.oncommit, []
+        for fn in oncommit:
+            fn()
 
     def __getattr__(self, name: str) -> JSONWrapper:
         return JSONWrapper(self, self.cid, name)
@@ -453,6 +742,60 @@ class DB(object):
             self.cur.execute(sql, dvals)
         return self.cur
 
+    def execute_values(
+        self,
+        sql: str,
+        argslist: List[Tuple[Any, ...]],
+        template: str | None = None,
+        page_size: int = 1000,
+    ) -> psycopg2.extensions.cursor:
+        if self.cur is None:
+            raise Exception("Database connection not open")
+
+        if self._trace:
+            log.info("%s (%s rows)", sql, len(argslist))
+        psycopg2.extras.execute_values(
+            self.cur, sql, argslist, template=template, page_size=page_size
+        )
+        return self.cur
+
+    def stream(
+        self, sql: str, *vals: Any, itersize: int = 2000, **dvals: Any
+    ) -> Generator[Tuple[Any, ...], None, None]:
+        """Iterates over the result of a query with a server side cursor,
+        fetching itersize rows at a time instead of the whole result.
+
+        Inside transaction() rows are produced as the query runs; outside
+        of one the cursor is declared WITH HOLD, so the server materializes
+        the result but the client still only holds itersize rows."""
+        if self.conn is None:
+            raise Exception("Database connection not open")
+
+        cur = self.conn.cursor(
+            name="stream_%s" % shortuuid.uuid(), withhold=self.conn.autocommit
+        )
+        cur.itersize = itersize
+        try:
+            if len(vals):
+                if self._trace:
+                    log.info(cur.mogrify(sql, vals).decode("utf-8"))
+                cur.execute(sql, vals)
+            else:
+                if self._trace:
+                    log.info(cur.mogrify(sql, dvals).decode("utf-8"))
+                cur.execute(sql, dvals)
+            yield from cur
+        finally:
+            cur.close()
+
+    def copy_expert(self, sql: str, fp: IO[str]) -> None:
+        if self.cur is None:
+            raise Exception("Database connection not open")
+
+        if self._trace:
+            log.info(sql)
+        self.cur.copy_expert(sql, fp)
+
     def single(self, sql: str, *vals: Any, **dvals: Any) -> Any:
         if self.cur is None:
             raise Exception("Database connection not open")
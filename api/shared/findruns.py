@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import heapq
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from typing import Any, Iterator, List, Tuple
+from .s3 import s3_write, s3_mmap
+from .utils import redis_connect
+from .db import JsonObj
+
+# A ListFind search is evaluated once: every bucket writes its matches to the
+# transfer bucket as a run of (sort key, email) entries in sort key order, and
+# each page after that is a k-way merge of the runs from the keyset offset,
+# so paging never rescans the contacts.  The search itself is kept in redis
+# for FIND_TTL seconds; cleanup removes runs older than that.
+FIND_TTL = int(os.environ.get("list_find_ttl", "1800"))
+
+_MAGIC = b"EDFIND01"
+
+# (sort key, email)
+FindEntry = Tuple[Any, str]
+
+
+def find_key(findid: str) -> str:
+    return "listfind-%s" % findid
+
+
+def save_find(findid: str, find: JsonObj) -> None:
+    redis_connect().set(find_key(findid), json.dumps(find), ex=FIND_TTL)
+
+
+def load_find(findid: str) -> JsonObj | None:
+    data = redis_connect().get(find_key(findid))
+    if data is None:
+        return None
+    find: JsonObj = json.loads(data)
+    return find
+
+
+def find_run_key(findid: str, hashval: int) -> str:
+    return "listfind/%s/%05d" % (findid, hashval)
+
+
+def write_find_run(findid: str, hashval: int, entries: List[FindEntry]) -> None:
+    """Writes entries, which must be sorted, as the run of one bucket."""
+    blobs = [json.dumps(e, separators=(",", ":")).encode("utf-8") for e in entries]
+    off = array("Q", [0])
+    for b in blobs:
+        off.append(off[-1] + len(b))
+
+    header = json.dumps({"created": time.time(), "count": len(entries)}).encode("utf-8")
+    header += b" " * (-(len(_MAGIC) + 4 + len(header)) % 8)
+
+    s3_write(
+        os.environ["s3_transferbucket"],
+        find_run_key(findid, hashval),
+        _MAGIC
+        + struct.pack("<I", len(header))
+        + header
+        + off.tobytes()
+        + b"".join(blobs),
+    )
+
+
+class FindRun(object):
+    """Memory maps a run and reads entries by index, so a keyset offset can
+    be found by binary search without decoding the whole run."""
+
+    def __init__(self, findid: str, hashval: int) -> None:
+        self.mm = s3_mmap(
+            os.environ["s3_transferbucket"], find_run_key(findid, hashval)
+        )
+        self.buf = memoryview(self.mm)
+        if bytes(self.buf[: len(_MAGIC)]) != _MAGIC:
+            raise ValueError("not a find run")
+        (headerlen,) = struct.unpack("<I", self.buf[len(_MAGIC) : len(_MAGIC) + 4])
+        start = len(_MAGIC) + 4
+        header = json.loads(bytes(self.buf[start : start + headerlen]))
+        start += headerlen
+        self.count: int = header["count"]
+        self.off = self.buf[start : start + 8 * (self.count + 1)].cast("Q")
+        self.blobstart = start + 8 * (self.count + 1)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> FindEntry:
+        key, email = json.loads(
+            bytes(
+                self.buf[
+                    self.blobstart + self.off[i] : self.blobstart + self.off[i + 1]
+                ]
+            )
+        )
+        return key, email
+
+    def close(self) -> None:
+        self.off.release()
+        self.buf.release()
+        self.mm.close()
+
+
+def _entries(
+    run: FindRun, hashval: int, lo: int, hi: int, reverse: bool
+) -> Iterator[Tuple[Any, str, int]]:
+    for i in range(hi - 1, lo - 1, -1) if reverse else range(lo, hi):
+        key, email = run[i]
+        yield key, email, hashval
+
+
+def find_page(
+    runs: List[FindRun],
+    before: Any | None,
+    after: Any | None,
+    desc: bool,
+    pagesize: int,
+) -> Tuple[List[Tuple[Any, str, int]], int]:
+    """Returns the (sort key, email, bucket) entries of a page in display
+    order, and how many entries are before the page (for after) or after it
+    (for before), matching the has_previous/has_next rules of ListFind."""
+    ranges = []
+    for run in runs:
+        lo, hi = 0, len(run)
+        if before is not None:
+            hi = bisect_left(run, before, key=lambda e: e[0])
+        elif after is not None:
+            lo = bisect_right(run, after, key=lambda e: e[0])
+        ranges.append((lo, hi))
+
+    # the page is the low end of the matching entries when paging forward
+    # in ascending order or backward in descending order, else the high end
+    fromlow = (before is None) != desc
+    merged = heapq.merge(
+        *(
+            _entries(run, hashval, lo, hi, not fromlow)
+            for hashval, (run, (lo, hi)) in enumerate(zip(runs, ranges))
+        ),
+        reverse=not fromlow,
+    )
+    page = list(islice(merged, pagesize))
+    if fromlow == desc:
+        page.reverse()
+
+    return page, sum(hi - lo for lo, hi in ranges)
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import struct
+import threading
+import numpy as np
+import numpy.typing as npt
+from typing import Any, Dict, List, Tuple, TypeAlias, cast
+from .s3 import s3_write, s3_mmap, s3_list, s3_delete
+from .utils import LRUCache, redis_connect, run_task
+from .db import DB, open_db
+from .tasks import tasks, LOW_PRIORITY
+from .log import get_logger
+
+log = get_logger()
+
+# iplocations is copied into a file in the data bucket holding sorted arrays
+# of range starts and ends, which every process memory maps and searches
+# instead of querying the table for each tracked event.  The file is keyed by
+# a signature of the table, so reloading the ip database starts a rebuild;
+# lookups fall back to the table until the new file is written.
+GEOLOC_CHECK_INTERVAL = 300
+GEOLOC_CACHE_SIZE = 100000
+GEOLOC_BUILD_LOCK_EXPIRE = 60 * 30
+
+_MAGIC = b"EDGEOL01"
+_PREFIX = "geoloc/"
+
+# country_code, country, region, zip
+GeoLocation: TypeAlias = Tuple[str, str, str, str]
+
+
+class GeoIndex(object):
+
+    def __init__(self, buf: memoryview) -> None:
+        if bytes(buf[: len(_MAGIC)]) != _MAGIC:
+            raise ValueError("not a geolocation index")
+        (headerlen,) = struct.unpack("<I", buf[len(_MAGIC) : len(_MAGIC) + 4])
+        start = len(_MAGIC) + 4
+        header = json.loads(bytes(buf[start : start + headerlen]))
+        start += headerlen
+
+        def col(name: str) -> npt.NDArray[Any]:
+            dtype, offset, count = header["columns"][name]
+            return np.frombuffer(buf, dtype=dtype, count=count, offset=start + offset)
+
+        self.starts = col("starts")
+        self.ends = col("ends")
+        self.locs = col("locs")
+        self.locoffsets = col("locoffsets")
+        self.locdata = col("locdata")
+
+    def lookup(self, ipnum: int) -> GeoLocation | None:
+        i = int(np.searchsorted(self.starts, ipnum, side="right")) - 1
+        if i < 0 or ipnum >= self.ends[i]:
+            return None
+        loc = self.locs[i]
+        data = self.locdata[self.locoffsets[loc] : self.locoffsets[loc + 1]]
+        return cast(GeoLocation, tuple(data.tobytes().decode("utf-8").split("\t")))
+
+
+def geoloc_signature(db: DB) -> str | None:
+    row = db.row(
+        """select c.oid, c.relfilenode,
+                  coalesce(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0)
+           from pg_class c
+           left join pg_stat_user_tables s on s.relid = c.oid
+           where c.oid = to_regclass('public.iplocations')"""
+    )
+    if row is None:
+        return None
+    return "%s-%s-%s" % row
+
+
+def geoloc_key(signature: str) -> str:
+    return "%siplocations-%s" % (_PREFIX, signature)
+
+
+def _encode(db: DB) -> bytes:
+    starts = []
+    ends = []
+    locs = []
+    locindex: Dict[str, int] = {}
+    for start, end, countrycode, country, region, zp in db.stream(
+        """select lower(iprange), upper(iprange), country_code, country, region, zip
+           from iplocations order by lower(iprange)""",
+        itersize=10000,
+    ):
+        loc = "\t".join((countrycode, country, region, zp))
+        i = locindex.get(loc)
+        if i is None:
+            i = locindex[loc] = len(locindex)
+        starts.append(start)
+        ends.append(end)
+        locs.append(i)
+
+    locdata = [loc.encode("utf-8") for loc in locindex]
+    locoffsets = np.zeros(len(locdata) + 1, dtype="<u4")
+    np.cumsum([len(d) for d in locdata], out=locoffsets[1:])
+
+    columns: List[Tuple[str, npt.NDArray[Any]]] = [
+        ("starts", np.array(starts, dtype="<i8")),
+        ("ends", np.array(ends, dtype="<i8")),
+        ("locs", np.array(locs, dtype="<u4")),
+        ("locoffsets", locoffsets),
+        ("locdata", np.frombuffer(b"".join(locdata), dtype="u1")),
+    ]
+
+    body = bytearray()
+    layout = {}
+    for name, arr in columns:
+        layout[name] = (arr.dtype.str, len(body), len(arr))
+        body += arr.tobytes()
+        body += b"\0" * (-len(body) % 8)
+
+    header = json.dumps({"created": time.time(), "columns": layout}).encode("utf-8")
+    header += b" " * (-(len(_MAGIC) + 4 + len(header)) % 8)
+
+    return _MAGIC + struct.pack("<I", len(header)) + header + bytes(body)
+
+
+@tasks.task(priority=LOW_PRIORITY)
+def build_geoloc_index(signature: str) -> None:
+    rdb = redis_connect()
+    lockkey = "geolocbuild-%s" % signature
+    if not rdb.set(lockkey, 1, nx=True, ex=GEOLOC_BUILD_LOCK_EXPIRE):
+        return
+    try:
+        with open_db() as db:
+            with db.transaction():
+                if geoloc_signature(db) != signature:
+                    return
+                data = _encode(db)
+
+        bucket = os.environ["s3_databucket"]
+        key = geoloc_key(signature)
+        s3_write(bucket, key, data)
+        for obj in s3_list(bucket, _PREFIX):
+            if obj.key != key:
+                try:
+                    s3_delete(bucket, obj.key)
+                except FileNotFoundError:
+                    pass
+        log.info("built ip location index %s (%s bytes)", key, len(data))
+    except:
+        log.exception("error")
+    finally:
+        rdb.delete(lockkey)
+
+
+_lock = threading.Lock()
+_index: GeoIndex | None = None
+_signature: str | None = None
+_checked = 0.0
+_cache = LRUCache(GEOLOC_CACHE_SIZE)
+
+
+def _load(db: DB) -> GeoIndex | None:
+    global _index, _signature, _checked
+
+    with _lock:
+        if _checked > time.monotonic() - GEOLOC_CHECK_INTERVAL:
+            return _index
+        _checked = time.monotonic()
+
+        signature = geoloc_signature(db)
+        if signature is None:
+            _index, _signature = None, None
+            return None
+        if signature == _signature:
+            return _index
+
+        try:
+            mm = s3_mmap(os.environ["s3_databucket"], geoloc_key(signature))
+        except FileNotFoundError:
+            # keep using the current index, if any, until the rebuild lands
+            run_task(build_geoloc_index, signature)
+            return _index
+        try:
+            _index = GeoIndex(memoryview(mm))
+        except Exception:
+            log.exception("error loading ip location index")
+            return _index
+        _signature = signature
+        _cache.clear()
+        return _index
+
+
+def lookup_ip(db: DB, ipnum: int) -> GeoLocation | None:
+    index = _load(db)
+    if index is None:
+        row = db.row(
+            "select country_code, country, region, zip from iplocations where iprange @> (%s)::bigint limit 1",
+            ipnum,
+        )
+        return cast(GeoLocation | None, row)
+
+    missing = object()
+    loc = _cache.get(ipnum, missing)
+    if loc is missing:
+        loc = index.lookup(ipnum)
+        _cache.put(ipnum, loc)
+    return cast(GeoLocation | None, loc)
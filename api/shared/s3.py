@@ -1,5 +1,6 @@
 import os
 import glob
+import mmap
 import stat
 import shutil
 import tempfile
@@ -101,6 +102,11 @@ def s3_read_stream(bucket: str, key: str) -> BufferedReader:
     return open(os.path.join(bucket, key), "rb")
 
 
+def s3_mmap(bucket: str, key: str) -> mmap.mmap:
+    with open(os.path.join(bucket, key), "rb") as fp:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 def s3_copy(frombucket: str, fromkey: str, tobucket: str, tokey: str) -> None:
     frompath = os.path.join(frombucket, fromkey)
     topath = os.path.join(tobucket, tokey)
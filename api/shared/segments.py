@@ -1,19 +1,50 @@
+import re
+import json
+import fnmatch as fnmatch_module
 import hashlib
 import dateutil.parser
 import shortuuid
+import numpy as np
+import numpy.typing as npt
 import os
-from typing import TypeAlias, Tuple, Dict, Any, List, Set, cast, Sequence
+from typing import (
+    TypeAlias,
+    Tuple,
+    Dict,
+    Any,
+    List,
+    Set,
+    cast,
+    Sequence,
+    Callable,
+    Iterable,
+    Iterator,
+)
 from fnmatch import fnmatch
 from datetime import datetime, timedelta
 from dateutil.tz import tzutc
 from .utils import djb2, md5re, unix_time_secs
 from .log import get_logger
 from .db import DB, JsonObj
+from .snapshots import (
+    SNAPSHOT_TTL,
+    contacts_version,
+    snapshot_key,
+    read_snapshot,
+    write_snapshot,
+)
 
 log = get_logger()
 
-# Cap hashlimit to prevent runaway task fan-out; locally defined to avoid circular imports.
-HASHLIMIT_CAP = int(os.environ.get("hashlimit_max", "128"))
+# Contacts are split into hash buckets of roughly HASH_BUCKET_SIZE bytes of
+# contact storage each, a power of two of them up to HASHLIMIT_MAX, so small
+# tenants fan out to few tasks and large ones keep each task's rows bounded.
+HASH_BUCKET_SIZE = int(os.environ.get("hash_bucket_size", str(32 * 1024 * 1024)))
+HASHLIMIT_MAX = int(os.environ.get("hashlimit_max", "1024"))
+# companies without a planned bucket count, from before contacts_hashlimit was
+# kept for all of them, were bucketed and indexed for this many
+HASHLIMIT_CAP = min(128, HASHLIMIT_MAX)
+
 
 class Cache:
 
@@ -32,6 +63,13 @@ def trace(cache: Cache, msg: str, *args: Any) -> None:
         log.info(msg, *args, stacklevel=2)
 
 
+def plan_hashlimit(size: int) -> int:
+    hashlimit = 1
+    while hashlimit < HASHLIMIT_MAX and size > hashlimit * HASH_BUCKET_SIZE:
+        hashlimit *= 2
+    return min(hashlimit, HASHLIMIT_MAX)
+
+
 def get_hashlimit(db: DB, cid: str, lists: List[JsonObj] | None = None) -> int:
     if lists is not None:
         count = sum(lst.get("count", 0) for lst in lists)
@@ -39,14 +77,16 @@ def get_hashlimit(db: DB, cid: str, lists: List[JsonObj] | None = None) -> int:
         if count <= 10000:
             return 1
 
+    # the bucket count planned by rebucket_contacts, which the hash indexes
+    # are built for
     hashlimit = db.single(
         "select hashlimit from contacts.contacts_hashlimit where cid = %s", cid
     )
 
     if hashlimit is None:
-        hashlimit = HASHLIMIT_CAP
+        return HASHLIMIT_CAP
 
-    return cast(int, min(hashlimit, HASHLIMIT_CAP))
+    return cast(int, hashlimit)
 
 
 def segment_get_segmentids(parts: List[JsonObj], newids: Set[str]) -> None:
@@ -197,6 +237,255 @@ def tag_set(row: JsonObj) -> JsonObj:
     return row
 
 
+# Segment rules that map directly onto the contact tables are translated into a
+# SQL condition on contacts."contacts_{cid}" c so get_segment_rows only builds
+# rows for contacts that can possibly match.  Each translation is (sql, args,
+# exact): inexact conditions are a superset of the matching contacts and can be
+# and-ed or or-ed but never negated; anything we can't express becomes "true".
+# The Python evaluator still runs over the candidates, so the filter only has to
+# be a necessary condition.
+
+SqlCond: TypeAlias = Tuple[str, List[Any], bool]
+
+_SQL_ANY: SqlCond = ("true", [], False)
+_SQL_TRUE: SqlCond = ("true", [], True)
+_SQL_FALSE: SqlCond = ("false", [], True)
+
+
+def _sql_and(conds: List[SqlCond]) -> SqlCond:
+    exact = all(e for _, _, e in conds)
+    if any(c == _SQL_FALSE for c in conds):
+        return _SQL_FALSE
+    conds = [c for c in conds if c[0] != "true"]
+    if not len(conds):
+        return "true", [], exact
+    args: List[Any] = []
+    for _, a, _ in conds:
+        args.extend(a)
+    return " and ".join(f"({sql})" for sql, _, _ in conds), args, exact
+
+
+def _sql_or(conds: List[SqlCond]) -> SqlCond:
+    if _SQL_TRUE in conds:
+        return _SQL_TRUE
+    exact = all(e for _, _, e in conds)
+    if any(sql == "true" for sql, _, _ in conds):
+        return _SQL_ANY
+    conds = [c for c in conds if c[0] != "false"]
+    if not len(conds):
+        return "false", [], exact
+    args: List[Any] = []
+    for _, a, _ in conds:
+        args.extend(a)
+    return " or ".join(f"({sql})" for sql, _, _ in conds), args, exact
+
+
+def _sql_not(cond: SqlCond) -> SqlCond:
+    sql, args, exact = cond
+    if not exact:
+        return _SQL_ANY
+    if sql == "true":
+        return _SQL_FALSE
+    if sql == "false":
+        return _SQL_TRUE
+    return f"not ({sql})", args, True
+
+
+def _sql_part(
+    cid: str,
+    part: JsonObj,
+    segments: Dict[str, JsonObj | None],
+    listfactors: List[str],
+    visiting: Set[str],
+) -> SqlCond:
+    t = part["type"]
+    if t == "Group":
+        return _sql_parts(
+            cid, part["parts"], part["operator"], segments, listfactors, visiting
+        )
+    elif t == "Info":
+        test = part.get("test")
+        if not test:
+            prop = part["prop"]
+            op = part["operator"]
+            rightval = part["value"].strip().lower()
+            if op not in _info_ops or prop.startswith("!") and prop != "!!*":
+                return _SQL_FALSE
+            if op in ("notequals", "notcontains") or prop == "!!*" or not rightval:
+                return _SQL_ANY
+            # python strips and lowercases each value before comparing, so the
+            # only safe pushdown for every operator is a substring test
+            if prop == "Email":
+                return "position(%s in lower(c.email)) > 0", [rightval], False
+            elif prop == "Domain":
+                return (
+                    "position(%s in lower(split_part(c.email, '@', 2))) > 0",
+                    [rightval],
+                    False,
+                )
+            elif (
+                not rightval.isascii()
+                or not rightval.isprintable()
+                or '"' in rightval
+                or "\\" in rightval
+            ):
+                # these would not appear verbatim in the jsonb text
+                return _SQL_ANY
+            return (
+                "coalesce(position(%s in lower((c.props->%s)::text)) > 0, false)",
+                [rightval, prop],
+                False,
+            )
+        elif test == "added":
+            if part["addedtype"] == "inpast":
+                return "c.added > %s", [_inpast(part["addednum"])], True
+            return (
+                "c.added between %s and %s",
+                [_parse_start(part["addedstart"]), _parse_end(part["addedend"])],
+                True,
+            )
+        elif test in ("tag", "notag"):
+            cond: SqlCond = (
+                f"""exists (select 1 from contacts."contact_values_{cid}" v
+                    where v.contact_id = c.contact_id and v.type = 'tag'
+                    and %s = any(string_to_array(v.value, ',')))""",
+                [part["tag"].strip().lower()],
+                True,
+            )
+            if test == "notag":
+                return _sql_not(cond)
+            return cond
+        else:
+            return _SQL_FALSE
+    elif t == "Lists":
+        op = part["operator"]
+        if op in ("in", "notin"):
+            # !!list only holds the lists the rows were selected from
+            if part["list"] not in listfactors:
+                cond = _SQL_FALSE
+            else:
+                cond = (
+                    f"""exists (select 1 from contacts."contact_lists_{cid}" l
+                        where l.contact_id = c.contact_id and l.list_id = %s)""",
+                    [part["list"]],
+                    True,
+                )
+            if op == "notin":
+                return _sql_not(cond)
+            return cond
+
+        segid = part["segment"]
+        segment = segments.get(segid, None)
+        if segment is None:
+            return _SQL_FALSE if op == "insegment" else _SQL_TRUE
+        if segid in visiting:
+            return _SQL_ANY
+        visiting.add(segid)
+        cond = _sql_parts(
+            cid, segment["parts"], segment["operator"], segments, listfactors, visiting
+        )
+        visiting.remove(segid)
+        if op == "notinsegment":
+            return _sql_not(cond)
+        return cond
+    elif t == "Responses":
+        action = part["action"]
+        if action == "from":
+            fromtype = part["fromtype"]
+            if fromtype not in ("device", "os", "browser", "country", "region"):
+                return _SQL_ANY
+            value: int | str = part["from" + fromtype]
+            if fromtype in ("device", "os", "browser"):
+                value = str(int(value))
+            return (
+                f"""exists (select 1 from contacts."contact_values_{cid}" v
+                    where v.contact_id = c.contact_id and v.type = '{fromtype}'
+                    and v.value = %s)""",
+                [value],
+                True,
+            )
+        elif action in ("sent", "notsent"):
+            campaign = (
+                part.get("broadcast")
+                or part.get("defaultbroadcast")
+                or part["campaign"]
+                or part["defaultcampaign"]
+            )
+            if not campaign:
+                return _SQL_TRUE if action == "notsent" else _SQL_FALSE
+            cond = (
+                f"""exists (select 1 from contacts."contact_send_logs_{cid}" s
+                    where s.contact_id = c.contact_id and s.campid = %s)""",
+                [campaign],
+                True,
+            )
+            if action == "notsent":
+                return _sql_not(cond)
+            return cond
+        return _SQL_ANY
+    else:
+        return _SQL_FALSE
+
+
+def _sql_parts(
+    cid: str,
+    parts: List[JsonObj],
+    operator: str,
+    segments: Dict[str, JsonObj | None],
+    listfactors: List[str],
+    visiting: Set[str],
+) -> SqlCond:
+    conds = []
+    for part in parts:
+        conds.append(_sql_part(cid, part, segments, listfactors, visiting))
+        for addl in part.get("addl", ()):
+            conds.append(_sql_part(cid, addl, segments, listfactors, visiting))
+
+    if operator == "or":
+        return _sql_or(conds)
+    elif operator == "and":
+        return _sql_and(conds)
+    else:
+        return _sql_not(_sql_or(conds))
+
+
+def segment_sql_filter(
+    cid: str,
+    segmentlist: List[JsonObj],
+    segments: Dict[str, JsonObj | None],
+    listfactors: List[str],
+) -> Tuple[str, List[Any]] | None:
+    """Return a SQL condition on contacts c that every contact matching any of
+    segmentlist satisfies, for get_segment_rows(where=...), or None when the
+    segments can't be narrowed down.
+
+    Subsets depend on every row in the bucket (their counters, numrows and
+    !!added_index), so segments using them anywhere are never filtered."""
+
+    for seg in list(segmentlist) + list(segments.values()):
+        if seg is not None and seg.get("subset"):
+            return None
+
+    conds = []
+    for segment in segmentlist:
+        visiting = {segment["id"]} if "id" in segment else set()
+        conds.append(
+            _sql_parts(
+                cid,
+                segment["parts"],
+                segment["operator"],
+                segments,
+                listfactors,
+                visiting,
+            )
+        )
+
+    sql, args, _ = _sql_or(conds)
+    if sql == "true":
+        return None
+    return sql, args
+
+
 def get_segment_rows(
     db: DB,
     cid: str,
@@ -204,15 +493,60 @@ def get_segment_rows(
     listfactors: List[str],
     hashlimit: int,
     rowset: Set[str] | None = None,
+    where: Tuple[str, List[Any]] | None = None,
+    contact_ids: List[int] | None = None,
+    snapshot: bool = False,
 ) -> List[JsonObj]:
     ret = []
 
+    # snapshots are for counts and listings: an unfiltered scan of the whole
+    # bucket is cached and reused until the next committed contact write.
+    # Sends and bulk changes leave snapshot off so they always read the tables.
+    snapkey = None
+    if (
+        snapshot
+        and rowset is None
+        and where is None
+        and contact_ids is None
+        and SNAPSHOT_TTL > 0
+    ):
+        version = contacts_version(cid)
+        snapkey = snapshot_key(cid, hashval, hashlimit, listfactors, version)
+        snaprows = read_snapshot(snapkey)
+        if snaprows is not None:
+            return snaprows
+
+    # contact_ids limits the rows, and the logs they are built from, to a
+    # handful of contacts, which isn't worth a snapshot of the whole bucket
+    if contact_ids is not None:
+        if where is None:
+            where = ("c.contact_id = any(%s)", [contact_ids])
+        else:
+            where = (
+                f"({where[0]}) and c.contact_id = any(%s)",
+                [*where[1], contact_ids],
+            )
+
     rowsetexpr = ""
     rowsetargs = []
     if rowset is not None:
         rowsetexpr = "and c.email = any(%s)"
         rowsetargs = [list(rowset)]
 
+    whereexpr = ""
+    wheresubexpr = ""
+    whereargs: List[Any] = []
+    wheresubargs: List[Any] = []
+    if where is not None:
+        wheresql, whereargs = where
+        whereexpr = f"and ({wheresql})"
+        wheresubexpr = f"""and c.contact_id in (
+                select c.contact_id from contacts."contacts_{cid}" c
+                where ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
+                and ({wheresql})
+            )"""
+        wheresubargs = [hashval, *whereargs]
+
     alternate_plan = os.environ.get("alternate_contact_plan")
 
     ret = [
@@ -234,6 +568,7 @@ def get_segment_rows(
             where l.list_id = any(%s)
             and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
             {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
+            {wheresubexpr}
             group by c.contact_id
         ),
         open_logs as (
@@ -245,6 +580,7 @@ def get_segment_rows(
             where l.list_id = any(%s)
             and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
             {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
+            {wheresubexpr}
             group by c.contact_id
         ),
         click_logs as (
@@ -256,6 +592,7 @@ def get_segment_rows(
             where l.list_id = any(%s)
             and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
             {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
+            {wheresubexpr}
             group by c.contact_id
         )
         select c.props ||
@@ -283,21 +620,26 @@ def get_segment_rows(
         where l.list_id = any(%s)
         and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
         {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
+        {whereexpr}
         {rowsetexpr}
         group by c.email, c.added, c.props, op.open_logs, cl.click_logs, op.max_open_ts, cl.max_click_ts, v.tags, v.device, v.os, v.browser, v.country, v.region, v.zip
     """,
             listfactors,
             hashval,
             hashval,
+            *wheresubargs,
             listfactors,
             hashval,
             hashval,
+            *wheresubargs,
             listfactors,
             hashval,
             hashval,
+            *wheresubargs,
             listfactors,
             hashval,
             hashval,
+            *whereargs,
             *rowsetargs,
         )
     ]
@@ -306,6 +648,9 @@ def get_segment_rows(
     # remain consistent
     ret.sort(key=lambda r: djb2(r["Email"][0]))
 
+    if snapkey is not None and contacts_version(cid) == version:
+        write_snapshot(snapkey, ret)
+
     return ret
 
 
@@ -783,3 +1128,764 @@ def segment_eval_parts(
                 segcounts[sub["id"]] = segcounts.get(sub["id"], 0) + 1
             trace(cache, "hashval = %s, returning %s", hashval, retval)
             return retval
+
+
+# A compiled segment is a tree of closures built once per task from the segment
+# JSON, so that per-row evaluation no longer re-normalizes rule values, parses
+# dates or dispatches on the rule type.  Each compile function returns the
+# predicate along with a flag saying whether it (or anything below it) keeps
+# subset state; parts are only allowed to short-circuit when none of them do,
+# which keeps subset counts identical to segment_eval_parts.
+
+
+Mask: TypeAlias = npt.NDArray[np.bool_]
+
+
+class ActivityLogs:
+    """Open and click logs of a list of rows flattened into parallel arrays so
+    that activity rules can be evaluated for every row at once.  Arrays are
+    built on first use and masks are kept per compiled rule, so one instance
+    can be shared by all the segments evaluated over the same rows."""
+
+    def __init__(self, rows: List[JsonObj]) -> None:
+        self.rows = rows
+        self.built = False
+        self.masks: Dict[Any, Mask] = {}
+
+    def build(self) -> None:
+        codes: Dict[str, int] = {}
+        index: List[int] = []
+        ts: List[int] = []
+        camp: List[int] = []
+        link: List[int] = []
+        upd: List[int] = []
+        click: List[bool] = []
+        for i, row in enumerate(self.rows):
+            for t, campid in row.get("!!open-logs") or ():
+                index.append(i)
+                ts.append(t)
+                camp.append(codes.setdefault(campid, len(codes)))
+                link.append(-1)
+                upd.append(0)
+                click.append(False)
+            for t, (campid, linkindex, updatedts) in row.get("!!click-logs") or ():
+                index.append(i)
+                ts.append(t)
+                camp.append(codes.setdefault(campid, len(codes)))
+                link.append(linkindex)
+                upd.append(updatedts or 0)
+                click.append(True)
+
+        self.codes = codes
+        self.rowindex = {id(row): i for i, row in enumerate(self.rows)}
+        self.index = np.array(index, dtype=np.int64)
+        self.ts = np.array(ts, dtype=np.int64)
+        self.camp = np.array(camp, dtype=np.int64)
+        self.link = np.array(link, dtype=np.int64)
+        self.upd = np.array(upd, dtype=np.int64)
+        self.click = np.array(click, dtype=np.bool_)
+        self.built = True
+
+    def mask(self, key: Any, func: Callable[["ActivityLogs"], Mask]) -> Mask:
+        mask = self.masks.get(key)
+        if mask is None:
+            if not self.built:
+                self.build()
+            mask = self.masks[key] = func(self)
+        return mask
+
+
+class EvalState:
+
+    def __init__(
+        self, sentrows: SentRows, numrows: int, logs: ActivityLogs | None = None
+    ) -> None:
+        self.sentrows = sentrows
+        self.numrows = numrows
+        self.segcounts: Dict[str, int] = {}
+        self.logs = logs
+
+
+Predicate: TypeAlias = Callable[[JsonObj, EvalState], bool]
+Compiled: TypeAlias = Tuple[Predicate, bool]
+
+
+def _const(value: bool) -> Predicate:
+    def pred(row: JsonObj, state: EvalState) -> bool:
+        return value
+
+    return pred
+
+
+def _epoch_secs(dt: datetime) -> float:
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def _parse_start(s: str) -> float:
+    return _epoch_secs(
+        dateutil.parser.parse(s).astimezone(tzutc()).replace(tzinfo=None)
+    )
+
+
+def _parse_end(s: str) -> float:
+    return _epoch_secs(
+        dateutil.parser.parse(s).astimezone(tzutc()).replace(tzinfo=None)
+        + timedelta(days=1)
+        - timedelta(seconds=1)
+    )
+
+
+def _inpast(days: int) -> float:
+    return _epoch_secs(datetime.utcnow() - timedelta(days=days))
+
+
+_info_ops: Dict[str, Callable[[str, str], bool]] = {
+    "equals": lambda l, r: l == r,
+    "notequals": lambda l, r: l != r,
+    "contains": lambda l, r: r in l,
+    "notcontains": lambda l, r: r not in l,
+    "startswith": lambda l, r: l.startswith(r),
+    "endswith": lambda l, r: l.endswith(r),
+}
+
+
+def _compile_info(part: JsonObj) -> Predicate:
+    test = part.get("test")
+    if not test:
+        prop = part["prop"]
+        rightval = part["value"].strip().lower()
+        op = _info_ops.get(part["operator"])
+
+        if op is None or prop.startswith("!") and prop != "!!*":
+            return _const(False)
+
+        def match(left: Iterable[str]) -> bool:
+            for leftval in left:
+                if op(leftval.strip().lower(), rightval):
+                    return True
+            return False
+
+        if prop == "!!*":
+
+            def info_any(row: JsonObj, state: EvalState) -> bool:
+                left = [
+                    val[0]
+                    for key, val in row.items()
+                    if not key.startswith("!") and len(val)
+                ]
+                left.extend(row.get("!!tags", ()))
+                return match(left)
+
+            return info_any
+        elif prop == "Domain":
+
+            def info_domain(row: JsonObj, state: EvalState) -> bool:
+                return match((row["Email"][0].split("@")[1],))
+
+            return info_domain
+        else:
+
+            def info_prop(row: JsonObj, state: EvalState) -> bool:
+                return match(row.get(prop, ("",)))
+
+            return info_prop
+    elif test == "added":
+        if part["addedtype"] == "inpast":
+            threshold = _inpast(part["addednum"])
+
+            def added_inpast(row: JsonObj, state: EvalState) -> bool:
+                for ts in row.get("!!added") or ():
+                    if ts > threshold:
+                        return True
+                return False
+
+            return added_inpast
+        else:
+            start = _parse_start(part["addedstart"])
+            end = _parse_end(part["addedend"])
+
+            def added_between(row: JsonObj, state: EvalState) -> bool:
+                for ts in row.get("!!added") or ():
+                    if start <= ts <= end:
+                        return True
+                return False
+
+            return added_between
+    elif test in ("tag", "notag"):
+        tag = part["tag"].strip().lower()
+        want: bool = test == "tag"
+
+        def has_tag(row: JsonObj, state: EvalState) -> bool:
+            for leftval in row.get("!!tags", ()):
+                if leftval and tag in leftval.split(","):
+                    return want
+            return not want
+
+        return has_tag
+    else:
+        return _const(False)
+
+
+def _compile_from(part: JsonObj) -> Predicate:
+    fromtype = part["fromtype"]
+    if fromtype in ("device", "os", "browser", "country", "region"):
+        prop = "!!" + fromtype
+        value: int | str = part["from" + fromtype]
+        if fromtype in ("device", "os", "browser"):
+            value = int(value)
+
+        def from_value(row: JsonObj, state: EvalState) -> bool:
+            vals = row.get(prop)
+            if not vals:
+                return False
+            return value in vals
+
+        return from_value
+    else:
+        if not part["fromzip"]:
+            return _const(False)
+        zipmatch = re.compile(fnmatch_module.translate(part["fromzip"])).match
+
+        def from_zip(row: JsonObj, state: EvalState) -> bool:
+            for z in row.get("!!zip") or ():
+                if zipmatch(z):
+                    return True
+            return False
+
+        return from_zip
+
+
+def _compile_sent(part: JsonObj) -> Predicate:
+    action = part["action"]
+    campaign = (
+        part.get("broadcast")
+        or part.get("defaultbroadcast")
+        or part["campaign"]
+        or part["defaultcampaign"]
+    )
+    if not campaign:
+        return _const(action != "sent")
+    want: bool = action == "sent"
+
+    def sent(row: JsonObj, state: EvalState) -> bool:
+        return (row["Email"][0] in state.sentrows.get(campaign, ())) == want
+
+    return sent
+
+
+def _compile_activity(part: JsonObj) -> Predicate:
+    action: str = part["action"]
+
+    if "openclick" in action:
+        props: Tuple[str, ...] = ("!!open-logs", "!!click-logs")
+    elif "open" in action:
+        props = ("!!open-logs",)
+    else:
+        props = ("!!click-logs",)
+
+    timetype = part["timetype"]
+    lo: float | None = None
+    hi: float | None = None
+    if timetype == "inpast":
+        lo = _inpast(part["timenum"])
+    elif timetype != "anytime":
+        lo = _parse_start(part["timestart"])
+        hi = _parse_end(part["timeend"])
+
+    iscnt = action.endswith("cnt")
+    campaign = part.get("broadcast") or part.get("campaign", "")
+    filtercamp = campaign if campaign and not iscnt else None
+
+    linkindex = part.get("linkindex", -1)
+    updatedts = part.get("updatedts", None)
+    if updatedts is not None:
+        updatedts = unix_time_secs(dateutil.parser.parse(updatedts, ignoretz=True))
+    checklinks = (
+        action in ("clicked", "openclicked") and linkindex >= 0 and bool(campaign)
+    )
+    propchecks = [(prop, checklinks and "click" in prop) for prop in props]
+
+    def matches(row: JsonObj) -> Iterator[str]:
+        for prop, checkprop in propchecks:
+            if prop not in row:
+                continue
+            for ts, campid in row[prop]:
+                rowlinkindex, rowupdatedts = None, None
+                if isinstance(campid, (tuple, list)):
+                    campid, rowlinkindex, rowupdatedts = campid
+                if filtercamp is not None and filtercamp != campid:
+                    continue
+                if checkprop and (
+                    linkindex != rowlinkindex or updatedts != rowupdatedts
+                ):
+                    continue
+                if lo is not None and ts < lo:
+                    continue
+                if hi is not None and ts > hi:
+                    continue
+                yield campid
+
+    def selected(logs: ActivityLogs) -> Mask:
+        sel: Mask
+        if len(props) == 2:
+            sel = np.ones(len(logs.ts), dtype=np.bool_)
+        elif props[0] == "!!click-logs":
+            sel = logs.click.copy()
+        else:
+            sel = ~logs.click
+        if filtercamp is not None:
+            code = logs.codes.get(filtercamp)
+            if code is None:
+                sel[:] = False
+            else:
+                sel &= logs.camp == code
+        if checklinks:
+            sel &= ~logs.click | (
+                (logs.link == linkindex) & (logs.upd == (updatedts or 0))
+            )
+        if lo is not None:
+            sel &= logs.ts >= lo
+        if hi is not None:
+            sel &= logs.ts <= hi
+        return sel
+
+    def vector_hits(logs: ActivityLogs) -> Mask:
+        sel = selected(logs)
+        return np.bincount(logs.index[sel], minlength=len(logs.rows)) > 0
+
+    def vector_counts(logs: ActivityLogs) -> npt.NDArray[np.int64]:
+        sel = selected(logs)
+        # count each (row, campaign) pair once
+        pairs = np.unique(logs.index[sel] * (len(logs.codes) + 1) + logs.camp[sel])
+        return np.bincount(pairs // (len(logs.codes) + 1), minlength=len(logs.rows))
+
+    def vector_lookup(
+        row: JsonObj, state: EvalState, key: Any, func: Callable[[ActivityLogs], Mask]
+    ) -> bool | None:
+        logs = state.logs
+        if logs is None:
+            return None
+        mask = logs.mask(key, func)
+        i = logs.rowindex.get(id(row))
+        if i is None:
+            return None
+        return bool(mask[i])
+
+    if iscnt:
+        cntop: str = part["cntoperator"]
+        cntval: int = part["cntvalue"]
+
+        def vector_cnt(logs: ActivityLogs) -> Mask:
+            counts = vector_counts(logs)
+            mask: Mask
+            if cntop == "more":
+                mask = counts > cntval
+            elif cntop == "equal":
+                mask = counts == cntval
+            else:
+                mask = counts < cntval
+            return mask
+
+        def activity_cnt(row: JsonObj, state: EvalState) -> bool:
+            hit = vector_lookup(row, state, activity_cnt, vector_cnt)
+            if hit is not None:
+                return hit
+            cnt = len(set(matches(row)))
+            if cntop == "more":
+                return cnt > cntval
+            elif cntop == "equal":
+                return cnt == cntval
+            else:
+                return cnt < cntval
+
+        return activity_cnt
+
+    negate = action.startswith("not")
+
+    def vector_activity(logs: ActivityLogs) -> Mask:
+        hits = vector_hits(logs)
+        return ~hits if negate else hits
+
+    def activity(row: JsonObj, state: EvalState) -> bool:
+        hit = vector_lookup(row, state, activity, vector_activity)
+        if hit is not None:
+            return hit
+        for _ in matches(row):
+            return not negate
+        return negate
+
+    return activity
+
+
+def _compile_part(
+    part: JsonObj,
+    segments: Dict[str, JsonObj | None],
+    hashlimit: int,
+    compiled: Dict[str, Compiled | None],
+    plan: "SegmentPlan | None" = None,
+) -> Compiled:
+    if plan is None:
+        return _compile_rule(part, segments, hashlimit, compiled, None)
+
+    key = plan.rule_key(part)
+    hit = plan.rules.get(key)
+    if hit is not None:
+        return hit
+    c = _compile_rule(part, segments, hashlimit, compiled, plan)
+    if not c[1]:
+        # sharing a closure also shares its activity masks; only rules that
+        # cost more than a memo lookup are memoized
+        if part["type"] in ("Group", "Responses"):
+            c = plan.memoize(key, c)
+        plan.rules[key] = c
+    return c
+
+
+def _compile_rule(
+    part: JsonObj,
+    segments: Dict[str, JsonObj | None],
+    hashlimit: int,
+    compiled: Dict[str, Compiled | None],
+    plan: "SegmentPlan | None",
+) -> Compiled:
+    t = part["type"]
+    if t == "Group":
+        return _compile_parts(
+            part["parts"], part["operator"], segments, None, hashlimit, compiled, plan
+        )
+    elif t == "Info":
+        return _compile_info(part), False
+    elif t == "Lists":
+        op = part["operator"]
+        if op in ("in", "notin"):
+            listid = part["list"]
+            want: bool = op == "in"
+
+            def in_list(row: JsonObj, state: EvalState) -> bool:
+                return (listid in row["!!list"]) == want
+
+            return in_list, False
+
+        segid = part["segment"]
+        segment = segments.get(segid, None)
+        if segment is None:
+            return _const(op != "insegment"), False
+        if segid not in compiled:
+            compiled[segid] = None
+            compiled[segid] = _compile_segment(
+                segment, segments, hashlimit, compiled, plan
+            )
+        sub = compiled[segid]
+        if sub is None:
+            raise Exception("Segment contains a circular reference")
+        subpred, stateful = sub
+        if op == "insegment":
+            return subpred, stateful
+
+        def not_in_segment(row: JsonObj, state: EvalState) -> bool:
+            return not subpred(row, state)
+
+        return not_in_segment, stateful
+    elif t == "Responses":
+        action = part["action"]
+        if action == "from":
+            return _compile_from(part), False
+        elif action in ("sent", "notsent"):
+            return _compile_sent(part), False
+        else:
+            return _compile_activity(part), False
+    else:
+        return _const(False), False
+
+
+def _compile_subset(pred: Predicate, sub: JsonObj, hashlimit: int) -> Predicate:
+    if "id" not in sub:
+        sub["id"] = shortuuid.uuid()
+    subid = sub["id"]
+
+    bycount = sub["subsettype"] == "count"
+    subsetsort = sub.get("subsetsort")
+    byadded = subsetsort in ("oldest", "newest")
+    newest = subsetsort == "newest"
+
+    if bycount and not byadded:
+        blockindex = round(sub["subsetnum"] / hashlimit)
+
+        def subset_count(row: JsonObj, state: EvalState) -> bool:
+            if not pred(row, state):
+                return False
+            index = state.segcounts.get(subid, 0)
+            if index < blockindex:
+                state.segcounts[subid] = index + 1
+                return True
+            return False
+
+        return subset_count
+
+    if bycount:
+        basepct = sub["subsetnum"] / hashlimit
+    else:
+        basepct = sub["subsetpct"] / 100.0
+
+    def subset_pct(row: JsonObj, state: EvalState) -> bool:
+        if not pred(row, state):
+            return False
+        numrows = state.numrows
+        pct = basepct / numrows if bycount else basepct
+        retval: bool
+        if byadded:
+            index = row["!!added_index"][0]
+            if newest:
+                index = (numrows - 1) - index
+            retval = index / numrows <= pct
+        else:
+            retval = djb2(row["Email"][0]) <= 0xFFFFFFFF * pct
+        if retval:
+            state.segcounts[subid] = state.segcounts.get(subid, 0) + 1
+        return retval
+
+    return subset_pct
+
+
+def _compile_parts(
+    parts: List[JsonObj],
+    operator: str,
+    segments: Dict[str, JsonObj | None],
+    sub: JsonObj | None,
+    hashlimit: int,
+    compiled: Dict[str, Compiled | None],
+    plan: "SegmentPlan | None" = None,
+) -> Compiled:
+    children: List[Compiled] = []
+    for part in parts:
+        children.append(_compile_part(part, segments, hashlimit, compiled, plan))
+        for addl in part.get("addl", ()):
+            children.append(_compile_part(addl, segments, hashlimit, compiled, plan))
+
+    preds = [pred for pred, _ in children]
+    stateful = any(s for _, s in children)
+
+    pred: Predicate
+    if len(preds) == 1 and operator in ("or", "and"):
+        pred = preds[0]
+    elif stateful:
+        # every part must run so that nested subset counters advance
+        if operator == "or":
+
+            def pred(row: JsonObj, state: EvalState) -> bool:
+                return any([p(row, state) for p in preds])
+
+        elif operator == "and":
+
+            def pred(row: JsonObj, state: EvalState) -> bool:
+                return all([p(row, state) for p in preds])
+
+        else:
+
+            def pred(row: JsonObj, state: EvalState) -> bool:
+                return not any([p(row, state) for p in preds])
+
+    else:
+        if operator == "or":
+
+            def pred(row: JsonObj, state: EvalState) -> bool:
+                for p in preds:
+                    if p(row, state):
+                        return True
+                return False
+
+        elif operator == "and":
+
+            def pred(row: JsonObj, state: EvalState) -> bool:
+                for p in preds:
+                    if not p(row, state):
+                        return False
+                return True
+
+        else:
+
+            def pred(row: JsonObj, state: EvalState) -> bool:
+                for p in preds:
+                    if p(row, state):
+                        return False
+                return True
+
+    if sub is None or not sub.get("subset", False):
+        return pred, stateful
+
+    return _compile_subset(pred, sub, hashlimit), True
+
+
+def _compile_segment(
+    segment: JsonObj,
+    segments: Dict[str, JsonObj | None],
+    hashlimit: int,
+    compiled: Dict[str, Compiled | None],
+    plan: "SegmentPlan | None",
+) -> Compiled:
+    if plan is not None and not segment.get("subset", False):
+        # a segment without a subset is just a group of its parts, which
+        # lets it share a predicate with an identical group elsewhere
+        return _compile_part(
+            SegmentPlan.segment_group(segment), segments, hashlimit, compiled, plan
+        )
+    return _compile_parts(
+        segment["parts"],
+        segment["operator"],
+        segments,
+        segment,
+        hashlimit,
+        compiled,
+        plan,
+    )
+
+
+class SegmentPlan:
+    """Compiles the segments evaluated by one task into a single DAG: every
+    subsegment is compiled once, identical rules share one predicate, and
+    subsegments and rules used more than once are evaluated once per row.
+
+    All the segments of a plan must be evaluated over the same rows, in the
+    same order, with the same sentrows and ActivityLogs, since memoized
+    results are kept for the current row only.  Rules that keep subset state
+    are never shared or memoized, so each EvalState still counts its own."""
+
+    def __init__(
+        self,
+        segmentlist: List[JsonObj],
+        segments: Dict[str, JsonObj | None],
+        hashlimit: int,
+    ) -> None:
+        self.uses: Dict[str, int] = {}
+        self.rules: Dict[str, Compiled] = {}
+        self.row: JsonObj | None = None
+        self.memo: Dict[str, bool] = {}
+
+        for segment in segmentlist:
+            self.count_segment(segment, segments)
+
+        compiled: Dict[str, Compiled | None] = {}
+        self.preds: List[Predicate] = []
+        for segment in segmentlist:
+            segid = segment.get("id")
+            if segid is None:
+                c = _compile_segment(segment, segments, hashlimit, compiled, self)
+            elif compiled.get(segid) is None:
+                compiled[segid] = None
+                c = compiled[segid] = _compile_segment(
+                    segment, segments, hashlimit, compiled, self
+                )
+            else:
+                c = cast(Compiled, compiled[segid])
+            self.preds.append(c[0])
+
+    @staticmethod
+    def segment_group(segment: JsonObj) -> JsonObj:
+        return {
+            "type": "Group",
+            "operator": segment["operator"],
+            "parts": segment["parts"],
+        }
+
+    @staticmethod
+    def rule_key(part: JsonObj) -> str:
+        # addl parts are compiled as siblings of the part, not within it
+        return json.dumps(
+            {k: v for k, v in part.items() if k not in ("id", "addl")},
+            sort_keys=True,
+            default=str,
+        )
+
+    def use(self, key: str) -> bool:
+        n = self.uses.get(key, 0)
+        self.uses[key] = n + 1
+        return n == 0
+
+    def count_segment(
+        self, segment: JsonObj, segments: Dict[str, JsonObj | None]
+    ) -> None:
+        if not segment.get("subset", False):
+            self.count_parts([self.segment_group(segment)], segments)
+        elif self.use("segment:%s" % segment.get("id")):
+            self.count_parts(segment["parts"], segments)
+
+    def count_parts(
+        self, parts: List[JsonObj], segments: Dict[str, JsonObj | None]
+    ) -> None:
+        for part in parts:
+            for p in [part, *part.get("addl", ())]:
+                first = self.use(self.rule_key(p))
+                if p["type"] == "Group":
+                    if first:
+                        self.count_parts(p["parts"], segments)
+                elif p["type"] == "Lists" and p["operator"] in (
+                    "insegment",
+                    "notinsegment",
+                ):
+                    # every reference counts as a use of the segment, even
+                    # from a rule that is itself shared
+                    segment = segments.get(p["segment"])
+                    if segment is not None:
+                        self.count_segment(segment, segments)
+
+    def memoize(self, key: str, c: Compiled) -> Compiled:
+        pred, stateful = c
+        if stateful or self.uses.get(key, 0) < 2:
+            return c
+
+        memo = self.memo
+
+        def memoized(row: JsonObj, state: EvalState) -> bool:
+            if self.row is not row:
+                self.row = row
+                memo.clear()
+            hit = memo.get(key)
+            if hit is None:
+                hit = memo[key] = pred(row, state)
+            return hit
+
+        return memoized, False
+
+
+def segment_compile(
+    segment: JsonObj, segments: Dict[str, JsonObj | None], hashlimit: int
+) -> Predicate:
+    """Compile a segment and the subsegments it references (as loaded by
+    segment_get_segments) into a single predicate over get_segment_rows rows.
+
+    Rows for one bucket must be evaluated in order against a single EvalState,
+    exactly like segment_eval_parts with a shared segcounts dict."""
+
+    return segment_compile_many([segment], segments, hashlimit)[0]
+
+
+def segment_compile_many(
+    segmentlist: List[JsonObj], segments: Dict[str, JsonObj | None], hashlimit: int
+) -> List[Predicate]:
+    """Like segment_compile for several segments evaluated over the same rows,
+    sharing the subsegments and rules they have in common (see SegmentPlan).
+    Each segment still needs its own EvalState."""
+
+    if os.environ.get("segment_trace"):
+        cache = Cache()
+
+        def tracer(segment: JsonObj) -> Predicate:
+            def traced(row: JsonObj, state: EvalState) -> bool:
+                return segment_eval_parts(
+                    segment["parts"],
+                    segment["operator"],
+                    row,
+                    state.segcounts,
+                    state.numrows,
+                    segments,
+                    state.sentrows,
+                    segment,
+                    hashlimit,
+                    cache,
+                )
+
+            return traced
+
+        return [tracer(segment) for segment in segmentlist]
+
+    return SegmentPlan(segmentlist, segments, hashlimit).preds
@@ -5,12 +5,23 @@ import random
 import json
 import os
 import base64
-import redis
 import falcon
 import smtplib
 import quopri
 import uuid
-from typing import Dict, Tuple, List, Set, cast, Any, Iterable, Type, TypedDict
+import time
+import threading
+from typing import (
+    Dict,
+    Tuple,
+    List,
+    Set,
+    cast,
+    Any,
+    Iterable,
+    Type,
+    Deque,
+)
 from urllib3 import Retry
 from requests.adapters import HTTPAdapter
 from email.header import Header
@@ -19,6 +30,8 @@ from datetime import datetime, timedelta
 from dateutil.tz import tzoffset, tzutc
 import dateutil.parser
 from io import StringIO, BytesIO
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import boto3
 from email.utils import formataddr, parseaddr
 from fnmatch import fnmatch
@@ -46,6 +59,9 @@ from .s3 import s3_read, s3_delete, s3_write, s3_read_stream
 from . import contacts
 from .log import get_logger
 from .webhooks import send_webhooks
+from .counters import incr_counters
+from .daystats import incr_daystats
+from .tracking import set_tracking
 
 log = get_logger()
 
@@ -159,33 +175,142 @@ def load_domain_throttles(db: DB, company: JsonObj) -> List[JsonObj]:
         db.set_cid(None)
 
 
-def check_send_limit(
-    company: JsonObj,
-    route: JsonObj,
-    domain: str,
-    domainthrottles: List[JsonObj],
-    requested: int,
-) -> int:
-    cid = company["id"]
-    minlimit = fix_empty_limit(company.get("minlimit"))
-    hourlimit = fix_empty_limit(company.get("hourlimit"))
-    daylimit = fix_empty_limit(company.get("daylimit"))
-    monthlimit = fix_empty_limit(company.get("monthlimit"))
-    offset = company.get("tzoffset", 0)
-    paid = company.get("paid", False)
-    trialend = company.get("trialend")
-    inreview = company.get("inreview")
-    persendlimit = fix_empty_limit(company.get("persendlimit"))
-
-    log.debug("%s", company)
-
-    localtime = datetime.now(tzoffset("", timedelta(minutes=offset)))
-
-    if localtime.hour < 7:
-        localtime = localtime - timedelta(days=1)
-
-    log.debug("%s", localtime)
-
+# Checks the company and domain send counters and reserves what is allowed for
+# one or more domains of a company in a single call, so that the counters can
+# be read and updated without WATCH/MULTI round trips.
+#
+# KEYS: company min, hour, day and month counters, credits, credits_expire and
+# limithit, then a min, hour and day counter per domain.  ARGV: company min,
+# hour, day and month limits, paid, per-send limit and the limithit value,
+# then the min, hour and day limits and requested count per domain.  Limits
+# of -1 are not enforced and a requested count of -1 skips the domain.
+# Returns the count granted for each domain.
+_RESERVE_SCRIPT = """
+local function limit(v)
+  v = tonumber(v)
+  if v < 0 then return nil end
+  return v
+end
+
+local function count(key)
+  return tonumber(redis.call('get', key) or 0)
+end
+
+local minlimit = limit(ARGV[1])
+local hourlimit = limit(ARGV[2])
+local daylimit = limit(ARGV[3])
+local monthlimit = limit(ARGV[4])
+local paid = ARGV[5] == '1'
+local persendlimit = limit(ARGV[6])
+
+local mincnt = count(KEYS[1])
+local hourcnt = count(KEYS[2])
+local daycnt = count(KEYS[3])
+local monthcnt = count(KEYS[4])
+local creditcnt, creditexpirecnt = 0, 0
+if paid then
+  creditcnt = count(KEYS[5])
+  creditexpirecnt = count(KEYS[6])
+end
+local daylimitok = daylimit ~= nil and daycnt < daylimit
+local changed = false
+
+local granted = {}
+for i = 1, (#KEYS - 7) / 3 do
+  local k = 7 + (i - 1) * 3
+  local a = 7 + (i - 1) * 4
+  local requested = tonumber(ARGV[a + 4])
+  local result = 0
+
+  if requested >= 0 then
+    local allowed = 9999999999999
+    local hit = false
+    local function check(lim, cnt)
+      if lim ~= nil then
+        if cnt >= lim then
+          hit = true
+        else
+          allowed = math.min(allowed, lim - cnt)
+        end
+      end
+    end
+
+    check(minlimit, mincnt)
+    check(hourlimit, hourcnt)
+    check(daylimit, daycnt)
+    check(monthlimit, monthcnt)
+
+    local domainlimits = {limit(ARGV[a + 1]), limit(ARGV[a + 2]), limit(ARGV[a + 3])}
+    local domaincnts = {}
+    for j = 1, 3 do
+      if domainlimits[j] ~= nil then
+        domaincnts[j] = count(KEYS[k + j])
+        check(domainlimits[j], domaincnts[j])
+      end
+    end
+
+    if paid then
+      if creditcnt + creditexpirecnt <= 0 then
+        hit = true
+      else
+        allowed = math.min(allowed, creditcnt + creditexpirecnt)
+      end
+    end
+
+    if not hit then
+      if persendlimit ~= nil then
+        allowed = math.min(allowed, persendlimit)
+      end
+      result = math.min(requested, allowed)
+
+      mincnt = mincnt + result
+      hourcnt = hourcnt + result
+      daycnt = daycnt + result
+      monthcnt = monthcnt + result
+      if paid then
+        creditcnt = creditcnt - result
+        if creditcnt < 0 then
+          creditexpirecnt = creditexpirecnt + creditcnt
+          creditcnt = 0
+        end
+      end
+
+      local ttls = {60, 60 * 60, 60 * 60 * 24}
+      for j = 1, 3 do
+        if domaincnts[j] ~= nil then
+          redis.call('set', KEYS[k + j], domaincnts[j] + result, 'ex', ttls[j])
+        end
+      end
+      changed = true
+    end
+  end
+
+  granted[i] = result
+end
+
+if changed then
+  redis.call('set', KEYS[1], mincnt, 'ex', 60)
+  redis.call('set', KEYS[2], hourcnt, 'ex', 60 * 60)
+  redis.call('set', KEYS[3], daycnt, 'ex', 60 * 60 * 24)
+  redis.call('set', KEYS[4], monthcnt, 'ex', 60 * 60 * 24 * 31)
+  if paid then
+    redis.call('set', KEYS[5], creditcnt)
+    redis.call('set', KEYS[6], creditexpirecnt)
+  end
+  if daylimitok and daycnt >= daylimit then
+    redis.call('set', KEYS[7], ARGV[7], 'ex', 60 * 60 * 24)
+  end
+end
+
+return granted
+"""
+
+_reserve_script: Any = None
+
+
+def domain_send_limits(
+    route: str, domain: str, domainthrottles: List[JsonObj]
+) -> Tuple[int | None, int | None, int | None]:
     domainminlimit: int | None = None
     domainhourlimit: int | None = None
     domaindaylimit: int | None = None
@@ -193,7 +318,6 @@ def check_send_limit(
     domainminlimitexact: int | None = None
     domainhourlimitexact: int | None = None
     domaindaylimitexact: int | None = None
-
     log.debug("domain throttles: %s", domainthrottles)
     for dt in domainthrottles:
         if dt["route"] != route:
@@ -250,201 +374,130 @@ def check_send_limit(
         "domain limits: %s %s %s", domainminlimit, domainhourlimit, domaindaylimit
     )
 
+    return domainminlimit, domainhourlimit, domaindaylimit
+
+
+def check_send_limits(
+    company: JsonObj,
+    domainthrottles: List[JsonObj],
+    requests: List[Tuple[str, str, int]],
+) -> List[int]:
+    """Reserves send quota for each (route, domain, requested) in order,
+    returning the count granted for each."""
+    global _reserve_script
+
+    cid = company["id"]
+    minlimit = fix_empty_limit(company.get("minlimit"))
+    hourlimit = fix_empty_limit(company.get("hourlimit"))
+    daylimit = fix_empty_limit(company.get("daylimit"))
+    monthlimit = fix_empty_limit(company.get("monthlimit"))
+    offset = company.get("tzoffset", 0)
+    paid = company.get("paid", False)
+    trialend = company.get("trialend")
+    inreview = company.get("inreview")
+    persendlimit = fix_empty_limit(company.get("persendlimit"))
+
+    log.debug("%s", company)
+
+    if not requests:
+        return []
+
     if (
         (minlimit is not None and minlimit <= 0)
         or (hourlimit is not None and hourlimit <= 0)
         or (daylimit is not None and daylimit <= 0)
         or (monthlimit is not None and monthlimit <= 0)
-        or (domainminlimit is not None and domainminlimit <= 0)
-        or (domainhourlimit is not None and domainhourlimit <= 0)
-        or (domaindaylimit is not None and domaindaylimit <= 0)
         or company.get("paused", False)
         or company.get("banned", False)
     ):
         log.debug("limit zero or company paused/banned, returning 0")
-        return 0
+        return [0] * len(requests)
 
     if inreview:
         log.debug("company in review, returning 0")
-        return 0
+        return [0] * len(requests)
     if not paid and trialend:
         trialenddate = (
             dateutil.parser.parse(trialend).astimezone(tzutc()).replace(tzinfo=None)
         )
         if trialenddate < datetime.utcnow():
             log.debug("trial ended, returning 0")
-            return 0
+            return [0] * len(requests)
 
-    rdb = redis_connect()
+    localtime = datetime.now(tzoffset("", timedelta(minutes=offset)))
 
-    minkey = "sendratemin-%s:%s" % (cid, localtime.minute)
-    hourkey = "sendratehour-%s:%s" % (cid, localtime.hour)
-    daykey = "sendrateday-%s:%s" % (cid, localtime.day)
-    monthkey = "sendratemonth-%s:%s" % (cid, localtime.month)
-    domainminkey = "sendratemin-%s-%s-%s:%s" % (cid, route, domain, localtime.minute)
-    domainhourkey = "sendratehour-%s-%s-%s:%s" % (cid, route, domain, localtime.hour)
-    domaindaykey = "sendrateday-%s-%s-%s:%s" % (cid, route, domain, localtime.day)
-    limithitkey = "limithit-%s:%s" % (cid, localtime.day)
-    creditskey = "credits-%s" % cid
-    creditsexpirekey = "credits_expire-%s" % cid
+    if localtime.hour < 7:
+        localtime = localtime - timedelta(days=1)
 
-    with rdb.pipeline() as pipe:
-        while True:
-            try:
-                pipe.watch(minkey)
-                pipe.watch(hourkey)
-                pipe.watch(daykey)
-                pipe.watch(monthkey)
-                pipe.watch(domainminkey)
-                pipe.watch(domainhourkey)
-                pipe.watch(domaindaykey)
-                if paid:
-                    pipe.watch(creditskey)
-                    pipe.watch(creditsexpirekey)
-
-                pipemin: bytes | None = cast(bytes | None, pipe.get(minkey))
-                pipehour: bytes | None = cast(bytes | None, pipe.get(hourkey))
-                pipeday: bytes | None = cast(bytes | None, pipe.get(daykey))
-                pipemonth: bytes | None = cast(bytes | None, pipe.get(monthkey))
-
-                mincnt = int(pipemin or 0)
-                hourcnt = int(pipehour or 0)
-                daycnt = int(pipeday or 0)
-                monthcnt = int(pipemonth or 0)
-                domainmincnt = None
-                if domainminlimit is not None:
-                    pipedomainmin = cast(bytes | None, pipe.get(domainminkey))
-                    domainmincnt = int(pipedomainmin or 0)
-                domainhourcnt = None
-                if domainhourlimit is not None:
-                    pipedomainhour = cast(bytes | None, pipe.get(domainhourkey))
-                    domainhourcnt = int(pipedomainhour or 0)
-                domaindaycnt = None
-                if domaindaylimit is not None:
-                    pipedomainday = cast(bytes | None, pipe.get(domaindaykey))
-                    domaindaycnt = int(pipedomainday or 0)
-                creditcnt, creditexpirecnt = 0, 0
-                if paid:
-                    pipecredits: bytes | None = cast(bytes | None, pipe.get(creditskey))
-                    pipecreditsexpire: bytes | None = cast(
-                        bytes | None, pipe.get(creditsexpirekey)
-                    )
-                    creditcnt = int(pipecredits or 0)
-                    creditexpirecnt = int(pipecreditsexpire or 0)
+    log.debug("%s", localtime)
 
-                daylimitok = daylimit is not None and daycnt < daylimit
+    def lim(limit: int | None) -> int:
+        return -1 if limit is None else limit
+
+    keys = [
+        "sendratemin-%s:%s" % (cid, localtime.minute),
+        "sendratehour-%s:%s" % (cid, localtime.hour),
+        "sendrateday-%s:%s" % (cid, localtime.day),
+        "sendratemonth-%s:%s" % (cid, localtime.month),
+        "credits-%s" % cid,
+        "credits_expire-%s" % cid,
+        "limithit-%s:%s" % (cid, localtime.day),
+    ]
+    args: List[Any] = [
+        lim(minlimit),
+        lim(hourlimit),
+        lim(daylimit),
+        lim(monthlimit),
+        1 if paid else 0,
+        lim(persendlimit),
+        datetime.utcnow().isoformat() + "Z",
+    ]
 
-                if minlimit is not None and mincnt >= minlimit:
-                    log.debug("minlimit %s hit with %s, returning 0", minlimit, mincnt)
-                    return 0
-                if hourlimit is not None and hourcnt >= hourlimit:
-                    log.debug(
-                        "hourlimit %s hit with %s, returning 0", hourlimit, hourcnt
-                    )
-                    return 0
-                if daylimit is not None and daycnt >= daylimit:
-                    log.debug("daylimit %s hit with %s, returning 0", daylimit, daycnt)
-                    return 0
-                if monthlimit is not None and monthcnt >= monthlimit:
-                    log.debug(
-                        "monthlimit %s hit with %s, returning 0", monthlimit, monthcnt
-                    )
-                    return 0
-                if (
-                    domainminlimit is not None
-                    and domainmincnt is not None
-                    and domainmincnt >= domainminlimit
-                ):
-                    log.debug(
-                        "domainminlimit %s hit with %s, returning 0",
-                        domainminlimit,
-                        domainmincnt,
-                    )
-                    return 0
-                if (
-                    domainhourlimit is not None
-                    and domainhourcnt is not None
-                    and domainhourcnt >= domainhourlimit
-                ):
-                    log.debug(
-                        "domainhourlimit %s hit with %s, returning 0",
-                        domainhourlimit,
-                        domainhourcnt,
-                    )
-                    return 0
-                if (
-                    domaindaylimit is not None
-                    and domaindaycnt is not None
-                    and domaindaycnt >= domaindaylimit
-                ):
-                    log.debug(
-                        "domaindaylimit %s hit with %s, returning 0",
-                        domaindaylimit,
-                        domaindaycnt,
-                    )
-                    return 0
-                if paid and (creditcnt + creditexpirecnt) <= 0:
-                    log.debug("out of credits, returning 0")
-                    return 0
-
-                allowed = 9999999999999
-                if minlimit is not None:
-                    allowed = min(allowed, minlimit - mincnt)
-                if hourlimit is not None:
-                    allowed = min(allowed, hourlimit - hourcnt)
-                if daylimit is not None:
-                    allowed = min(allowed, daylimit - daycnt)
-                if monthlimit is not None:
-                    allowed = min(allowed, monthlimit - monthcnt)
-                if domainminlimit is not None and domainmincnt is not None:
-                    allowed = min(allowed, domainminlimit - domainmincnt)
-                if domainhourlimit is not None and domainhourcnt is not None:
-                    allowed = min(allowed, domainhourlimit - domainhourcnt)
-                if domaindaylimit is not None and domaindaycnt is not None:
-                    allowed = min(allowed, domaindaylimit - domaindaycnt)
-                if paid:
-                    allowed = min(allowed, creditcnt + creditexpirecnt)
-                if persendlimit is not None:
-                    allowed = min(allowed, persendlimit)
-
-                log.debug("requested = %s, allowed = %s", requested, allowed)
-                result = min(requested, allowed)
-
-                if paid:
-                    creditcnt -= result
-                    if creditcnt < 0:
-                        creditexpirecnt += creditcnt
-                        creditcnt = 0
-
-                log.debug("saving new counts")
-                pipe.multi()
-
-                pipe.set(minkey, mincnt + result, 60)
-                pipe.set(hourkey, hourcnt + result, 60 * 60)
-                pipe.set(daykey, daycnt + result, 60 * 60 * 24)
-                pipe.set(monthkey, monthcnt + result, 60 * 60 * 24 * 31)
-                if domainmincnt is not None:
-                    pipe.set(domainminkey, domainmincnt + result, 60)
-                if domainhourcnt is not None:
-                    pipe.set(domainhourkey, domainhourcnt + result, 60 * 60)
-                if domaindaycnt is not None:
-                    pipe.set(domaindaykey, domaindaycnt + result, 60 * 60 * 24)
-                if paid:
-                    pipe.set(creditskey, creditcnt)
-                    pipe.set(creditsexpirekey, creditexpirecnt)
-
-                if daylimitok and daylimit is not None and daycnt + result >= daylimit:
-                    pipe.set(
-                        limithitkey, datetime.utcnow().isoformat() + "Z", 60 * 60 * 24
-                    )
+    for route, domain, requested in requests:
+        domainminlimit, domainhourlimit, domaindaylimit = domain_send_limits(
+            route, domain, domainthrottles
+        )
 
-                pipe.execute()
+        log.debug(
+            "domain limits: %s %s %s", domainminlimit, domainhourlimit, domaindaylimit
+        )
 
-                log.debug("returning %s", result)
-                return result
-            except redis.WatchError:
-                log.debug("redis watch error, retrying")
-                continue
+        if (
+            (domainminlimit is not None and domainminlimit <= 0)
+            or (domainhourlimit is not None and domainhourlimit <= 0)
+            or (domaindaylimit is not None and domaindaylimit <= 0)
+        ):
+            log.debug("domain limit zero for %s, skipping", domain)
+            requested = -1
+
+        keys.extend(
+            [
+                "sendratemin-%s-%s-%s:%s" % (cid, route, domain, localtime.minute),
+                "sendratehour-%s-%s-%s:%s" % (cid, route, domain, localtime.hour),
+                "sendrateday-%s-%s-%s:%s" % (cid, route, domain, localtime.day),
+            ]
+        )
+        args.extend(
+            [lim(domainminlimit), lim(domainhourlimit), lim(domaindaylimit), requested]
+        )
+
+    if _reserve_script is None:
+        _reserve_script = redis_connect().register_script(_RESERVE_SCRIPT)
+
+    result = [int(r) for r in _reserve_script(keys=keys, args=args)]
+
+    log.debug("requested = %s, returning %s", [r[2] for r in requests], result)
+    return result
+
+
+def check_send_limit(
+    company: JsonObj,
+    route: str,
+    domain: str,
+    domainthrottles: List[JsonObj],
+    requested: int,
+) -> int:
+    return check_send_limits(company, domainthrottles, [(route, domain, requested)])[0]
 
 
 unsubheaderre = re.compile(r"\{\{!!unsubheaderlink\}\}")
@@ -1346,6 +1399,7 @@ def do_ses_send(
     raise_err: bool,
 ) -> None:
     stream = None
+    stats = SendStats()
     try:
         try:
             data = s3_read(os.environ["s3_transferbucket"], htmlkey)
@@ -1353,6 +1407,8 @@ def do_ses_send(
             return
 
         html = data.decode("utf-8")
+        htmltemplate = MergeTemplate(html)
+        subjecttemplate = MergeTemplate(subject)
         s3_delete(os.environ["s3_transferbucket"], htmlkey)
 
         with open_db() as db:
@@ -1398,11 +1454,8 @@ def do_ses_send(
                             r.get(lookup) or defval
                         )
 
-                def rf(m: re.Match[str]) -> str:
-                    return cast(str, replace.get(m.group(1), ""))
-
-                htmlreplaced = varre.sub(rf, html)
-                subjectreplaced = varre.sub(rf, subject)
+                htmlreplaced = htmltemplate.render(replace)
+                subjectreplaced = subjecttemplate.render(replace)
                 trackingid = replace["__trackingid"]
 
                 error = None
@@ -1457,6 +1510,9 @@ def do_ses_send(
                             trackingid,
                             ts,
                         )
+                        set_tracking(
+                            trackingid, "ses", ses["id"], "pool", ts, ses["cid"]
+                        )
                     else:
                         log.error("SES Error: %s", error)
                         handle_soft_event(
@@ -1473,6 +1529,7 @@ def do_ses_send(
                             domain,
                             "ses",
                             ses["id"],
+                            stats,
                         )
                         if raise_err:
                             raise Exception(error)
@@ -1492,6 +1549,9 @@ def do_ses_send(
     finally:
         if stream is not None:
             stream.close()
+        if stats.pending:
+            with open_db() as db:
+                stats.flush(db)
 
 
 def mime_word(headername: str, s: str) -> str:
@@ -1566,6 +1626,146 @@ def handle_soft_event(
         send_webhooks(db, campcid, [webhookev])
 
 
+# Counts from incr_stats are collected per send task and written with one
+# upsert per row when the task finishes, or when they have been held this
+# many seconds, so that a large send doesn't update the same campaign row
+# and hourstats rows once per message.
+STATS_FLUSH_INTERVAL = int(os.environ.get("send_stats_interval", "10"))
+
+
+class SendStats(object):
+
+    def __init__(self) -> None:
+        self.camps: Dict[Tuple[bool, str], List[int]] = {}
+        self.hourstats: Dict[Tuple[Any, ...], List[int]] = {}
+        self.txnstats: Dict[Tuple[Any, ...], List[int]] = {}
+        self.flushed = time.monotonic()
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.camps or self.hourstats or self.txnstats)
+
+    def add(
+        self,
+        send: int,
+        soft: int,
+        campid: str,
+        is_camp: bool,
+        cid: str,
+        campcid: str,
+        domain: str,
+        sinkid: str,
+        settingsid: str,
+        txntag: str | None,
+    ) -> None:
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+        counts = [send, soft]
+        if not campid.startswith("tx-"):
+            self._add(self.camps, (is_camp, campid), counts)
+        self._add(
+            self.hourstats,
+            (hour, sinkid, domain, settingsid, campid, cid, campcid),
+            counts,
+        )
+        if txntag is not None:
+            self._add(self.txnstats, (hour, campcid, txntag, domain), counts)
+
+    def _add(
+        self,
+        d: Dict[Tuple[Any, ...], List[int]],
+        key: Tuple[Any, ...],
+        counts: List[int],
+    ) -> None:
+        if key not in d:
+            d[key] = [0, 0]
+        totals = d[key]
+        totals[0] += counts[0]
+        totals[1] += counts[1]
+
+    def flush_due(self) -> bool:
+        return time.monotonic() - self.flushed >= STATS_FLUSH_INTERVAL
+
+    def flush(self, db: DB) -> None:
+        self.flushed = time.monotonic()
+        if not self.pending:
+            return
+
+        for (is_camp, campid), (send, soft) in sorted(self.camps.items()):
+            incr_counters(
+                db, is_camp, campid, {"delivered": send, "send": send, "soft": soft}
+            )
+
+        if self.hourstats:
+            db.execute_values(
+                """insert into hourstats (id, cid, campcid, ts, sinkid, domaingroupid, ip, settingsid, campid,
+                            complaint, unsub, open, click, send, soft, hard, err, defercnt)
+                            values %s
+                            on conflict on constraint hourstats_uniq do update set
+                            send =      hourstats.send      + excluded.send,
+                            soft =      hourstats.soft      + excluded.soft""",
+                [
+                    (
+                        shortuuid.uuid(),
+                        cid,
+                        campcid,
+                        hour,
+                        sinkid,
+                        domain,
+                        settingsid,
+                        campid,
+                        send,
+                        soft,
+                    )
+                    for (hour, sinkid, domain, settingsid, campid, cid, campcid), (
+                        send,
+                        soft,
+                    ) in sorted(self.hourstats.items())
+                ],
+                template="(%s, %s, %s, %s, %s, %s, 'pool', %s, %s, 0, 0, 0, 0, %s, %s, 0, 0, 0)",
+            )
+            incr_daystats(
+                db,
+                (
+                    (
+                        cid,
+                        campcid,
+                        hour,
+                        sinkid,
+                        domain,
+                        settingsid,
+                        campid,
+                        {"send": send, "soft": soft},
+                    )
+                    for (hour, sinkid, domain, settingsid, campid, cid, campcid), (
+                        send,
+                        soft,
+                    ) in self.hourstats.items()
+                ),
+            )
+
+        if self.txnstats:
+            db.execute_values(
+                """insert into txnstats (id, cid, ts, tag, domain,
+                            complaint, unsub, open, click, send, soft, hard, open_all, click_all)
+                            values %s
+                            on conflict (ts, cid, tag, domain) do update set
+                            send =      txnstats.send      + excluded.send,
+                            soft =      txnstats.soft      + excluded.soft""",
+                [
+                    (shortuuid.uuid(), cid, hour, tag, domain, send, soft)
+                    for (hour, cid, tag, domain), (send, soft) in sorted(
+                        self.txnstats.items()
+                    )
+                ],
+                template="(%s, %s, %s, %s, %s, 0, 0, 0, 0, %s, %s, 0, 0, 0)",
+            )
+
+        self.camps = {}
+        self.hourstats = {}
+        self.txnstats = {}
+
+
 def incr_stats(
     db: DB,
     send: int,
@@ -1577,101 +1777,24 @@ def incr_stats(
     domain: str,
     sinkid: str,
     settingsid: str,
+    stats: SendStats | None = None,
 ) -> None:
-    ts = datetime.utcnow()
-    if len(campid) <= 30:
-        if is_camp:
-            db.execute(
-                """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                    'send', (data->>'send')::int + %s,
-                                                                                    'soft', (data->>'soft')::int + %s) where id = %s""",
-                send,
-                send,
-                soft,
-                campid,
-            )
-        else:
-            db.execute(
-                """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                'send', (data->>'send')::int + %s,
-                                                                                'soft', (data->>'soft')::int + %s) where id = %s""",
-                send,
-                send,
-                soft,
-                campid,
-            )
-    else:
+    txntag = None
+    if len(campid) > 30:
         campcidtmp, txntag, _ = get_txn(db, campid)
         if campcidtmp is None:
             return
         campcid = campcidtmp
         campid = "tx-%s" % campcid
-    db.execute(
-        """insert into hourstats (id, cid, campcid, ts, sinkid, domaingroupid, ip, settingsid, campid,
-                    complaint, unsub, open, click, send, soft, hard, err, defercnt)
-                    values (%s, %s, %s, date_trunc('hour', %s), %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    on conflict on constraint hourstats_uniq do update set
-                    complaint = hourstats.complaint + excluded.complaint,
-                    unsub =     hourstats.unsub     + excluded.unsub,
-                    open =      hourstats.open      + excluded.open,
-                    click =     hourstats.click     + excluded.click,
-                    send =      hourstats.send      + excluded.send,
-                    soft =      hourstats.soft      + excluded.soft,
-                    hard =      hourstats.hard      + excluded.hard,
-                    err =       hourstats.err       + excluded.err,
-                    defercnt =  hourstats.defercnt  + excluded.defercnt""",
-        shortuuid.uuid(),
-        cid,
-        campcid,
-        ts,
-        sinkid,
-        domain,
-        "pool",
-        settingsid,
-        campid,
-        0,
-        0,
-        0,
-        0,
-        send,
-        soft,
-        0,
-        0,
-        0,
+
+    flush = stats is None
+    if stats is None:
+        stats = SendStats()
+    stats.add(
+        send, soft, campid, is_camp, cid, campcid, domain, sinkid, settingsid, txntag
     )
-    if campid.startswith("tx-"):
-        db.execute(
-            """insert into txnstats (id, cid, ts, tag, domain,
-                        complaint, unsub, open, click, send, soft, hard, open_all, click_all)
-                        values (%s, %s, date_trunc('hour', %s), %s, %s,
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        on conflict (ts, cid, tag, domain) do update set
-                        complaint = txnstats.complaint + excluded.complaint,
-                        unsub =     txnstats.unsub     + excluded.unsub,
-                        open =      txnstats.open      + excluded.open,
-                        click =     txnstats.click     + excluded.click,
-                        send =      txnstats.send      + excluded.send,
-                        soft =      txnstats.soft      + excluded.soft,
-                        hard =      txnstats.hard      + excluded.hard,
-                        open_all =  txnstats.open_all  + excluded.open_all,
-                        click_all = txnstats.click_all + excluded.click_all
-                        """,
-            shortuuid.uuid(),
-            campcid,
-            ts,
-            txntag,
-            domain,
-            0,
-            0,
-            0,
-            0,
-            send,
-            soft,
-            0,
-            0,
-            0,
-        )
+    if flush or stats.flush_due():
+        stats.flush(db)
 
 
 def link_webroot(obj: JsonObj) -> str:
@@ -1721,9 +1844,135 @@ def do_smtprelay_send_task(
     )
 
 
-class SMTPRelayState(TypedDict):
-    conn: smtplib.SMTP | smtplib.SMTP_SSL | None
-    conn_sent: int
+# Messages for a relay are handed to a set of sender threads, each holding one
+# connection, so that a slow server round trip doesn't stall the whole send.
+# Connections are kept per worker process and reused by later sends through
+# the same relay until msgsperconn is reached.
+SMTP_RELAY_CONNECTIONS = int(os.environ.get("smtprelay_connections", "4"))
+# idle connections older than this are checked with a NOOP before reuse
+SMTP_RELAY_IDLE_CHECK = 30
+
+
+class SMTPRelayConnection(object):
+
+    def __init__(self, conn: smtplib.SMTP | smtplib.SMTP_SSL) -> None:
+        self.conn = conn
+        self.sent = 0
+        self.used = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.conn.quit()
+        except:
+            pass
+
+
+class SMTPRelayPool(object):
+
+    def __init__(self, smtp: JsonObj) -> None:
+        self.smtp = smtp
+        self.size = int(smtp.get("connections") or SMTP_RELAY_CONNECTIONS)
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.lock = threading.Lock()
+        self.idle: List[SMTPRelayConnection] = []
+
+    def open(self) -> SMTPRelayConnection:
+        smtp = self.smtp
+
+        cls: Type[smtplib.SMTP] | Type[smtplib.SMTP_SSL]
+        if smtp["ssltype"] == "ssl":
+            cls = smtplib.SMTP_SSL
+        else:
+            cls = smtplib.SMTP
+
+        newconn = cls(
+            host=smtp["hostname"].strip(),
+            port=smtp["port"],
+            local_hostname=smtp["ehlohostname"].strip(),
+            timeout=10,
+        )
+
+        if smtp["ssltype"] == "starttls":
+            newconn.starttls()
+
+        if smtp["useauth"]:
+            newconn.login(smtp["username"].strip(), smtp["password"])
+
+        return SMTPRelayConnection(newconn)
+
+    def checkout(self) -> SMTPRelayConnection:
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                c = self.idle.pop()
+            if time.monotonic() - c.used < SMTP_RELAY_IDLE_CHECK:
+                return c
+            try:
+                c.conn.noop()
+                return c
+            except:
+                c.close()
+        return self.open()
+
+    def checkin(self, c: SMTPRelayConnection) -> None:
+        msgsperconn = self.smtp.get("msgsperconn")
+        if msgsperconn and c.sent >= msgsperconn:
+            c.close()
+            return
+        c.used = time.monotonic()
+        with self.lock:
+            self.idle.append(c)
+
+    def send(self, fromaddr: str, toaddr: str, msg: bytes) -> None:
+        with self.slots:
+            c = self.checkout()
+            try:
+                c.conn.sendmail(fromaddr, toaddr, msg)
+                c.sent += 1
+            except smtplib.SMTPResponseException:
+                # the server rejected this message but the session is fine
+                self.checkin(c)
+                raise
+            except:
+                c.close()
+                raise
+            self.checkin(c)
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for c in idle:
+            c.close()
+
+
+_relay_pools: Dict[str, SMTPRelayPool] = {}
+_relay_pools_lock = threading.Lock()
+
+_RELAY_SETTINGS = (
+    "hostname",
+    "port",
+    "ssltype",
+    "ehlohostname",
+    "useauth",
+    "username",
+    "password",
+    "msgsperconn",
+    "connections",
+)
+
+
+def get_relay_pool(smtp: JsonObj) -> SMTPRelayPool:
+    with _relay_pools_lock:
+        pool = _relay_pools.get(smtp["id"])
+        if pool is not None and all(
+            pool.smtp.get(k) == smtp.get(k) for k in _RELAY_SETTINGS
+        ):
+            return pool
+        _relay_pools[smtp["id"]] = SMTPRelayPool(smtp)
+    if pool is not None:
+        pool.close()
+    return _relay_pools[smtp["id"]]
 
 
 def do_smtprelay_send(
@@ -1745,6 +1994,7 @@ def do_smtprelay_send(
 
     with open_db() as db:
         stream = None
+        stats = SendStats()
         sent_emails = []
         try:
             try:
@@ -1753,6 +2003,8 @@ def do_smtprelay_send(
                 return
 
             html = data.decode("utf-8")
+            htmltemplate = MergeTemplate(html)
+            subjecttemplate = MergeTemplate(subject)
             s3_delete(os.environ["s3_transferbucket"], htmlkey)
 
             if recipkey is not None:
@@ -1761,54 +2013,28 @@ def do_smtprelay_send(
 
             assert recips is not None
 
-            tolist: List[JsonObj] = []
-
             _, fromaddr = parseaddr(frm)
 
             headers = re.sub("\n\n", "\n", smtp["headers"].strip())
             if headers:
                 headers = "\r\n" + headers
 
-            state: SMTPRelayState = {"conn": None, "conn_sent": 0}
-
-            def open_conn() -> None:
-                if state["conn"] is not None:
-                    return
-
-                cls: Type[smtplib.SMTP] | Type[smtplib.SMTP_SSL]
-                if smtp["ssltype"] == "ssl":
-                    cls = smtplib.SMTP_SSL
-                else:
-                    cls = smtplib.SMTP
-
-                newconn = cls(
-                    host=smtp["hostname"].strip(),
-                    port=smtp["port"],
-                    local_hostname=smtp["ehlohostname"].strip(),
-                    timeout=10,
-                )
-
-                if smtp["ssltype"] == "starttls":
-                    newconn.starttls()
+            pool = get_relay_pool(smtp)
 
-                if smtp["useauth"]:
-                    newconn.login(smtp["username"].strip(), smtp["password"])
-
-                state["conn"] = newconn
-                state["conn_sent"] = 0
+            # test and transactional sends stop at the first error, so they
+            # go out one at a time as before
+            if campid == "test" or raise_err:
+                threads, window = 1, 1
+            else:
+                threads, window = pool.size, pool.size * 2
 
-            def do_send() -> None:
-                for info in tolist:
-                    send = 0
-                    soft = 0
-                    error = None
-                    trackingid = info["trackingid"]
+            def build_msg(info: JsonObj) -> bytes:
+                trackingid = info["trackingid"]
 
-                    try:
-                        msg = BytesIO()
+                msg = BytesIO()
 
-                        msg.write(
-                            f"""From: {mime_word('From', frm)}
+                msg.write(
+                    f"""From: {mime_word('From', frm)}
 Reply-To: {mime_word('Reply-To', replyto)}
 To: {mime_word('To', info['to'])}
 Subject: {mime_word('Subject', info['subject'])}
@@ -1821,157 +2047,137 @@ List-Unsubscribe: {mime_word('List-Unsubscribe', f'<{linkwebroot}/l?t=unsub&r={t
 List-Unsubscribe-Post: List-Unsubscribe=One-Click{headers}
 
 """.replace(
-                                "\n", "\r\n"
-                            ).encode(
-                                "ascii"
-                            )
-                        )
-
-                        msg.write(
-                            quopri.encodestring(info["html"].encode("utf-8")).replace(
-                                b"\n", b"\r\n"
-                            )
-                        )
-
-                        open_conn()
-
-                        assert state["conn"] is not None
+                        "\n", "\r\n"
+                    ).encode(
+                        "ascii"
+                    )
+                )
 
-                        state["conn"].sendmail(
-                            fromaddr, info["address"], msg.getvalue()
-                        )
+                msg.write(info["html"].replace(b"\n", b"\r\n"))
 
-                        state["conn_sent"] += 1
-                        send += 1
-                    except Exception as e:
-                        log.error("SMTP Relay Error: %s", e)
-                        if campid == "test":
-                            add_test_log(db, campcid, info["address"], str(e))
-                            raise
-                        else:
-                            soft += 1
-                            error = str(e)
-                            handle_soft_event(
-                                db, info["address"], campid, campcid, is_camp, error
-                            )
+                return msg.getvalue()
 
-                    if (
-                        smtp["msgsperconn"]
-                        and state["conn_sent"] >= smtp["msgsperconn"]
-                    ):
-                        try:
-                            assert state["conn"] is not None
-                            state["conn"].quit()
-                        except:
-                            pass
-                        state["conn"] = None
+            def finish_send(info: JsonObj, result: Future[None]) -> None:
+                send = 0
+                soft = 0
+                error = None
+                trackingid = info["trackingid"]
 
+                try:
+                    result.result()
+                    send += 1
+                except Exception as e:
+                    log.error("SMTP Relay Error: %s", e)
                     if campid == "test":
-                        add_test_log(db, campcid, info["address"], "Success")
-                    else:
-                        ts = datetime.utcnow()
-                        domain = info["address"].split("@")[1]
-                        db.execute(
-                            "insert into smtptracking (id, settingsid, ts) values (%s, %s, %s)",
-                            trackingid,
-                            smtp["id"],
-                            ts,
-                        )
-
-                        incr_stats(
-                            db,
-                            send,
-                            soft,
-                            campid,
-                            is_camp,
-                            smtp["cid"],
-                            campcid,
-                            domain,
-                            "smtprelay",
-                            smtp["id"],
-                        )
-
-                        if not campid.startswith("tx-") and send:
-                            sent_emails.append(info["address"])
-
-                        if error and raise_err:
-                            raise Exception(error)
-
-            for r in recips:
-                trackingid = shortuuid.uuid()
-
-                recipvars = {}
-                recipvars["__uid"] = encrypt(r["Email"])
-                recipvars["__to"] = r["Email"]
-                recipvars["__trackingid"] = trackingid
-                for v, vals in othervars.items():
-                    lookup, defval = vals
-                    if v == "__rand":
-                        recipvars["__rand"] = "".join(
-                            random.choice(randchars) for _ in range(9)
-                        )
+                        add_test_log(db, campcid, info["address"], str(e))
+                        raise
                     else:
-                        recipvars[v.replace(" ", "_").replace("!", "_")] = (
-                            r.get(lookup) or defval
+                        soft += 1
+                        error = str(e)
+                        handle_soft_event(
+                            db, info["address"], campid, campcid, is_camp, error
                         )
 
-                if "!!to" in r:
-                    to = r["!!to"]
+                if campid == "test":
+                    add_test_log(db, campcid, info["address"], "Success")
                 else:
-                    name = (
-                        "%s %s" % (r.get("First Name", ""), r.get("Last Name", ""))
-                    ).strip()
-                    if name:
-                        to = formataddr((name, r["Email"]))
-                    else:
-                        to = r["Email"]
-                replace: Dict[str, str] = {
-                    "__trackingid": shortuuid.uuid(),
-                    "__uid": encrypt(r["Email"]),
-                    "__to": to,
-                    "Email": r["Email"],
-                }
-                for v, vals in othervars.items():
-                    lookup, defval = vals
-                    if v == "!!rand":
-                        replace["__rand"] = "".join(
-                            random.choice(randchars) for _ in range(9)
-                        )
-                    else:
-                        replace[v.replace(" ", "_").replace("!", "_")] = (
-                            r.get(lookup) or defval
-                        )
+                    ts = datetime.utcnow()
+                    domain = info["address"].split("@")[1]
+                    db.execute(
+                        "insert into smtptracking (id, settingsid, ts) values (%s, %s, %s)",
+                        trackingid,
+                        smtp["id"],
+                        ts,
+                    )
+                    set_tracking(
+                        trackingid, "smtprelay", smtp["id"], "pool", ts, smtp["cid"]
+                    )
 
-                def rf(m: re.Match[str]) -> str:
-                    return replace.get(m.group(1), "")
+                    incr_stats(
+                        db,
+                        send,
+                        soft,
+                        campid,
+                        is_camp,
+                        smtp["cid"],
+                        campcid,
+                        domain,
+                        "smtprelay",
+                        smtp["id"],
+                        stats,
+                    )
 
-                htmlreplaced = varre.sub(rf, html)
-                subjectreplaced = varre.sub(rf, subject)
-                trackingid = replace["__trackingid"]
+                    if not campid.startswith("tx-") and send:
+                        sent_emails.append(info["address"])
 
-                tolist.append(
-                    {
-                        "address": r["Email"],
-                        "to": to,
-                        "html": htmlreplaced,
-                        "subject": subjectreplaced,
-                        "trackingid": trackingid,
-                    }
-                )
+                    if error and raise_err:
+                        raise Exception(error)
 
-                if len(tolist) >= 1:
-                    do_send()
+            # messages are handed to the sender threads as they are built and
+            # their results are recorded here, in order, once the window of
+            # messages in flight is full; the database connection is only
+            # used from this thread
+            inflight: Deque[Tuple[JsonObj, Future[None]]] = deque()
 
-                    tolist = []
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                try:
+                    for r in recips:
+                        if "!!to" in r:
+                            to = r["!!to"]
+                        else:
+                            name = (
+                                "%s %s"
+                                % (r.get("First Name", ""), r.get("Last Name", ""))
+                            ).strip()
+                            if name:
+                                to = formataddr((name, r["Email"]))
+                            else:
+                                to = r["Email"]
+                        replace: Dict[str, str] = {
+                            "__trackingid": shortuuid.uuid(),
+                            "__uid": encrypt(r["Email"]),
+                            "__to": to,
+                            "Email": r["Email"],
+                        }
+                        for v, vals in othervars.items():
+                            lookup, defval = vals
+                            if v == "!!rand":
+                                replace["__rand"] = "".join(
+                                    random.choice(randchars) for _ in range(9)
+                                )
+                            else:
+                                replace[v.replace(" ", "_").replace("!", "_")] = (
+                                    r.get(lookup) or defval
+                                )
 
-            if len(tolist) > 0:
-                do_send()
+                        info = {
+                            "address": r["Email"],
+                            "to": to,
+                            "html": htmltemplate.render_qp(replace),
+                            "subject": subjecttemplate.render(replace),
+                            "trackingid": replace["__trackingid"],
+                        }
+
+                        inflight.append(
+                            (
+                                info,
+                                executor.submit(
+                                    pool.send,
+                                    fromaddr,
+                                    info["address"],
+                                    build_msg(info),
+                                ),
+                            )
+                        )
 
-            if state["conn"] is not None:
-                try:
-                    state["conn"].quit()
-                except:
-                    pass
+                        while len(inflight) >= window:
+                            finish_send(*inflight.popleft())
+
+                    while inflight:
+                        finish_send(*inflight.popleft())
+                finally:
+                    for _, result in inflight:
+                        result.cancel()
         except Exception as e:
             if write_err:
                 db.campaigns.patch(
@@ -1987,6 +2193,7 @@ List-Unsubscribe-Post: List-Unsubscribe=One-Click{headers}
         finally:
             if stream is not None:
                 stream.close()
+            stats.flush(db)
             if len(sent_emails):
                 contacts.add_send(db, campid, sent_emails)
 
@@ -2041,6 +2248,7 @@ def do_easylink_send(
 ) -> None:
     with open_db() as db:
         stream = None
+        stats = SendStats()
         sent_emails = []
         try:
             try:
@@ -2049,6 +2257,8 @@ def do_easylink_send(
                 return
 
             html = data.decode("utf-8")
+            htmltemplate = MergeTemplate(html)
+            subjecttemplate = MergeTemplate(subject)
             s3_delete(os.environ["s3_transferbucket"], htmlkey)
 
             if recipkey is not None:
@@ -2177,6 +2387,7 @@ def do_easylink_send(
                             domain,
                             "easylink",
                             el["id"],
+                            stats,
                         )
                         if raise_err:
                             raise Exception(error)
@@ -2193,6 +2404,9 @@ def do_easylink_send(
                                 el["id"],
                                 ts,
                             )
+                            set_tracking(
+                                trackingid, "easylink", el["id"], "pool", ts, el["cid"]
+                            )
 
                             incr_stats(
                                 db,
@@ -2205,29 +2419,13 @@ def do_easylink_send(
                                 domain,
                                 "easylink",
                                 el["id"],
+                                stats,
                             )
 
                             if not campid.startswith("tx-"):
                                 sent_emails.append(info["address"])
 
             for r in recips:
-                trackingid = shortuuid.uuid()
-
-                recipvars = {}
-                recipvars["__uid"] = encrypt(r["Email"])
-                recipvars["__to"] = r["Email"]
-                recipvars["__trackingid"] = trackingid
-                for v, vals in othervars.items():
-                    lookup, defval = vals
-                    if v == "__rand":
-                        recipvars["__rand"] = "".join(
-                            random.choice(randchars) for _ in range(9)
-                        )
-                    else:
-                        recipvars[v.replace(" ", "_").replace("!", "_")] = (
-                            r.get(lookup) or defval
-                        )
-
                 if "!!to" in r:
                     to = r["!!to"]
                 else:
@@ -2255,19 +2453,12 @@ def do_easylink_send(
                             r.get(lookup) or defval
                         )
 
-                def rf(m: re.Match[str]) -> str:
-                    return replace.get(m.group(1), "")
-
-                htmlreplaced = varre.sub(rf, html)
-                subjectreplaced = varre.sub(rf, subject)
-                trackingid = replace["__trackingid"]
-
                 tolist.append(
                     {
                         "address": r["Email"],
-                        "html": htmlreplaced,
-                        "subject": subjectreplaced,
-                        "trackingid": trackingid,
+                        "html": htmltemplate.render(replace),
+                        "subject": subjecttemplate.render(replace),
+                        "trackingid": replace["__trackingid"],
                     }
                 )
 
@@ -2293,6 +2484,7 @@ def do_easylink_send(
         finally:
             if stream is not None:
                 stream.close()
+            stats.flush(db)
             if len(sent_emails):
                 contacts.add_send(db, campid, sent_emails)
 
@@ -2723,6 +2915,110 @@ def get_vars(texts: Tuple[str, str]) -> Dict[str, Tuple[str, str]]:
     return othervars
 
 
+def _qp_crlf(data: bytes) -> bool:
+    i = data.find(b"\n")
+    return i > 0 and data[i - 1 : i] == b"\r"
+
+
+def _qp_encode(data: bytes, crlf: bool) -> bytes:
+    # quoted-printable output uses the line ending of the first line for every
+    # line, so a piece of a larger text is encoded with that text's ending by
+    # putting an empty line of the right kind in front of it
+    if _qp_crlf(data) == crlf:
+        return quopri.encodestring(data)
+    prefix = b"\r\n" if crlf else b"\n"
+    return quopri.encodestring(prefix + data)[len(prefix) :]
+
+
+class MergeTemplate(object):
+    """A message body or subject split once into literal text and merge tag
+    slots, so that rendering it for a recipient is a single join.
+
+    render_qp returns the same bytes as quopri.encodestring of the rendered
+    text.  Quoted-printable is encoded line by line, so runs of lines without
+    merge tags are encoded once and only the lines with tags are encoded per
+    recipient."""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.literals: List[str] = []
+        self.slots: List[str] = []
+        pos = 0
+        for m in varre.finditer(text):
+            self.literals.append(text[pos : m.start()])
+            self.slots.append(m.group(1))
+            pos = m.end()
+        self.literals.append(text[pos:])
+        self._qp: List[Tuple[bytes, Dict[bool, bytes]] | MergeTemplate] | None = None
+
+    def render(self, replace: Dict[str, str]) -> str:
+        if not self.slots:
+            return self.text
+        parts = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            parts.append(replace.get(slot, ""))
+            parts.append(literal)
+        return "".join(parts)
+
+    def _compile_qp(self) -> List[Tuple[bytes, Dict[bool, bytes]] | "MergeTemplate"]:
+        text = self.text
+
+        # split into runs of lines with and without merge tags, keeping the
+        # lines that a tag spans together
+        runs: List[List[Any]] = []
+        start = 0
+        tags = varre.finditer(text)
+        tag = next(tags, None)
+        while start < len(text):
+            end = text.find("\n", start) + 1 or len(text)
+            hastag = False
+            while tag is not None and tag.start() < end:
+                hastag = True
+                if tag.end() > end:
+                    end = text.find("\n", tag.end()) + 1 or len(text)
+                tag = next(tags, None)
+            if runs and runs[-1][2] == hastag:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end, hastag])
+            start = end
+
+        chunks: List[Tuple[bytes, Dict[bool, bytes]] | MergeTemplate] = []
+        for start, end, hastag in runs:
+            if hastag:
+                chunks.append(MergeTemplate(text[start:end]))
+            else:
+                chunks.append((text[start:end].encode("utf-8"), {}))
+        return chunks
+
+    def render_qp(self, replace: Dict[str, str]) -> bytes:
+        if self._qp is None:
+            self._qp = self._compile_qp()
+
+        pieces: List[Tuple[bytes, Dict[bool, bytes] | None]] = []
+        for chunk in self._qp:
+            if isinstance(chunk, MergeTemplate):
+                pieces.append((chunk.render(replace).encode("utf-8"), None))
+            else:
+                pieces.append(chunk)
+
+        crlf = False
+        for data, _ in pieces:
+            if b"\n" in data:
+                crlf = _qp_crlf(data)
+                break
+
+        parts = []
+        for data, cache in pieces:
+            if cache is None:
+                parts.append(_qp_encode(data, crlf))
+            else:
+                if crlf not in cache:
+                    cache[crlf] = _qp_encode(data, crlf)
+                parts.append(cache[crlf])
+        return b"".join(parts)
+
+
 def ses_send(
     ses: JsonObj,
     frm: str,
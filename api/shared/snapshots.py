@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import struct
+import hashlib
+from array import array
+from io import BytesIO
+from typing import Any, Dict, List, Tuple
+from .s3 import s3_write, s3_mmap, s3_list, s3_delete
+from .utils import redis_connect
+from .db import DB, JsonObj
+from .log import get_logger
+
+log = get_logger()
+
+# Rows built by get_segment_rows for unfiltered scans are cached per (cid,
+# bucket, lists) in a columnar file in the transfer bucket.  Files are keyed
+# by a per-customer contact version which every write to the contact tables
+# bumps once it has committed, so a stale snapshot is simply never looked up
+# again; the ttl only bounds how long unused files stay around.
+SNAPSHOT_TTL = int(os.environ.get("segment_snapshot_ttl", "900"))
+
+_MAGIC = b"EDSNAP01"
+
+_SCALAR_COLUMNS = (
+    ("!!added", "added"),
+    ("!!added_index", "added_index"),
+    ("!!lastactivity", "lastactivity"),
+)
+
+_SET_COLUMNS = (
+    ("!!list", "list"),
+    ("!!tags", "tags"),
+    ("!!device", "device"),
+    ("!!os", "os"),
+    ("!!browser", "browser"),
+    ("!!country", "country"),
+    ("!!region", "region"),
+    ("!!zip", "zip"),
+)
+
+_SPECIAL = frozenset(
+    ["Email", "!!open-logs", "!!click-logs"]
+    + [k for k, _ in _SCALAR_COLUMNS]
+    + [k for k, _ in _SET_COLUMNS]
+)
+
+
+def contacts_version(cid: str) -> int:
+    return int(redis_connect().get("contactsversion-%s" % cid) or 0)
+
+
+def bump_contacts_version(db: DB, cid: str) -> None:
+    # bumping before the write is visible would let a reader cache the old
+    # rows under the new version
+    db.on_commit(lambda: redis_connect().incr("contactsversion-%s" % cid))
+
+
+def snapshot_metrics() -> str:
+    """Snapshot lookup counters, in the prometheus text format."""
+    stats = redis_connect().hgetall("snapshotstats")
+    lines = []
+    for stat in ("hit", "miss"):
+        name = "edcom_segment_snapshot_%s_total" % stat
+        lines.append("# TYPE %s counter" % name)
+        lines.append("%s %s" % (name, int(stats.get(stat.encode("utf-8"), 0))))
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_key(
+    cid: str, hashval: int, hashlimit: int, listfactors: List[str], version: int
+) -> str:
+    lists = hashlib.md5(",".join(sorted(listfactors)).encode("utf-8")).hexdigest()
+    return "snapshots/%s/%s-%s-%s/%08d" % (cid, hashlimit, hashval, lists, version)
+
+
+class _Dict:
+
+    def __init__(self) -> None:
+        self.values: List[Any] = []
+        self.index: Dict[Any, int] = {}
+
+    def get(self, value: Any) -> int:
+        i = self.index.get(value)
+        if i is None:
+            i = len(self.values)
+            self.index[value] = i
+            self.values.append(value)
+        return i
+
+
+def _encode(rows: List[JsonObj]) -> bytes:
+    columns: Dict[str, array[int] | bytes] = {}
+    dicts: Dict[str, _Dict] = {}
+
+    columns["email"] = "\n".join(row["Email"][0] for row in rows).encode("utf-8")
+    columns["props"] = "\n".join(
+        json.dumps({k: v for k, v in row.items() if k not in _SPECIAL}) for row in rows
+    ).encode("utf-8")
+
+    for key, name in _SCALAR_COLUMNS:
+        columns[name] = array("q", (row[key][0] for row in rows))
+
+    for key, name in _SET_COLUMNS:
+        d = dicts[name] = _Dict()
+        off = array("I", [0])
+        val = array("I")
+        for row in rows:
+            val.extend(d.get(v) for v in row[key])
+            off.append(len(val))
+        columns[f"{name}.off"] = off
+        columns[f"{name}.val"] = val
+
+    campids = dicts["campid"] = _Dict()
+
+    off = array("I", [0])
+    ts = array("q")
+    camp = array("I")
+    for row in rows:
+        for t, campid in row["!!open-logs"]:
+            ts.append(t)
+            camp.append(campids.get(campid))
+        off.append(len(ts))
+    columns["open.off"] = off
+    columns["open.ts"] = ts
+    columns["open.camp"] = camp
+
+    off = array("I", [0])
+    ts = array("q")
+    camp = array("I")
+    link = array("q")
+    upd = array("q")
+    for row in rows:
+        for t, (campid, linkindex, updatedts) in row["!!click-logs"]:
+            ts.append(t)
+            camp.append(campids.get(campid))
+            link.append(linkindex)
+            upd.append(updatedts or 0)
+        off.append(len(ts))
+    columns["click.off"] = off
+    columns["click.ts"] = ts
+    columns["click.camp"] = camp
+    columns["click.link"] = link
+    columns["click.upd"] = upd
+
+    body = BytesIO()
+    layout: Dict[str, Tuple[str, int, int]] = {}
+    for name, col in columns.items():
+        data = col if isinstance(col, bytes) else col.tobytes()
+        typecode = "B" if isinstance(col, bytes) else col.typecode
+        layout[name] = (typecode, body.tell(), len(data))
+        body.write(data)
+        body.write(b"\0" * (-body.tell() % 8))
+
+    header = json.dumps(
+        {
+            "created": time.time(),
+            "count": len(rows),
+            "columns": layout,
+            "dicts": {name: d.values for name, d in dicts.items()},
+        }
+    ).encode("utf-8")
+    header += b" " * (-(len(_MAGIC) + 4 + len(header)) % 8)
+
+    return _MAGIC + struct.pack("<I", len(header)) + header + body.getvalue()
+
+
+def _decode(buf: memoryview, ttl: int) -> List[JsonObj] | None:
+    if bytes(buf[: len(_MAGIC)]) != _MAGIC:
+        return None
+    (headerlen,) = struct.unpack("<I", buf[len(_MAGIC) : len(_MAGIC) + 4])
+    start = len(_MAGIC) + 4
+    header = json.loads(bytes(buf[start : start + headerlen]))
+    if header["created"] < time.time() - ttl:
+        return None
+    start += headerlen
+
+    def col(name: str) -> Any:
+        typecode, offset, length = header["columns"][name]
+        data = buf[start + offset : start + offset + length]
+        if typecode == "B":
+            return bytes(data)
+        return data.cast(typecode)
+
+    count = header["count"]
+    if count == 0:
+        return []
+
+    dicts = header["dicts"]
+    emails = col("email").decode("utf-8").split("\n")
+    props = col("props").decode("utf-8").split("\n")
+    scalars = [(key, col(name)) for key, name in _SCALAR_COLUMNS]
+    sets = [
+        (key, dicts[name], col(f"{name}.off"), col(f"{name}.val"))
+        for key, name in _SET_COLUMNS
+    ]
+    campids = dicts["campid"]
+    openoff, opents, opencamp = col("open.off"), col("open.ts"), col("open.camp")
+    clickoff, clickts, clickcamp, clicklink, clickupd = (
+        col("click.off"),
+        col("click.ts"),
+        col("click.camp"),
+        col("click.link"),
+        col("click.upd"),
+    )
+
+    rows = []
+    for i in range(count):
+        row: JsonObj = json.loads(props[i])
+        row["Email"] = [emails[i]]
+        for key, c in scalars:
+            row[key] = [c[i]]
+        for key, values, off, val in sets:
+            row[key] = [values[v] for v in val[off[i] : off[i + 1]]]
+        row["!!open-logs"] = [
+            [opents[j], campids[opencamp[j]]] for j in range(openoff[i], openoff[i + 1])
+        ]
+        row["!!click-logs"] = [
+            [
+                clickts[j],
+                [campids[clickcamp[j]], clicklink[j], clickupd[j] or None],
+            ]
+            for j in range(clickoff[i], clickoff[i + 1])
+        ]
+        row["!!tags"] = set(row["!!tags"])
+        rows.append(row)
+    return rows
+
+
+def read_snapshot(key: str) -> List[JsonObj] | None:
+    if SNAPSHOT_TTL <= 0:
+        return None
+    rows = _read_snapshot(key)
+    redis_connect().hincrby("snapshotstats", "miss" if rows is None else "hit", 1)
+    return rows
+
+
+def _read_snapshot(key: str) -> List[JsonObj] | None:
+    try:
+        mm = s3_mmap(os.environ["s3_transferbucket"], key)
+    except FileNotFoundError:
+        return None
+    try:
+        with memoryview(mm) as buf:
+            return _decode(buf, SNAPSHOT_TTL)
+    except Exception:
+        log.exception("error reading snapshot %s", key)
+        return None
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            pass
+
+
+def write_snapshot(key: str, rows: List[JsonObj]) -> None:
+    if SNAPSHOT_TTL <= 0:
+        return
+    bucket = os.environ["s3_transferbucket"]
+    prefix = key.rsplit("/", 1)[0] + "/"
+    s3_write(bucket, key, _encode(rows))
+    for obj in s3_list(bucket, prefix):
+        if obj.key != key:
+            try:
+                s3_delete(bucket, obj.key)
+            except FileNotFoundError:
+                pass
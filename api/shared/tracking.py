@@ -0,0 +1,48 @@
+import json
+from datetime import datetime
+from typing import Tuple, TypeAlias
+from .utils import redis_connect
+
+# Tracking ids are written to redis as messages are handed to a sink so that
+# the Track endpoint can resolve an open or click with a single lookup instead
+# of probing every sink's tracking table.  Entries only need to outlive the
+# burst of events right after a send; older ids fall back to the tables.
+TRACKING_EXPIRE = 60 * 60 * 72
+
+# sinkid, settingsid, ip, ts, cid of the sink settings (None if not known)
+TrackingInfo: TypeAlias = Tuple[str, str, str, datetime | None, str | None]
+
+
+def tracking_key(trackingid: str) -> str:
+    return "trackinfo-%s" % trackingid
+
+
+def set_tracking(
+    trackingid: str,
+    sinkid: str,
+    settingsid: str,
+    ip: str,
+    ts: datetime | None,
+    cid: str | None = None,
+) -> None:
+    redis_connect().set(
+        tracking_key(trackingid),
+        json.dumps(
+            [sinkid, settingsid, ip, ts.isoformat() if ts is not None else None, cid]
+        ),
+        ex=TRACKING_EXPIRE,
+    )
+
+
+def get_tracking(trackingid: str) -> TrackingInfo | None:
+    data = redis_connect().get(tracking_key(trackingid))
+    if data is None:
+        return None
+    sinkid, settingsid, ip, ts, cid = json.loads(data)
+    return (
+        sinkid,
+        settingsid,
+        ip,
+        datetime.fromisoformat(ts) if ts is not None else None,
+        cid,
+    )
@@ -8,6 +8,8 @@ import hashlib
 import requests
 import string
 import time
+import threading
+from collections import OrderedDict
 from functools import wraps
 import falcon
 import redis
@@ -19,9 +21,9 @@ from io import StringIO, IOBase
 from random_words.random_words import Random as RandomWordDB
 from urllib.parse import urlparse
 from html import escape as html_escape
-from typing import Tuple, Dict, List, Any, cast, Callable
+from typing import Tuple, Dict, List, Any, Iterable, Set, cast, Callable
 
-from .db import json_iter, json_obj, JsonObj, DB
+from .db import json_obj, JsonObj, DB
 from .s3 import s3_write, s3_size
 from . import jsnotify
 from . import foundation
@@ -487,28 +489,32 @@ browser_names = {
 }
 
 
-def get_browser(agent: str) -> int:
-    if "firefox" in agent:
+def _browser(tokens: Set[str]) -> int:
+    if "firefox" in tokens:
         return BROWSER_FIREFOX
-    if "chromium" in agent:
+    if "chromium" in tokens:
         return BROWSER_CHROMIUM
-    if "chrome" in agent:
+    if "chrome" in tokens:
         return BROWSER_CHROME
-    if ("safari" in agent) or ("applewebkit" in agent):
+    if ("safari" in tokens) or ("applewebkit" in tokens):
         return BROWSER_SAFARI
-    if "opr" in agent or "opera" in agent:
+    if "opr" in tokens or "opera" in tokens:
         return BROWSER_OPERA
-    if "msie" in agent or "trident" in agent:
+    if "msie" in tokens or "trident" in tokens:
         return BROWSER_MSIE
-    if "bot" in agent:
+    if "bot" in tokens:
         return BROWSER_ROBOT
-    if "outlook" in agent:
+    if "outlook" in tokens:
         return BROWSER_OUTLOOK
-    if "thunderbird" in agent:
+    if "thunderbird" in tokens:
         return BROWSER_THUNDERBIRD
     return BROWSER_UNKNOWN
 
 
+def get_browser(agent: str) -> int:
+    return _browser(_agent_tokens(agent))
+
+
 OS_UNKNOWN = 0
 OS_WINDOWS = 1
 OS_IOS = 2
@@ -526,20 +532,24 @@ os_names = {
 }
 
 
-def get_os(agent: str) -> int:
-    if "windows" in agent:
+def _os(tokens: Set[str]) -> int:
+    if "windows" in tokens:
         return OS_WINDOWS
-    if ("ios" in agent) or ("iphone" in agent) or ("ipad" in agent):
+    if ("ios" in tokens) or ("iphone" in tokens) or ("ipad" in tokens):
         return OS_IOS
-    if "android" in agent:
+    if "android" in tokens:
         return OS_ANDROID
-    if "macintosh" in agent:
+    if "macintosh" in tokens:
         return OS_MAC
-    if "linux" in agent:
+    if "linux" in tokens:
         return OS_LINUX
     return OS_UNKNOWN
 
 
+def get_os(agent: str) -> int:
+    return _os(_agent_tokens(agent))
+
+
 DEVICE_UNKNOWN = 0
 DEVICE_PHONE = 1
 DEVICE_TABLET = 2
@@ -553,12 +563,11 @@ device_names = {
 }
 
 
-def get_device(agent: str) -> int:
-    if "ipad" in agent:
+def _device(tokens: Set[str], os: int) -> int:
+    if "ipad" in tokens:
         return DEVICE_TABLET
-    if "mobi" in agent:
+    if "mobi" in tokens:
         return DEVICE_PHONE
-    os = get_os(agent)
     if os == OS_UNKNOWN:
         return DEVICE_UNKNOWN
     elif os in (OS_IOS, OS_ANDROID):
@@ -567,6 +576,43 @@ def get_device(agent: str) -> int:
         return DEVICE_PC
 
 
+def get_device(agent: str) -> int:
+    tokens = _agent_tokens(agent)
+    return _device(tokens, _os(tokens))
+
+
+# Every substring the browser, os and device checks look for.  The lookahead
+# reports overlapping occurrences, so one scan of the agent finds the same
+# set of tokens as testing each substring on its own.
+_AGENT_TOKENS = (
+    "firefox",
+    "chromium",
+    "chrome",
+    "safari",
+    "applewebkit",
+    "opr",
+    "opera",
+    "msie",
+    "trident",
+    "bot",
+    "outlook",
+    "thunderbird",
+    "windows",
+    "ios",
+    "iphone",
+    "ipad",
+    "android",
+    "macintosh",
+    "linux",
+    "mobi",
+)
+_agentre = re.compile("(?=(%s))" % "|".join(_AGENT_TOKENS))
+
+
+def _agent_tokens(agent: str) -> Set[str]:
+    return {m.group(1) for m in _agentre.finditer(agent)}
+
+
 def run_tasks(paramsets: List[Tuple[Any, ...]]) -> None:
     for paramset in paramsets:
         run_task(*paramset)
@@ -652,6 +698,63 @@ class MPDictReader(object):
             raise StopIteration()
 
 
+class LRUCache(object):
+    """Small thread-safe in-process LRU for rows that are read far more often
+    than they change; entries older than ttl seconds are treated as missing."""
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict[Any, Tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            ts, value = item
+            if self.ttl is not None and ts < time.monotonic() - self.ttl:
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def put(self, key: Any, value: Any) -> None:
+        with self.lock:
+            self.data[key] = (time.monotonic(), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+
+# Opens come from a small set of mail clients and image proxies, so the same
+# user-agent strings repeat across millions of tracked events.
+AGENT_CACHE_SIZE = 10000
+
+_agent_cache = LRUCache(AGENT_CACHE_SIZE)
+
+
+def classify_agent(useragent: str) -> Tuple[int, int, int]:
+    """Returns (os, browser, device) for a raw user-agent string."""
+    result = _agent_cache.get(useragent)
+    if result is None:
+        tokens = _agent_tokens(useragent.lower())
+        os = _os(tokens)
+        result = (os, _browser(tokens), _device(tokens, os))
+        _agent_cache.put(useragent, result)
+    return cast(Tuple[int, int, int], result)
+
+
+def classify_agents(useragents: Iterable[str]) -> Dict[str, Tuple[int, int, int]]:
+    """Classifies each distinct user-agent in a batch of events once."""
+    return {ua: classify_agent(ua) for ua in set(useragents)}
+
+
 urlstartre = re.compile(r"^[a-zA-Z]+:")
 linkre = re.compile(r'(<\s*a\s+[^>]*href\s*=\s*")([^"]+)("[^>]*>)', re.I)
 imgre = re.compile(r'(<\s*img\s+[^>]*src\s*=\s*")(data:[^"]+)', re.I)
@@ -1531,72 +1634,146 @@ def unix_time_secs(dt: datetime) -> int:
     return int(unix_time_millis(dt) / 1000)
 
 
-def gather_init(db: DB, name: str, count: int) -> str:
-    return db.taskgather.add(
-        {
-            "name": name,
-            "count": 0,
-            "limit": count,
-            "ts": datetime.utcnow().isoformat() + "Z",
-        }
-    )
+# Scatter/gather state lives in redis: a hash per gather holding its name,
+# limit and an atomic completion counter, and a list of the results posted
+# by its tasks.  Every gather is also indexed by start time in GATHER_INDEX
+# so that ones which never complete can be reported.
+GATHER_TTL = 60 * 60 * 24 * 3
+GATHER_INDEX = "gathers"
+
+# KEYS: gather hash, results list, index.  ARGV: gather id, result json (or
+# empty for none), "1" to collect the results once the limit is reached.
+_GATHER_COMPLETE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+  return false
+end
+if ARGV[2] ~= '' then
+  redis.call('rpush', KEYS[2], ARGV[2])
+  redis.call('pexpire', KEYS[2], redis.call('pttl', KEYS[1]))
+end
+local count = redis.call('hincrby', KEYS[1], 'count', 1)
+if ARGV[3] == '1' and count >= tonumber(redis.call('hget', KEYS[1], 'limit')) then
+  local ret = redis.call('lrange', KEYS[2], 0, -1)
+  redis.call('del', KEYS[1], KEYS[2])
+  redis.call('zrem', KEYS[3], ARGV[1])
+  return ret
+end
+return false
+"""
+
+# KEYS: gather hash, results list, index.  ARGV: gather id.
+_GATHER_CHECK_SCRIPT = """
+local state = redis.call('hmget', KEYS[1], 'count', 'limit')
+if not state[1] or tonumber(state[1]) < tonumber(state[2]) then
+  return false
+end
+local ret = redis.call('lrange', KEYS[2], 0, -1)
+redis.call('del', KEYS[1], KEYS[2])
+redis.call('zrem', KEYS[3], ARGV[1])
+return ret
+"""
+
+_gather_complete_script: Any = None
+_gather_check_script: Any = None
+
+
+def _gather_keys(gatherid: str) -> List[str]:
+    return ["gather-%s" % gatherid, "gatherdata-%s" % gatherid, GATHER_INDEX]
+
+
+def _gather_results(ret: List[bytes] | None) -> List[JsonObj] | None:
+    if ret is None:
+        return None
+    return [json.loads(r) for r in ret]
+
+
+def gather_init(db: DB, name: str, count: int, cid: str | None = None) -> str:
+    """Starts a gather of count results.  Gathers which fan out over a
+    company's hash buckets pass its cid, see gathers_running."""
+    gatherid = shortuuid.uuid()
+    key = _gather_keys(gatherid)[0]
+    mapping: Dict[str, Any] = {
+        "name": name,
+        "count": 0,
+        "limit": count,
+        "ts": datetime.utcnow().isoformat() + "Z",
+    }
+    if cid is not None:
+        mapping["cid"] = cid
+    with redis_connect().pipeline() as pipe:
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, GATHER_TTL)
+        pipe.zadd(GATHER_INDEX, {gatherid: time.time()})
+        pipe.execute()
+    return gatherid
 
 
 def gather_check(db: DB, gatherid: str) -> List[JsonObj] | None:
-    if db.single(
-        "select 1 from taskgather where id = %s and (data->>'count')::int >= (data->>'limit')::int",
-        gatherid,
-    ):
-        db.taskgather.remove(gatherid)
-        ret = list(
-            json_iter(
-                db.execute(
-                    "select id, cid, data from taskgatherdata where data->>'gatherid' = %s",
-                    gatherid,
-                )
-            )
-        )
-        if len(ret):
-            db.execute(
-                "delete from taskgatherdata where data->>'gatherid' = %s", gatherid
-            )
-        return ret
-    return None
+    global _gather_check_script
+
+    if _gather_check_script is None:
+        _gather_check_script = redis_connect().register_script(_GATHER_CHECK_SCRIPT)
+
+    return _gather_results(
+        _gather_check_script(keys=_gather_keys(gatherid), args=[gatherid])
+    )
 
 
 def gather_complete(
     db: DB, gatherid: str, data: JsonObj | None, remove: bool = True
 ) -> List[JsonObj] | None:
+    global _gather_complete_script
+
+    if _gather_complete_script is None:
+        _gather_complete_script = redis_connect().register_script(
+            _GATHER_COMPLETE_SCRIPT
+        )
+
+    result = ""
     if data is not None:
         data["gatherid"] = gatherid
         data["ts"] = datetime.utcnow().isoformat() + "Z"
-        db.taskgatherdata.add(data)
+        result = json.dumps(data)
 
-    if remove:
-        if db.single(
-            "update taskgather set data = data || jsonb_build_object('count', (data->>'count')::int + 1) where id = %s returning (data->>'count')::int >= (data->>'limit')::int",
-            gatherid,
-        ):
-            db.taskgather.remove(gatherid)
-            ret = list(
-                json_iter(
-                    db.execute(
-                        "select id, cid, data from taskgatherdata where data->>'gatherid' = %s",
-                        gatherid,
-                    )
-                )
-            )
-            if len(ret):
-                db.execute(
-                    "delete from taskgatherdata where data->>'gatherid' = %s", gatherid
-                )
-            return ret
-    else:
-        db.execute(
-            "update taskgather set data = data || jsonb_build_object('count', (data->>'count')::int + 1) where id = %s",
-            gatherid,
+    return _gather_results(
+        _gather_complete_script(
+            keys=_gather_keys(gatherid),
+            args=[gatherid, result, "1" if remove else "0"],
+        )
+    )
+
+
+def gathers_running(cid: str, before: float) -> bool:
+    """Whether a gather for cid started before the given unix time is still
+    running."""
+    rdb = redis_connect()
+    for gatherid in rdb.zrangebyscore(GATHER_INDEX, "-inf", before):
+        gathercid = rdb.hget(_gather_keys(gatherid.decode("utf-8"))[0], "cid")
+        if gathercid is not None and gathercid.decode("utf-8") == cid:
+            return True
+    return False
+
+
+def gather_stragglers(age: int) -> List[JsonObj]:
+    """Gathers started more than age seconds ago which haven't completed."""
+    rdb = redis_connect()
+    ret = []
+    for gatherid in rdb.zrangebyscore(GATHER_INDEX, "-inf", time.time() - age):
+        gatherid = gatherid.decode("utf-8")
+        state = rdb.hgetall(_gather_keys(gatherid)[0])
+        if not state:
+            rdb.zrem(GATHER_INDEX, gatherid)
+            continue
+        ret.append(
+            {
+                "id": gatherid,
+                "name": state[b"name"].decode("utf-8"),
+                "count": int(state[b"count"]),
+                "limit": int(state[b"limit"]),
+                "ts": state[b"ts"].decode("utf-8"),
+            }
         )
-    return None
+    return ret
 
 
 def user_log(
@@ -1,55 +1,105 @@
+import os
 import json
-from typing import List, Dict
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Dict, Set, Tuple
 import requests
-from .utils import run_task, run_task_delay, redis_connect, get_webhost
+from requests.adapters import HTTPAdapter
+from .utils import run_task, run_task_delay, redis_connect, get_webhost, LRUCache
 from .tasks import tasks, NORMAL_PRIORITY
 from .db import DB, JsonObj
 from .log import get_logger
 
 log = get_logger()
 
+# Each company's hooks are cached per process under a version number in redis
+# which every hook change bumps; the ttl is a backstop for changes made in a
+# transaction that hadn't committed when the hooks were reloaded.
+WEBHOOK_CACHE_TTL = 60
+
+# Deliveries to an endpoint share a small pool of keep-alive connections.  An
+# endpoint that keeps failing is skipped for a growing interval instead of
+# holding a worker through one timeout after another.
+WEBHOOK_CONCURRENCY = int(os.environ.get("webhook_concurrency", "8"))
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_TIMEOUT = (5, 10)
+WEBHOOK_RETRIES = 2
+WEBHOOK_RETRY_DELAY = 20
+WEBHOOK_BREAKER_FAILURES = 5
+WEBHOOK_BREAKER_OPEN = 30
+WEBHOOK_BREAKER_MAX = 60 * 60
+
+_hooks_cache = LRUCache(4096, ttl=WEBHOOK_CACHE_TTL)
+
+multieventtypes = {
+    "open": ["open", "open_click"],
+    "click": ["click", "open_click"],
+    "unsub": ["unsub", "unsub_complaint"],
+    "complaint": ["complaint", "unsub_complaint"],
+}
+
+
+def webhooks_version_key(cid: str) -> str:
+    return "resthooksversion-%s" % cid
+
+
+def invalidate_webhooks(cid: str) -> None:
+    redis_connect().incr(webhooks_version_key(cid))
+
+
+def load_webhooks(db: DB, cid: str, version: int) -> Dict[str, List[JsonObj]]:
+    key = (cid, version)
+    rh: Dict[str, List[JsonObj]] | None = _hooks_cache.get(key)
+    if rh is None:
+        rh = {}
+        oldcid = db.get_cid()
+        try:
+            db.set_cid(cid)
+
+            for hook in db.resthooks.get_all():
+                rh.setdefault(hook["event"], []).append(hook)
+        finally:
+            db.set_cid(oldcid)
+        _hooks_cache.put(key, rh)
+    return rh
+
+
+def event_types(event: JsonObj) -> List[str]:
+    t = event["type"]
+    if t == "bounce":
+        if event["bouncetype"] == "hard":
+            return ["bounce", "hard_bounce"]
+        else:
+            return ["bounce", "soft_bounce"]
+    return multieventtypes.get(t, [t])
+
 
 def send_webhooks(db: DB, cid: str, events: List[JsonObj]) -> None:
-    rh: Dict[str, List[JsonObj]] = {}
-    oldcid = db.get_cid()
-    try:
-        db.set_cid(cid)
-
-        for hook in db.resthooks.get_all():
-            ev = hook["event"]
-            if ev not in rh:
-                rh[ev] = []
-            rh[ev].append(hook)
-    finally:
-        db.set_cid(oldcid)
+    typed = [(event, event_types(event)) for event in events]
 
-    rdb = redis_connect()
+    # only the last event of each type is kept for polling
+    lastevents = {}
+    for event, resteventtypes in typed:
+        for resteventtype in resteventtypes:
+            lastevents[resteventtype] = event
 
-    msgs_by_url: Dict[str, List[JsonObj]] = {}
+    pipe = redis_connect().pipeline(transaction=False)
+    for resteventtype, event in lastevents.items():
+        pipe.set("lastevent-%s-%s" % (cid, resteventtype), json.dumps(event))
+    pipe.get(webhooks_version_key(cid))
+    version = int(pipe.execute()[-1] or 0)
 
-    multieventtypes = {
-        "open": ["open", "open_click"],
-        "click": ["click", "open_click"],
-        "unsub": ["unsub", "unsub_complaint"],
-        "complaint": ["complaint", "unsub_complaint"],
-    }
-
-    for event in events:
-        t = event["type"]
-        if t == "bounce":
-            if event["bouncetype"] == "hard":
-                resteventtypes = ["bounce", "hard_bounce"]
-            else:
-                resteventtypes = ["bounce", "soft_bounce"]
-        else:
-            resteventtypes = multieventtypes.get(t, [t])
+    rh = load_webhooks(db, cid, version)
+    if not rh:
+        return
 
-        for resteventtype in resteventtypes:
-            rdb.set("lastevent-%s-%s" % (cid, resteventtype), json.dumps(event))
+    msgs_by_url: Dict[str, List[JsonObj]] = {}
 
-            if resteventtype not in rh:
-                continue
-            for h in rh[resteventtype]:
+    for event, resteventtypes in typed:
+        for resteventtype in resteventtypes:
+            for h in rh.get(resteventtype, ()):
                 url = h["target_url"]
                 if url not in msgs_by_url:
                     msgs_by_url[url] = []
@@ -57,50 +107,142 @@ def send_webhooks(db: DB, cid: str, events: List[JsonObj]) -> None:
                     {
                         "event": event,
                         "remove_id": h["id"],
+                        "cid": cid,
+                        "batch": bool(h.get("batch")),
                     }
                 )
 
+    # events written inside a transaction are only posted once it commits
     for url, msgs in msgs_by_url.items():
-        run_task(send_webhooks_task, url, 0, msgs)
+        db.on_commit(partial(run_task, send_webhooks_task, url, 0, msgs))
+
+
+def webhook_posts(msgs: List[JsonObj]) -> List[List[JsonObj]]:
+    """Groups messages into requests: hooks that accept batches get up to
+    WEBHOOK_BATCH_SIZE events per post, all others one event each."""
+    batched = [msg for msg in msgs if msg.get("batch")]
+    return [[msg] for msg in msgs if not msg.get("batch")] + [
+        batched[i : i + WEBHOOK_BATCH_SIZE]
+        for i in range(0, len(batched), WEBHOOK_BATCH_SIZE)
+    ]
 
 
 @tasks.task(priority=NORMAL_PRIORITY)
 def send_webhooks_task(url: str, retries: int, msgs: List[JsonObj]) -> None:
-    db = None
-
-    to_retry = []
-
-    try:
-        with requests.Session() as session:
-            session.max_redirects = 2
-            for msg in msgs:
-                event = msg["event"]
-                remove_id = msg["remove_id"]
-                log.info("Webhook sending %s to %s", event["type"], url)
-                try:
-                    r = session.post(
-                        url,
-                        json=event,
-                        headers={"User-Agent": f"{get_webhost()} webhook"},
-                        timeout=10,
-                    )
-
-                    if r.status_code == 410 and "remove_id" in event:
-                        if db is None:
-                            db = DB()
-                        db.resthooks.remove(remove_id)
-                        log.info("Webhook returned status 410, removed %s", remove_id)
-                    else:
-                        r.raise_for_status()
-
-                        log.info("Webhook Success")
-                except Exception as e:
-                    log.error("Error: %s", e)
-                    if retries < 2:
-                        to_retry.append(msg)
-
-        if len(to_retry) > 0:
-            run_task_delay(send_webhooks_task, 20, url, retries + 1, to_retry)
-    finally:
-        if db is not None:
+    rdb = redis_connect()
+    urlhash = hashlib.md5(url.encode("utf-8")).hexdigest()
+    breakerkey = "webhookbreaker-%s" % urlhash
+    failkey = "webhookfails-%s" % urlhash
+
+    delay = WEBHOOK_RETRY_DELAY * 2**retries
+
+    wait = rdb.ttl(breakerkey)
+    if wait is not None and wait > 0:
+        log.info("Webhook endpoint %s is failing, deferring %s events", url, len(msgs))
+        to_retry = msgs
+        delay = max(delay, wait)
+    else:
+        to_retry = deliver_webhooks(url, msgs, failkey, breakerkey)
+
+    if len(to_retry) > 0:
+        if retries < WEBHOOK_RETRIES:
+            run_task_delay(send_webhooks_task, delay, url, retries + 1, to_retry)
+        else:
+            log.error("Webhook giving up on %s events for %s", len(to_retry), url)
+
+
+def deliver_webhooks(
+    url: str, msgs: List[JsonObj], failkey: str, breakerkey: str
+) -> List[JsonObj]:
+    """Posts msgs to url and returns the messages that should be retried."""
+    lock = threading.Lock()
+    tripped = threading.Event()
+    failures = 0
+    succeeded = False
+    gone: Set[Tuple[str | None, str]] = set()
+    to_retry: List[JsonObj] = []
+
+    with requests.Session() as session:
+        session.max_redirects = 2
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=WEBHOOK_CONCURRENCY)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        def post(batch: List[JsonObj]) -> None:
+            nonlocal failures, succeeded
+
+            if tripped.is_set():
+                with lock:
+                    to_retry.extend(batch)
+                return
+
+            if batch[0].get("batch"):
+                payload = [msg["event"] for msg in batch]
+            else:
+                payload = batch[0]["event"]
+            log.info(
+                "Webhook sending %s to %s",
+                ",".join(sorted(set(msg["event"]["type"] for msg in batch))),
+                url,
+            )
+            try:
+                r = session.post(
+                    url,
+                    json=payload,
+                    headers={"User-Agent": f"{get_webhost()} webhook"},
+                    timeout=WEBHOOK_TIMEOUT,
+                )
+
+                if r.status_code == 410:
+                    with lock:
+                        gone.update((msg.get("cid"), msg["remove_id"]) for msg in batch)
+                else:
+                    r.raise_for_status()
+
+                    log.info("Webhook Success")
+                with lock:
+                    failures = 0
+                    succeeded = True
+            except Exception as e:
+                log.error("Error: %s", e)
+                with lock:
+                    to_retry.extend(batch)
+                    failures += 1
+                    if failures >= WEBHOOK_BREAKER_FAILURES:
+                        tripped.set()
+
+        posts = webhook_posts(msgs)
+        with ThreadPoolExecutor(min(WEBHOOK_CONCURRENCY, len(posts))) as pool:
+            list(pool.map(post, posts))
+
+    rdb = redis_connect()
+    if succeeded and not tripped.is_set():
+        rdb.delete(failkey)
+    elif failures > 0:
+        total = (
+            rdb.pipeline()
+            .incrby(failkey, failures)
+            .expire(failkey, WEBHOOK_BREAKER_MAX)
+            .execute()[0]
+        )
+        if total >= WEBHOOK_BREAKER_FAILURES:
+            openfor = min(
+                WEBHOOK_BREAKER_MAX,
+                WEBHOOK_BREAKER_OPEN
+                * 2 ** ((total - WEBHOOK_BREAKER_FAILURES) // WEBHOOK_BREAKER_FAILURES),
+            )
+            log.info("Webhook endpoint %s failing, pausing for %ss", url, openfor)
+            rdb.set(breakerkey, 1, ex=openfor)
+
+    if gone:
+        db = DB()
+        try:
+            for _, remove_id in gone:
+                db.resthooks.remove(remove_id)
+                log.info("Webhook returned status 410, removed %s", remove_id)
+            for cid in set(cid for cid, _ in gone if cid):
+                invalidate_webhooks(cid)
+        finally:
             db.close()
+
+    return to_retry
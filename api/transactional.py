@@ -27,7 +27,7 @@ from .shared.utils import (
 )
 from .shared.send import (
     send_backend_mail,
-    check_send_limit,
+    check_send_limits,
     check_test_limit,
     load_domain_throttles,
 )
@@ -1095,16 +1095,15 @@ def check_txns() -> None:
 
                         domainthrottles = load_domain_throttles(db, company)
 
-                        for cnt, route, domain in list(
-                            db.execute(
+                        groups = [
+                            (route, domain, min(cnt, 1000))
+                            for cnt, route, domain in db.execute(
                                 "select count(id), route, domain from txnqueue where cid = %s group by route, domain having count(id) > 0",
                                 cid,
                             )
-                        ):
-                            requesting = min(cnt, 1000)
-                            cnt = check_send_limit(
-                                company, route, domain, domainthrottles, requesting
-                            )
+                        ]
+                        grants = check_send_limits(company, domainthrottles, groups)
+                        for (route, domain, requesting), cnt in zip(groups, grants):
                             if cnt > 0:
                                 log.debug(
                                     "%s clear to send %s transactional, route: %s, domain: %s (requested %s)",
@@ -45,6 +45,7 @@ interface SearchState {
   fields: string[]
   beforeEmail: string | null
   afterEmail: string | null
+  cursor: string | null
 }
 
 export function ContactsFindPage() {
@@ -75,6 +76,7 @@ export function ContactsFindPage() {
     fields: [],
     beforeEmail: null,
     afterEmail: null,
+    cursor: null,
   })
 
   // Selection state
@@ -229,7 +231,7 @@ export function ContactsFindPage() {
 
   // Initiate search
   const startSearch = useCallback(
-    async (params?: { before?: string; after?: string }) => {
+    async (params?: { before?: string; after?: string; cursor?: string | null }) => {
       setSearch((s) => ({ ...s, status: 'searching' }))
       setSelected(new Set())
       setSelectAll(false)
@@ -237,9 +239,11 @@ export function ContactsFindPage() {
       try {
         const segment = buildSegment(params?.before, params?.after)
 
-        const { data } = await api.post<{ id: string; complete?: boolean; result?: { rows: ContactRecord[]; has_next: boolean; allprops: string[]; count: number } }>(
+        // Paging passes the cursor of the search so the server reads the
+        // page from its stored results instead of searching again
+        const { data } = await api.post<{ id: string; complete?: boolean; result?: { rows: ContactRecord[]; has_next: boolean; allprops: string[]; count: number; cursor?: string } }>(
           `/api/lists/${listId}/find`,
-          segment
+          { ...segment, cursor: params?.cursor || undefined }
         )
 
         // If result is returned immediately (or complete), use it directly
@@ -253,6 +257,7 @@ export function ContactsFindPage() {
             fields: result.allprops || [],
             beforeEmail: params?.before || null,
             afterEmail: params?.after || null,
+            cursor: result.cursor || null,
           }))
           return
         }
@@ -270,7 +275,7 @@ export function ContactsFindPage() {
             const { data: pollResult } = await api.get<{
               complete?: boolean
               error?: string
-              result?: { rows: ContactRecord[]; has_next: boolean; allprops: string[]; count: number }
+              result?: { rows: ContactRecord[]; has_next: boolean; allprops: string[]; count: number; cursor?: string }
             }>(`/api/listfind/${data.id}`)
 
             if (pollResult.error) {
@@ -296,6 +301,7 @@ export function ContactsFindPage() {
               results: result.rows || [],
               total: result.count || result.rows?.length || 0,
               fields: result.allprops || [],
+              cursor: result.cursor || null,
             }))
           } catch {
             if (pollRef.current) clearInterval(pollRef.current)
@@ -403,13 +409,13 @@ export function ContactsFindPage() {
   const goNext = () => {
     const lastResult = search.results[search.results.length - 1]
     const lastEmail = lastResult ? ((lastResult.Email || lastResult.email || '') as string) : ''
-    if (lastEmail) startSearch({ after: lastEmail })
+    if (lastEmail) startSearch({ after: lastEmail, cursor: search.cursor })
   }
 
   const goPrev = () => {
     const firstResult = search.results[0]
     const firstEmail = firstResult ? ((firstResult.Email || firstResult.email || '') as string) : ''
-    if (firstEmail) startSearch({ before: firstEmail })
+    if (firstEmail) startSearch({ before: firstEmail, cursor: search.cursor })
   }
 
   const tabs = [
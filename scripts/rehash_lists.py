@@ -6,14 +6,10 @@ import argparse
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from api.shared.contacts import recalculate_hashlimit
-from api.shared.db import DB
+from api.shared.contacts import rebucket_contacts
 
 parser = argparse.ArgumentParser(prog='rehash_lists', description='Create optimal list indexes')
 parser.add_argument('cid', help='Company ID')
 args = parser.parse_args()
 
-db = DB()
-
-with db.transaction():
-    recalculate_hashlimit(db, args.cid)
+rebucket_contacts(args.cid)
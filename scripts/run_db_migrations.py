@@ -11,7 +11,8 @@ from api.shared.db import DB
 from api.shared import contacts
 from api.migrations import fix_funnel_indexes, create_sp_event_table, add_monthly_limit, fix_templates_for_outlook, \
     remove_limit_incr, add_txnsends_msgid, webhooks_to_resthooks, add_resthooks_created, add_txnsettings_table, \
-    add_list_stats, add_list_unsubscribe_post, add_signupsettings_table, add_beefree_templates, add_savedrows_table
+    add_list_stats, add_list_unsubscribe_post, add_signupsettings_table, add_beefree_templates, add_savedrows_table, \
+    add_campaign_counters, add_segment_members, add_daystats, add_track_entries
 from api.shared.log import get_logger
 
 log = get_logger()
@@ -31,6 +32,10 @@ migration_list = [
     ('add_signupsettings_table', add_signupsettings_table),
     ('add_beefree_templates', add_beefree_templates),
     ('add_savedrows_table', add_savedrows_table),
+    ('add_campaign_counters', add_campaign_counters),
+    ('add_segment_members', add_segment_members),
+    ('add_daystats', add_daystats),
+    ('add_track_entries', add_track_entries),
 ]
 
 def run():
@@ -14,15 +14,11 @@ import api.lists as lists
 procnum = int(os.environ.get('PROCNUM', '0'))
 total   = int(os.environ.get('TOTALPROCS', '1'))
 
+# segments are rescanned in full by age (segment_reconcile_secs) rather
+# than every few passes
 def run():
-    cnt = 0
     while True:
-        force = False
-        if cnt == 29:
-            force = True
-            cnt = 0
-        lists.refresh_all_segments(procnum, total, force)
+        lists.refresh_all_segments(procnum, total, False)
         time.sleep(random.randint(1, 60))
-        cnt += 1
 
 run()
\ No newline at end of file
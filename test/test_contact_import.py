@@ -0,0 +1,180 @@
+import os
+import test_base
+from unittest import mock
+from api.shared import contacts
+from api.shared.contacts import add_blocks, detect_encoding, line_ranges, parse_import_rows
+from api.shared.s3 import s3_list, s3_write
+
+ROWS = [
+    ('amy@importtest.example', 'Amy', 'plain'),
+    ('bob@importtest.example', 'Bob', 'a "quoted" note'),
+    ('carol@importtest.example', 'Carol', 'spans\ntwo lines'),
+    ('dan@importtest.example', 'Dan', 'spans\nthree\nlines, with a comma'),
+    ('erin@importtest.example', 'Erin', '"\n"'),
+    ('frank@importtest.example', 'Frank', ''),
+]
+
+
+def quote(v):
+    return '"%s"' % v.replace('"', '""')
+
+
+def csvdata(rows):
+    return ''.join('%s,%s,%s\n' % (email, name, quote(note)) for email, name, note in rows).encode('utf-8')
+
+
+class TestContactImport(test_base.TestBase):
+
+    def write(self, data):
+        key = 'lists/%s.txt' % self._testMethodName
+        s3_write(os.environ['s3_transferbucket'], key, data)
+        return key
+
+    def parse(self, data, ranges):
+        rows = []
+        for start, end in ranges:
+            text = data[start:end].decode('utf-8')
+            rows.extend(parse_import_rows(text, ['Email', 'First Name', 'Notes'], 'list', False, set()))
+        return rows
+
+    def test_line_ranges(self):
+        data = csvdata(ROWS)
+        key = self.write(data)
+
+        expected = self.parse(data, [(0, len(data))])
+        assert len(expected) == len(ROWS)
+
+        # small samples so that quotes and line ends fall across chunk edges
+        for samplesize in (1, 3, 7, 64 * 1024):
+            with mock.patch.object(contacts, 'INGEST_SAMPLE_SIZE', samplesize):
+                for rangesize in range(1, len(data) + 2):
+                    ranges = line_ranges(key, rangesize)
+
+                    assert ranges[0][0] == 0
+                    assert ranges[-1][1] == len(data)
+                    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                        assert end == start
+                    for start, end in ranges:
+                        # every range but the last ends outside a quoted field,
+                        # and at least rangesize bytes in
+                        assert data[end - 1:end] == b'\n'
+                        assert data[:end].count(b'"') % 2 == 0
+                        if end != len(data):
+                            assert end - start >= rangesize
+
+                    assert self.parse(data, ranges) == expected
+
+        assert line_ranges(key, len(data) + 1) == [(0, len(data))]
+        assert len(line_ranges(key, 1)) == len(ROWS)
+
+    def test_line_ranges_unterminated(self):
+        data = csvdata(ROWS)[:-1]
+        key = self.write(data)
+
+        ranges = line_ranges(key, 1)
+        assert ranges[-1] == (ranges[-2][1], len(data))
+        assert self.parse(data, ranges)[-1] == ('frank@importtest.example', {'First Name': ['Frank'], 'Notes': ['']})
+
+        assert line_ranges(self.write(b''), 1) == []
+
+    def test_detect_encoding(self):
+        assert detect_encoding('Émile,émile@importtest.example\n'.encode('utf-8')) == 'utf-8'
+        assert detect_encoding(b'\xef\xbb\xbfEmail\n') == 'utf-8'
+        # a sample which cuts a character in half is still utf-8
+        assert detect_encoding('Zoë'.encode('utf-8')[:-1]) == 'utf-8'
+        assert detect_encoding('Zoë,zoe@importtest.example\n'.encode('iso-8859-1')) == 'iso-8859-1'
+
+    def test_parse_import_rows(self):
+        text = '\n'.join([
+            'Email,First Name,!!bad,Unsubscribed',
+            'Amy <AMY@ImportTest.example>,Amy,x,true',
+            'not an email,Bob,x,true',
+            'carol@importtest.example',
+            '',
+            ' dan@importtest.example , Dan ,x,,extra',
+        ])
+        colmap = ['Email', 'First Name', '!!bad', 'Unsubscribed']
+
+        used = set()
+        assert list(parse_import_rows(text, colmap, 'list', False, used)) == [
+            ('amy@importtest.example', {'First Name': ['Amy']}),
+            ('carol@importtest.example', {'First Name': ['']}),
+            ('dan@importtest.example', {'First Name': ['Dan']}),
+        ]
+        assert used == {'First Name'}
+
+        used = set()
+        assert list(parse_import_rows(text, colmap, 'list', True, used))[0] == (
+            'amy@importtest.example', {'First Name': ['Amy'], 'Unsubscribed': ['true']}
+        )
+        assert used == {'First Name', 'Unsubscribed'}
+
+        md5 = '0123456789abcdef0123456789ABCDEF'
+        assert [e for e, _ in parse_import_rows(md5, ['Email'], 'supp', False, set())] == [md5.lower()]
+        assert list(parse_import_rows(md5, ['Email'], 'list', False, set())) == []
+
+    def test_duplicates_across_ranges(self):
+        lid, cid = self.create_list('test_duplicates_across_ranges')
+
+        rows = list(ROWS)
+        # the same emails again, in later ranges, with other names
+        rows += [(email.upper(), name + ' Again', note) for email, name, note in ROWS]
+        rows += [(email, name + ' Third', '') for email, name, _ in reversed(ROWS)]
+        data = b'Email,First Name,Notes\n' + csvdata(rows)
+
+        with mock.patch.object(contacts, 'INGEST_RANGE_SIZE', 40):
+            assert len(line_ranges(self.write(data), 40)) > len(ROWS)
+            self.import_list(lid, cid, data)
+
+        # the first occurrence of each email wins
+        assert self.list_contacts(cid, lid) == {
+            email: {'First Name': [name], 'Notes': [note]} for email, name, note in ROWS
+        }
+        assert self.db.lists.get(lid)['count'] == len(ROWS)
+
+        self.user_delete(f'/api/lists/{lid}')
+
+    def test_encodings(self):
+        lid, cid = self.create_list('test_encodings')
+
+        header = b'Email,First Name,Notes\n'
+        names = [('zoe@importtest.example', 'Zoë', ''), ('emile@importtest.example', 'Émile', 'ça\nva')]
+        utf8 = b'\xef\xbb\xbf' + header + csvdata(names)
+        latin1 = header + ''.join('%s,%s,%s\n' % (e, n, quote(o)) for e, n, o in names).encode('iso-8859-1')
+
+        for data in (utf8, latin1):
+            with mock.patch.object(contacts, 'INGEST_RANGE_SIZE', 16):
+                self.import_list(lid, cid, data)
+
+            assert self.list_contacts(cid, lid) == {
+                email: {'First Name': [name], 'Notes': [note]} for email, name, note in names
+            }
+
+        self.user_delete(f'/api/lists/{lid}')
+
+    def create_list(self, name):
+        result = self.user_post('/api/lists', json={
+            'name': name
+        })
+        return result['id'], result['cid']
+
+    def import_list(self, lid, cid, data):
+        key = self.write(data)
+        add_blocks(cid, lid, 'list', key, ['Email', 'First Name', 'Notes'], True)
+
+        lst = self.db.lists.get(lid)
+        assert not lst.get('processing')
+        assert not lst.get('processing_error')
+
+        # the upload and every intermediate file are cleaned up
+        assert s3_list(os.environ['s3_transferbucket'], key) == []
+
+    def list_contacts(self, cid, lid):
+        return {
+            email: {'First Name': props['First Name'], 'Notes': props['Notes']}
+            for email, props in self.db.execute(
+                f'''select c.email, c.props from contacts."contacts_{cid}" c
+                    join contacts."contact_lists_{cid}" l on l.contact_id = c.contact_id
+                    where l.list_id = %s''', lid
+            )
+        }
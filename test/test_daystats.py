@@ -0,0 +1,127 @@
+import random
+import test_base
+from datetime import datetime, timedelta
+from api.shared.daystats import DAYSTATS_COLUMNS, incr_daystats, stat_buckets
+
+CID = 'daystats-test'
+SINKS = ['sink1', 'sink2']
+DOMAINS = ['gmail', 'yahoo', 'other']
+CAMPS = ['tx-daystats', 'camp-daystats', 'msg-daystats', 'gone-daystats']
+SUMS = ['send', 'soft', 'hard', 'err', 'open', 'defercnt']
+
+CAMPSUMS = """sum({table}.open),
+   sum(case when substring({table}.campid from 1 for 3) = 'tx-' then {table}.send else 0 end),
+   sum(case when campaigns.id is not null then {table}.send else 0 end),
+   sum(case when messages.id is not null then {table}.send else 0 end)"""
+CAMPSOURCE = """{table}
+   left join campaigns on campaigns.id = {table}.campid
+   left join messages on messages.id = {table}.campid"""
+
+
+class TestDayStats(test_base.TestBase):
+
+    def setUp(self):
+        super(TestDayStats, self).setUp()
+
+        self.db.execute('delete from hourstats where cid = %s', CID)
+        self.db.execute('delete from daystats where cid = %s', CID)
+        self.db.execute('delete from campdaystats where campcid = %s', CID)
+        self.db.execute("delete from campaigns where id = 'camp-daystats'")
+        self.db.execute("delete from messages where id = 'msg-daystats'")
+        self.db.execute("""insert into campaigns (id, cid, data) values ('camp-daystats', %s, '{}')""", CID)
+        self.db.execute("""insert into messages (id, cid, data) values ('msg-daystats', %s, '{}')""", CID)
+
+        # nine days of hours up to the current one, with a few hours missing
+        rnd = random.Random(25)
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        rows = []
+        ts = hour - timedelta(days=9)
+        while ts <= hour:
+            if rnd.random() > 0.1:
+                for _ in range(rnd.randint(1, 4)):
+                    counts = {c: rnd.randint(0, 20) for c in DAYSTATS_COLUMNS}
+                    rows.append((CID, CID, ts, rnd.choice(SINKS), rnd.choice(DOMAINS), 'settings', rnd.choice(CAMPS), counts))
+            ts += timedelta(hours=1)
+
+        for i, (cid, campcid, ts, sinkid, domain, settingsid, campid, counts) in enumerate(rows):
+            self.db.execute(
+                f"""insert into hourstats (id, cid, campcid, ts, sinkid, domaingroupid, ip, settingsid, campid,
+                                           {", ".join(DAYSTATS_COLUMNS)})
+                    values (%s, %s, %s, %s, %s, %s, %s, %s, %s, {", ".join(["%s"] * len(DAYSTATS_COLUMNS))})""",
+                'daystats-%s' % i, cid, campcid, ts, sinkid, domain, 'ip%s' % i, settingsid, campid,
+                *(counts[c] for c in DAYSTATS_COLUMNS),
+            )
+        # in more than one write, as the event counters do
+        incr_daystats(self.db, rows[::2])
+        incr_daystats(self.db, rows[1::2])
+
+    def tearDown(self):
+        self.db.execute('delete from hourstats where cid = %s', CID)
+        self.db.execute('delete from daystats where cid = %s', CID)
+        self.db.execute('delete from campdaystats where campcid = %s', CID)
+        self.db.execute("delete from campaigns where id = 'camp-daystats'")
+        self.db.execute("delete from messages where id = 'msg-daystats'")
+
+        super(TestDayStats, self).tearDown()
+
+    def ends(self):
+        now = datetime.utcnow()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return [
+            now,
+            now.replace(minute=0, second=0, microsecond=0),
+            midnight,
+            # the next local midnight, east and west of UTC and off the hour
+            midnight + timedelta(days=1) - timedelta(hours=5, minutes=30),
+            midnight + timedelta(days=1) + timedelta(hours=8),
+            midnight + timedelta(days=1) - timedelta(hours=13),
+            now - timedelta(days=3, hours=7, minutes=15),
+        ]
+
+    def old_buckets(self, dayarray, sums, source, where, args, inclusive):
+        buckets = {}
+        for bucket, *vals in self.db.execute(
+            f"""select width_bucket(hourstats.ts, %s) daybucket, {sums.replace('{table}', 'hourstats')}
+                from {source.replace('{table}', 'hourstats')}
+                where {where.replace('{table}', 'hourstats')} and hourstats.ts {'>=' if inclusive else '>'} %s
+                group by daybucket
+                order by daybucket""",
+            dayarray, *args, dayarray[0] - timedelta(days=1),
+        ):
+            if bucket >= len(dayarray):
+                break
+            buckets[bucket] = [int(v or 0) for v in vals]
+        return nonzero(buckets)
+
+    def check(self, rollup, days, sums, source, where, args, inclusive=False):
+        for end in self.ends():
+            dayarray = [end - timedelta(days=days - 1 - i) for i in range(days)]
+
+            expected = self.old_buckets(dayarray, sums, source, where, args, inclusive)
+            assert expected
+
+            result = stat_buckets(
+                self.db, rollup, dayarray, dayarray[0] - timedelta(days=1),
+                sums, source, where, *args, inclusive=inclusive,
+            )
+            assert nonzero(result) == expected, end
+
+    def test_daystats(self):
+        sums = ', '.join('sum({table}.%s)' % c for c in SUMS)
+
+        for days in (1, 2, 7):
+            self.check('daystats', days, sums, '{table}', '{table}.cid = %s', [CID])
+
+        self.check('daystats', 7, sums, '{table}',
+                   '{table}.cid = %s and {table}.domaingroupid = any(%s)', [CID, ['gmail', 'other']])
+        self.check('daystats', 7, sums, '{table}',
+                   '{table}.cid = %s and {table}.domaingroupid = any(%s) and {table}.sinkid = any(%s)',
+                   [CID, ['yahoo'], ['sink2']])
+
+    def test_campdaystats(self):
+        for days in (1, 7, 20):
+            self.check('campdaystats', days, CAMPSUMS, CAMPSOURCE, '{table}.campcid = %s', [CID], inclusive=True)
+
+
+def nonzero(buckets):
+    return {b: vals for b, vals in buckets.items() if any(vals)}
@@ -0,0 +1,100 @@
+import time
+import test_base
+from concurrent.futures import ThreadPoolExecutor
+from api.shared.utils import (
+    GATHER_INDEX,
+    gather_check,
+    gather_complete,
+    gather_init,
+    gather_stragglers,
+    gathers_running,
+    redis_connect,
+)
+
+THREADS = 8
+LIMIT = 50
+
+
+class TestGather(test_base.TestBase):
+
+    def complete_all(self, gatherid, calls, remove=True):
+        with ThreadPoolExecutor(THREADS) as pool:
+            return list(pool.map(
+                lambda i: gather_complete(self.db, gatherid, {'index': i}, remove),
+                range(calls),
+            ))
+
+    def test_complete_once(self):
+        for _ in range(20):
+            gatherid = gather_init(self.db, 'test_complete_once', LIMIT)
+
+            # the completions past the limit are retries of tasks which already completed
+            results = self.complete_all(gatherid, LIMIT + 10)
+
+            done = [r for r in results if r is not None]
+            assert len(done) == 1
+            # the results of the first LIMIT completions, whichever those were
+            indexes = set(d['index'] for d in done[0])
+            assert len(done[0]) == len(indexes) == LIMIT
+            assert indexes <= set(range(LIMIT + 10))
+            assert all(d['gatherid'] == gatherid for d in done[0])
+
+            assert gather_complete(self.db, gatherid, {'index': 0}) is None
+            assert gather_check(self.db, gatherid) is None
+            assert not redis_connect().exists('gather-%s' % gatherid, 'gatherdata-%s' % gatherid)
+            assert redis_connect().zscore(GATHER_INDEX, gatherid) is None
+
+    def test_complete_without_data(self):
+        gatherid = gather_init(self.db, 'test_complete_without_data', 3)
+
+        assert gather_complete(self.db, gatherid, None) is None
+        assert gather_complete(self.db, gatherid, {'index': 1}) is None
+        # completions without data count toward the limit but add no result
+        results = gather_complete(self.db, gatherid, None)
+        assert [r['index'] for r in results] == [1]
+
+    def test_check(self):
+        gatherid = gather_init(self.db, 'test_check', LIMIT)
+
+        assert all(r is None for r in self.complete_all(gatherid, LIMIT - 1, False))
+        assert gather_check(self.db, gatherid) is None
+
+        assert gather_complete(self.db, gatherid, {'index': LIMIT - 1}, False) is None
+
+        with ThreadPoolExecutor(THREADS) as pool:
+            results = list(pool.map(lambda _: gather_check(self.db, gatherid), range(THREADS * 4)))
+        done = [r for r in results if r is not None]
+        assert len(done) == 1
+        assert sorted(d['index'] for d in done[0]) == list(range(LIMIT))
+
+    def test_stragglers(self):
+        rdb = redis_connect()
+        old = time.time() - 3600
+
+        straggler = gather_init(self.db, 'test_stragglers', 3, 'gathercid')
+        gather_complete(self.db, straggler, {'index': 0})
+        finished = gather_init(self.db, 'test_stragglers', 1, 'gathercid')
+        expired = gather_init(self.db, 'test_stragglers', 1)
+        recent = gather_init(self.db, 'test_stragglers', 1, 'gathercid')
+        for gatherid in (straggler, finished, expired):
+            rdb.zadd(GATHER_INDEX, {gatherid: old})
+        gather_complete(self.db, finished, {'index': 0})
+        rdb.delete('gather-%s' % expired)
+
+        stragglers = [s for s in gather_stragglers(600) if s['name'] == 'test_stragglers']
+        assert [(s['id'], s['count'], s['limit']) for s in stragglers] == [(straggler, 1, 3)]
+        # the index entry of a gather which expired is dropped
+        assert rdb.zscore(GATHER_INDEX, expired) is None
+        assert rdb.zscore(GATHER_INDEX, recent) is not None
+
+        assert gathers_running('gathercid', old + 1)
+        assert not gathers_running('othercid', old + 1)
+
+        gather_complete(self.db, straggler, {'index': 1})
+        assert gather_complete(self.db, straggler, {'index': 2}) is not None
+
+        assert not [s for s in gather_stragglers(600) if s['name'] == 'test_stragglers']
+        assert not gathers_running('gathercid', old + 1)
+        assert gathers_running('gathercid', time.time())
+
+        gather_complete(self.db, recent, None)
@@ -0,0 +1,207 @@
+import test_base
+from datetime import datetime, timedelta
+from api.shared.contacts import update
+from api.shared.segments import (
+    get_segment_rows,
+    segment_compile,
+    segment_compile_many,
+    segment_eval_parts,
+    ActivityLogs,
+    Cache,
+    EvalState,
+)
+from api.shared.utils import get_os, get_browser, get_device
+
+AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:101.0) Gecko/20100101 Firefox/101.0'
+
+CONTACTS = [
+    ('amy@petpsychic.com', 'Amy', ['buyer']),
+    ('bob@petpsychic.com', 'Bob', ['buyer', 'vip']),
+    ('carol@example.com', 'Carol', []),
+    ('dan@example.com', ' dan ', ['vip']),
+    ('erin@example.org', '', ['lapsed']),
+    ('frank@example.org', 'Frank', []),
+]
+
+
+def info(prop, operator, value):
+    return {'type': 'Info', 'prop': prop, 'operator': operator, 'value': value}
+
+
+def added(addedtype):
+    return {
+        'type': 'Info',
+        'test': 'added',
+        'addedtype': addedtype,
+        'addednum': 1,
+        'addedstart': (datetime.utcnow() - timedelta(days=60)).isoformat() + 'Z',
+        'addedend': (datetime.utcnow() - timedelta(days=10)).date().isoformat(),
+    }
+
+
+def response(action, campaign='', **kwargs):
+    part = {
+        'type': 'Responses',
+        'action': action,
+        'campaign': campaign,
+        'defaultcampaign': '',
+        'timetype': 'anytime',
+        'timenum': 30,
+        'timestart': (datetime.utcnow() - timedelta(days=60)).isoformat() + 'Z',
+        'timeend': (datetime.utcnow() + timedelta(days=1)).isoformat() + 'Z',
+        'cntoperator': 'more',
+        'cntvalue': 0,
+    }
+    part.update(kwargs)
+    return part
+
+
+def segment(operator, *parts, **kwargs):
+    seg = {'operator': operator, 'parts': list(parts)}
+    seg.update(kwargs)
+    return seg
+
+
+class TestSegmentCompile(test_base.TestBase):
+
+    def test_compile(self):
+        result = self.user_post('/api/lists', json={
+            "name": "test_compile"
+        })
+
+        lid = result['id']
+        cid = result['cid']
+
+        for email, name, tags in CONTACTS:
+            self.user_post(f'/api/lists/{lid}/feed', json={
+                'email': email,
+                'tags': tags,
+                'data': {
+                    'First Name': name,
+                }
+            })
+
+        camp = self.create_broadcast(lid, 'test_compile')
+        campid = camp['id']
+
+        self.update('amy@petpsychic.com', 'open', campid)
+        self.update('bob@petpsychic.com', 'open', campid)
+        self.update('bob@petpsychic.com', 'click', campid, 1)
+        self.update('carol@example.com', 'click', campid, 0)
+
+        sub = segment('or', info('Email', 'endswith', '.org'), {'type': 'Info', 'test': 'tag', 'tag': 'vip'}, id='sub')
+        segments = {'sub': sub, 'missing': None}
+
+        tests = [
+            segment('and', info('First Name', 'equals', 'dan')),
+            segment('and', info('First Name', 'notequals', 'amy')),
+            segment('or', info('First Name', 'startswith', 'b'), info('First Name', 'endswith', 'ol')),
+            segment('and', info('Email', 'contains', 'petpsychic')),
+            segment('and', info('Domain', 'equals', 'example.com')),
+            segment('and', info('!!*', 'contains', 'fra')),
+            segment('and', info('Missing', 'equals', '')),
+            segment('and', {'type': 'Info', 'test': 'tag', 'tag': 'buyer'}),
+            segment('nor', {'type': 'Info', 'test': 'notag', 'tag': 'vip'}),
+            segment('and', added('inpast')),
+            segment('or', added('between'), info('First Name', 'equals', 'Amy')),
+            segment('and', {'type': 'Lists', 'operator': 'in', 'list': lid}),
+            segment('and', {'type': 'Lists', 'operator': 'notin', 'list': 'other'}),
+            segment('and', {'type': 'Lists', 'operator': 'insegment', 'segment': 'sub'}),
+            segment('or', {'type': 'Lists', 'operator': 'notinsegment', 'segment': 'sub'}, info('First Name', 'equals', 'Bob')),
+            segment('and', {'type': 'Lists', 'operator': 'insegment', 'segment': 'missing'}),
+            segment('and', response('opened')),
+            segment('and', response('opened', campid)),
+            segment('and', response('notopened', campid)),
+            segment('and', response('clicked', campid, linkindex=1)),
+            segment('and', response('notclicked')),
+            segment('and', response('openclicked', timetype='inpast', timenum=2)),
+            segment('and', response('notopenclicked', timetype='between')),
+            segment('and', response('openedcnt', cntoperator='equal', cntvalue=1)),
+            segment('and', response('clickedcnt', cntoperator='less', cntvalue=1)),
+            segment('and', response('openclickedcnt', cntoperator='more', cntvalue=1)),
+            segment('and', response('sent', campid)),
+            segment('and', response('notsent', campid)),
+            segment('and', response('from', fromtype='country', fromcountry='United States of America')),
+            segment('and', response('from', fromtype='zip', fromzip='999*')),
+            segment('and', response('opened', campid, addl=[response('clicked', campid)])),
+            segment('and', {'type': 'Group', 'operator': 'or', 'parts': [
+                {'type': 'Info', 'test': 'tag', 'tag': 'lapsed'},
+                {'type': 'Group', 'operator': 'nor', 'parts': [info('Email', 'contains', 'example')]},
+            ]}),
+            segment('and', info('Email', 'contains', 'e'), subset=True, subsettype='count', subsetnum=2, subsetsort='oldest'),
+            segment('and', info('Email', 'contains', 'e'), subset=True, subsettype='pct', subsetpct=50, subsetsort='newest'),
+        ]
+
+        for i, seg in enumerate(tests):
+            seg['id'] = 'seg%s' % i
+
+        rows = get_segment_rows(self.db, cid, 0, [lid], 1)
+        assert len(rows) == len(CONTACTS)
+
+        sentrows = {campid: {'amy@petpsychic.com', 'bob@petpsychic.com', 'carol@example.com'}}
+
+        for seg in tests:
+            pred = segment_compile(seg, segments, 1)
+            state = EvalState(sentrows, len(rows), ActivityLogs(rows))
+            assert [pred(row, state) for row in rows] == self.eval_parts(seg, rows, segments, sentrows), seg
+
+        # segments compiled together share their rules, and are evaluated row
+        # by row like refresh_segment_block does, but keep their own state
+        logs = ActivityLogs(rows)
+        preds = segment_compile_many(tests, segments, 1)
+        states = [EvalState(sentrows, len(rows), logs) for _ in tests]
+        results = [[] for _ in tests]
+        for row in rows:
+            for pred, state, result in zip(preds, states, results):
+                result.append(pred(row, state))
+
+        for seg, result in zip(tests, results):
+            assert result == self.eval_parts(seg, rows, segments, sentrows), seg
+
+    def eval_parts(self, seg, rows, segments, sentrows):
+        segcounts = {}
+        return [
+            segment_eval_parts(seg['parts'], seg['operator'], row, segcounts, len(rows), segments, sentrows, seg, 1, Cache())
+            for row in rows
+        ]
+
+    def create_broadcast(self, lid, name):
+        return self.user_post('/api/broadcasts', json={
+            'name': name,
+            'when': 'draft',
+            'tags': [],
+            'lists': [lid],
+            'segments': [],
+            'supplists': [],
+            'suppsegs': [],
+            'supptags': [],
+            'subject': 'test',
+            'fromname': 'test',
+            'fromemail': '',
+            'returnpath': 'test',
+            'replyto': '',
+            'rawText': '',
+            'type': 'raw',
+            'parts': [],
+            'bodyStyle': {}
+        })
+
+    def update(self, email, ct, c, linkindex=None):
+        upd = {
+            'email': email,
+            'cmd': ct,
+            'campid': c,
+        }
+        if ct == 'click':
+            upd['updatedts'] = None
+            upd['linkindex'] = linkindex
+
+        agentl = AGENT.lower()
+        upd['os'] = get_os(agentl)
+        upd['browser'] = get_browser(agentl)
+        upd['device'] = get_device(agentl)
+        upd['country'] = 'United States of America'
+        upd['region'] = 'California'
+        upd['zip'] = '99999'
+
+        update(self.db, self.user_cookie['cid'], upd)
@@ -0,0 +1,155 @@
+import test_base
+from datetime import datetime
+from api.shared.contacts import erase, update
+from api.shared.utils import get_os, get_browser, get_device
+from api.lists import refresh_company_segments
+
+AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:101.0) Gecko/20100101 Firefox/101.0'
+
+CONTACTS = [
+    ('amy@petpsychic.com', 'Amy', ['buyer']),
+    ('bob@petpsychic.com', 'Bob', ['buyer', 'vip']),
+    ('carol@example.com', 'Carol', []),
+    ('dan@example.com', 'Dan', ['vip']),
+    ('erin@example.org', 'Erin', ['lapsed']),
+]
+
+
+def info(prop, operator, value):
+    return {'type': 'Info', 'prop': prop, 'operator': operator, 'value': value}
+
+
+def tag(t):
+    return {'type': 'Info', 'test': 'tag', 'tag': t}
+
+
+class TestSegmentIncremental(test_base.TestBase):
+
+    def test_incremental(self):
+        result = self.user_post('/api/lists', json={
+            "name": "test_incremental"
+        })
+
+        lid = result['id']
+        cid = result['cid']
+
+        for email, name, tags in CONTACTS:
+            self.feed(lid, email, name, tags)
+
+        camp = self.create_broadcast(lid, 'test_incremental')
+
+        vip = self.create_segment('and', tag('vip'))
+        segids = [
+            vip,
+            self.create_segment('and', info('First Name', 'startswith', 'd')),
+            self.create_segment('or', info('Email', 'endswith', '.org'), tag('buyer')),
+            self.create_segment('and', {'type': 'Responses', 'action': 'opened', 'campaign': '', 'defaultcampaign': '', 'timetype': 'anytime'}),
+            self.create_segment('and', {'type': 'Lists', 'operator': 'insegment', 'list': '', 'segment': vip}),
+        ]
+
+        # feed, update, tag, erase and activity changes
+        self.feed(lid, 'frank@example.org', 'Frank', ['vip'])
+        self.feed(lid, 'carol@example.com', 'Dora', [])
+        self.user_post(f'/api/lists/{lid}/feed', json={
+            'email': 'bob@petpsychic.com',
+            'removetags': ['vip', 'buyer'],
+        })
+        erase(self.db, cid, ['amy@petpsychic.com'])
+        self.update('dan@example.com', 'open', camp['id'])
+
+        # a segment with a rescan in flight is left alone and the changes are
+        # kept for the pass after it
+        started = datetime.utcnow().isoformat() + 'Z'
+        self.db.segments.patch(vip, {'refresh_id': 'inflight', 'refresh_started': started})
+        before = self.segment_state(segids)
+
+        refresh_company_segments(cid, False)
+
+        assert self.segment_state([vip]) == {vip: before[vip]}
+        assert self.db.single('select count(*) from contact_changes where cid = %s', cid) > 0
+
+        self.db.execute("update segments set data = data - 'refresh_id' - 'refresh_started' where id = %s", vip)
+
+        refresh_company_segments(cid, False)
+
+        assert self.db.single('select count(*) from contact_changes where cid = %s', cid) == 0
+        incremental = self.segment_state(segids)
+        assert incremental != before
+
+        refresh_company_segments(cid, True)
+
+        assert self.segment_state(segids) == incremental
+        assert incremental[vip] == (2, self.emails(cid, ['dan@example.com', 'frank@example.org']))
+
+    def segment_state(self, segids):
+        state = {}
+        for segid in segids:
+            seg = self.db.segments.get(segid)
+            members = set(
+                contact_id for contact_id, in self.db.execute(
+                    'select contact_id from segment_members where segment_id = %s', segid
+                )
+            )
+            state[segid] = (seg['count'], members)
+        return state
+
+    def emails(self, cid, emails):
+        return set(
+            contact_id for contact_id, in self.db.execute(
+                f'select contact_id from contacts."contacts_{cid}" where email = any(%s)', emails
+            )
+        )
+
+    def feed(self, lid, email, name, tags):
+        self.user_post(f'/api/lists/{lid}/feed', json={
+            'email': email,
+            'tags': tags,
+            'data': {
+                'First Name': name,
+            }
+        })
+
+    def create_segment(self, operator, *parts):
+        return self.user_post('/api/segments', json={
+            'operator': operator,
+            'parts': list(parts),
+            'subset': False,
+            'subsettype': 'percent',
+            'subsetpct': 10,
+            'subsetnum': 2000,
+        })['id']
+
+    def create_broadcast(self, lid, name):
+        return self.user_post('/api/broadcasts', json={
+            'name': name,
+            'when': 'draft',
+            'tags': [],
+            'lists': [lid],
+            'segments': [],
+            'supplists': [],
+            'suppsegs': [],
+            'supptags': [],
+            'subject': 'test',
+            'fromname': 'test',
+            'fromemail': '',
+            'returnpath': 'test',
+            'replyto': '',
+            'rawText': '',
+            'type': 'raw',
+            'parts': [],
+            'bodyStyle': {}
+        })
+
+    def update(self, email, ct, c):
+        agentl = AGENT.lower()
+        update(self.db, self.user_cookie['cid'], {
+            'email': email,
+            'cmd': ct,
+            'campid': c,
+            'os': get_os(agentl),
+            'browser': get_browser(agentl),
+            'device': get_device(agentl),
+            'country': 'United States of America',
+            'region': 'California',
+            'zip': '99999',
+        })
@@ -0,0 +1,55 @@
+import test_base
+from concurrent.futures import ThreadPoolExecutor
+from api.shared.send import check_send_limit, check_send_limits
+from api.shared.utils import redis_connect
+
+THREADS = 8
+CALLS = 25
+
+
+class TestSendLimits(test_base.TestBase):
+
+    def setUp(self):
+        super(TestSendLimits, self).setUp()
+
+        self.cid = 'sendlimits-%s' % self._testMethodName
+        rdb = redis_connect()
+        for key in rdb.scan_iter('*%s*' % self.cid):
+            rdb.delete(key)
+
+    def run_concurrent(self, fn):
+        with ThreadPoolExecutor(THREADS) as pool:
+            return list(pool.map(lambda _: fn(), range(THREADS * CALLS)))
+
+    def test_daylimit(self):
+        company = {'id': self.cid, 'daylimit': 100}
+
+        granted = self.run_concurrent(lambda: check_send_limit(company, 'route', 'gmail.com', [], 3))
+
+        assert sum(granted) == 100
+        assert all(g in (0, 1, 3) for g in granted)
+        assert check_send_limit(company, 'route', 'gmail.com', [], 1) == 0
+
+    def test_domain_throttle(self):
+        company = {'id': self.cid}
+        throttles = [{'route': 'route', 'domainsparsed': ['gmail.com'], 'daylimit': 50}]
+
+        granted = self.run_concurrent(lambda: check_send_limits(company, throttles, [
+            ('route', 'gmail.com', 2),
+            ('route', 'yahoo.com', 2),
+        ]))
+
+        assert sum(g[0] for g in granted) == 50
+        assert sum(g[1] for g in granted) == 2 * THREADS * CALLS
+
+    def test_credits(self):
+        company = {'id': self.cid, 'paid': True}
+        rdb = redis_connect()
+        rdb.set('credits-%s' % self.cid, 30)
+        rdb.set('credits_expire-%s' % self.cid, 10)
+
+        granted = self.run_concurrent(lambda: check_send_limit(company, 'route', 'gmail.com', [], 4))
+
+        assert sum(granted) == 40
+        assert int(rdb.get('credits-%s' % self.cid)) == 0
+        assert int(rdb.get('credits_expire-%s' % self.cid)) == 0
@@ -0,0 +1,270 @@
+import os
+import msgpack
+import test_base
+from psycopg2.errors import CardinalityViolation
+from datetime import datetime
+from api.shared.contacts import write_rows
+from api.shared.s3 import s3_read_stream, s3_write
+from api.shared.snapshots import bump_contacts_version
+from api.shared.utils import unix_time_secs
+
+# contacts already in the tenant: email -> (props, lists)
+EXISTING = {
+    'inlist@writerows.example': ({'First Name': ['Old'], 'Unsubscribed': ['true']}, ['target']),
+    'both@writerows.example': ({'Bounced': ['true'], 'Complained': ['true']}, ['target', 'other']),
+    'otherlist@writerows.example': ({'Bounced': ['true'], 'Soft Bounced': ['true'], 'Last Name': ['Kept']}, ['other']),
+    'nolist@writerows.example': ({'Unsubscribed': ['true'], 'Complained': ['true']}, []),
+    'logged@writerows.example': ({'First Name': ['Old']}, ['other']),
+}
+
+# email -> (bounced, unsubscribed, complained)
+UNSUBLOGS = {
+    'logged@writerows.example': (False, False, True),
+    'unsubbed@writerows.example': (True, True, False),
+    'inlist@writerows.example': (False, True, False),
+}
+
+BLOCK = [
+    ('new@writerows.example', {'First Name': ['New']}),
+    ('unsubbed@writerows.example', {'First Name': ['Unsubbed']}),
+    ('inlist@writerows.example', {'First Name': ['Updated']}),
+    ('both@writerows.example', {'First Name': ['Both'], 'Soft Bounced': ['true']}),
+    ('otherlist@writerows.example', {'First Name': ['Other'], 'Unsubscribed': ['true']}),
+    ('nolist@writerows.example', {'First Name': ['None'], 'Unsubscribed': ['']}),
+    ('logged@writerows.example', {'First Name': ['Logged']}),
+    ('other@writerows.net', {'First Name': ['Net']}),
+]
+
+# the same email twice in one block
+DUPLICATES = [
+    ('dupe@writerows.example', {'First Name': ['First']}),
+    ('inlist@writerows.example', {'First Name': ['First']}),
+    ('dupe@writerows.example', {'First Name': ['Second'], 'Last Name': ['Second']}),
+    ('inlist@writerows.example', {'Last Name': ['Second']}),
+]
+
+
+def rowwise_write_rows(db, cid, listid, key, keytype, override, unsub):
+    """write_rows as it was before the staging table: one multi-row insert
+    with a parameter per value."""
+    count = 0
+    domaincounts = {}
+    values_query = []
+    values = []
+    emails = []
+    override_emails = []
+    unsublogs = {}
+    if keytype == 'list':
+        list_table = f'contacts."contact_lists_{cid}"'
+        list_column = 'list_id'
+    else:
+        list_table = f'contacts."contact_supplists_{cid}"'
+        list_column = 'supplist_id'
+    with db.transaction():
+        with s3_read_stream(os.environ['s3_transferbucket'], key) as fp:
+            lines = [(email, props) for email, props in msgpack.Unpacker(fp, strict_map_key=False)]
+        if keytype == 'list':
+            for email, bounced, unsubscribed, complained in db.execute(
+                'select email, bounced, unsubscribed, complained from unsublogs where cid = %s and email = any(%s)',
+                cid, [email for email, _ in lines],
+            ):
+                unsublogs[email] = (bounced, unsubscribed, complained)
+        for email, props in lines:
+            if override:
+                override_emails.append(email)
+                props['Bounced'] = ['']
+                props['Unsubscribed'] = ['']
+                props['Complained'] = ['']
+            elif email in unsublogs:
+                bounced, unsubscribed, complained = unsublogs[email]
+                if bounced:
+                    props['Bounced'] = ['true']
+                if unsubscribed:
+                    props['Unsubscribed'] = ['true']
+                if complained:
+                    props['Complained'] = ['true']
+            if keytype == 'list':
+                emails.append(email)
+            values_query.append('(%s, %s, %s)')
+            values.extend([email, unix_time_secs(datetime.now()), props])
+        values.append(listid)
+
+        flag = "count(distinct c.contact_id) filter (where coalesce((nullif(props->'%s'->>0, ''))::bool, false))"
+        if override:
+            stats = db.row(
+                f"""select -{flag % 'Bounced'}, -{flag % 'Unsubscribed'}, -{flag % 'Complained'}, 0
+                    from contacts."contacts_{cid}" c
+                    join {list_table} l on l.contact_id = c.contact_id and l.{list_column} = %s
+                    where c.email = any(%s)""",
+                listid, emails,
+            )
+        else:
+            stats = db.row(
+                f"""select sum(bounced), sum(unsubscribed), sum(complained), sum(soft_bounced)
+                    from (
+                        select {flag % 'Bounced'} as bounced,
+                               {'count(distinct c.contact_id)' if unsub else flag % 'Unsubscribed'} as unsubscribed,
+                               {flag % 'Complained'} as complained,
+                               {flag % 'Soft Bounced'} as soft_bounced
+                        from contacts."contacts_{cid}" c
+                        left join {list_table} l on l.contact_id = c.contact_id
+                        where email = any(%s)
+                        and (l.{list_column} is null or l.{list_column} != %s)
+                        union all
+                        select count(email) filter (where bounced),
+                               {'0' if unsub else 'count(email) filter (where unsubscribed)'},
+                               count(email) filter (where complained),
+                               0
+                        from unsublogs
+                        where cid = %s and email = any(%s)
+                    ) s""",
+                emails, listid, cid, emails,
+            )
+            if unsub:
+                existunsubs = db.single(
+                    f"""select count(c.contact_id)
+                        from contacts."contacts_{cid}" c
+                        join {list_table} l on l.contact_id = c.contact_id and l.{list_column} = %s
+                        where email = any(%s)""",
+                    listid, emails,
+                )
+                stats = (stats[0], stats[1] + existunsubs, stats[2], stats[3])
+
+        for domain, domaincount in db.execute(
+            f"""with c as (
+                    insert into contacts."contacts_{cid}" (email, added, props) values
+                    {", ".join(values_query)}
+                    on conflict (email) do update set props = contacts."contacts_{cid}".props || excluded.props
+                    returning contact_id, email
+                ), l as (
+                    insert into {list_table} (contact_id, {list_column})
+                    select c.contact_id, %s
+                    from c
+                    on conflict (contact_id, {list_column}) do nothing
+                    returning contact_id
+                )
+                select split_part(c.email, '@', 2) as domain, count(c.contact_id) as count
+                from c
+                join l on c.contact_id = l.contact_id
+                group by split_part(c.email, '@', 2)""",
+            *values,
+        ):
+            count += domaincount
+            domaincounts[domain] = domaincount
+
+        if len(override_emails):
+            db.execute('delete from unsublogs where cid = %s and email = any(%s)', cid, override_emails)
+
+    bump_contacts_version(db, cid)
+
+    return count, domaincounts, tuple(int(s or 0) for s in stats)
+
+
+class TestWriteRows(test_base.TestBase):
+
+    def setUp(self):
+        super(TestWriteRows, self).setUp()
+
+        self.cid = self.user_cookie['cid']
+        self.lists = {
+            'target': self.user_post('/api/lists', json={'name': 'test_write_rows'})['id'],
+            'other': self.user_post('/api/lists', json={'name': 'test_write_rows_other'})['id'],
+        }
+        self.supplist = self.user_post('/api/supplists', json={'name': 'test_write_rows'})['id']
+
+    def tearDown(self):
+        self.reset()
+        for lid in self.lists.values():
+            self.user_delete(f'/api/lists/{lid}')
+        self.user_delete(f'/api/supplists/{self.supplist}')
+
+        super(TestWriteRows, self).tearDown()
+
+    def reset(self):
+        self.db.execute(f'''delete from contacts."contacts_{self.cid}" where email like '%%@writerows.%%' ''')
+        self.db.execute('''delete from unsublogs where cid = %s and email like '%%@writerows.%%' ''', self.cid)
+
+    def seed(self, block):
+        self.reset()
+        for email, (props, lists) in EXISTING.items():
+            contact_id = self.db.single(
+                f'insert into contacts."contacts_{self.cid}" (email, added, props) values (%s, 0, %s) returning contact_id',
+                email, props,
+            )
+            for name in lists:
+                self.db.execute(
+                    f'insert into contacts."contact_lists_{self.cid}" (contact_id, list_id) values (%s, %s)',
+                    contact_id, self.lists[name],
+                )
+        for email, (bounced, unsubscribed, complained) in UNSUBLOGS.items():
+            self.db.execute(
+                'insert into unsublogs (cid, email, rawhash, unsubscribed, complained, bounced) values (%s, %s, 0, %s, %s, %s)',
+                self.cid, email, unsubscribed, complained, bounced,
+            )
+
+        key = 'lists/test_write_rows.block'
+        s3_write(os.environ['s3_transferbucket'], key, b''.join(msgpack.packb(row) for row in block))
+        return key
+
+    def state(self, keytype):
+        if keytype == 'list':
+            members = f'select contact_id from contacts."contact_lists_{self.cid}" where list_id = %s'
+            listid = self.lists['target']
+        else:
+            members = f'select contact_id from contacts."contact_supplists_{self.cid}" where supplist_id = %s'
+            listid = self.supplist
+        contacts = {
+            email: (props, member)
+            for email, props, member in self.db.execute(
+                f'''select email, props, contact_id in ({members})
+                    from contacts."contacts_{self.cid}" where email like '%%@writerows.%%' ''',
+                listid,
+            )
+        }
+        unsublogs = set(self.db.execute(
+            '''select email, bounced, unsubscribed, complained from unsublogs
+               where cid = %s and email like '%%@writerows.%%' ''', self.cid
+        ))
+        return contacts, unsublogs
+
+    def run_write(self, fn, block, keytype, listid, override, unsub):
+        key = self.seed(block)
+        count, domaincounts, stats = fn(self.db, self.cid, listid, key, keytype, override, unsub)
+        return (count, domaincounts, tuple(stats)), self.state(keytype)
+
+    def test_write_rows(self):
+        for keytype in ('list', 'supp'):
+            for override, unsub in ((False, False), (True, False), (False, True)):
+                listid = self.lists['target'] if keytype == 'list' else self.supplist
+                old = self.run_write(rowwise_write_rows, BLOCK, keytype, listid, override, unsub)
+                new = self.run_write(write_rows, BLOCK, keytype, listid, override, unsub)
+                assert new == old, (keytype, override, unsub)
+
+                (count, domaincounts, stats), (contacts, _) = new
+                assert count == len(BLOCK) - (2 if keytype == 'list' else 0)
+                assert domaincounts == {'writerows.example': count - 1, 'writerows.net': 1}
+                assert contacts['otherlist@writerows.example'][0]['Last Name'] == ['Kept']
+                if keytype == 'list':
+                    assert any(stats)
+
+    def test_duplicates(self):
+        first = {}
+        for email, props in DUPLICATES:
+            first.setdefault(email, props)
+        deduped = list(first.items())
+
+        for keytype in ('list', 'supp'):
+            for override, unsub in ((False, False), (True, False), (False, True)):
+                # the old single insert can't upsert an email twice
+                key = self.seed(DUPLICATES)
+                with self.assertRaises(CardinalityViolation):
+                    rowwise_write_rows(self.db, self.cid, self.lists['target'], key, keytype, override, unsub)
+
+                listid = self.lists['target'] if keytype == 'list' else self.supplist
+                old = self.run_write(rowwise_write_rows, deduped, keytype, listid, override, unsub)
+                new = self.run_write(write_rows, DUPLICATES, keytype, listid, override, unsub)
+                assert new == old, (keytype, override, unsub)
+
+                _, (contacts, _) = new
+                assert contacts['dupe@writerows.example'][0]['First Name'] == ['First']
+                assert 'Last Name' not in contacts['dupe@writerows.example'][0]